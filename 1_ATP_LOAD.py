@@ -1,30 +1,7 @@
 from ATP_common_config import *
 import time
 import random
-from functools import wraps
-
-# --- API Rate Limiting and Retry Logic ---
-MAX_RETRIES = 4
-INITIAL_BACKOFF = 0.5  # seconds
-MAX_BACKOFF = 8.0      # seconds
-RATE_LIMIT_DELAY = 0.25  # seconds, adjust as needed for API
-
-def call_with_retries(request_func, *args, **kwargs):
-    """Call an API function with retries and exponential backoff."""
-    delay = INITIAL_BACKOFF
-    for attempt in range(MAX_RETRIES):
-        response = request_func(*args, **kwargs)
-        if response.status_code in (200, 201, 204):
-            time.sleep(RATE_LIMIT_DELAY)  # Rate limiting after successful call
-            return response
-        elif response.status_code in (429, 500, 502, 503, 504):  # Retryable errors
-            logging.warning(f"API call failed with {response.status_code}, retry #{attempt + 1} after {delay}s.")
-            time.sleep(delay + random.uniform(0, 0.25))
-            delay = min(MAX_BACKOFF, delay * 2)
-        else:
-            logging.error(f"API call failed with {response.status_code}: {getattr(response, 'text', '')}")
-            break
-    return response  # Return last response for error handling
+from functools import partial, wraps
 
 def parse_atp_date(date_str):
     for fmt in ("%d-%m-%Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
@@ -49,19 +26,6 @@ def prompt_overwrite_past():
     answer = input("Do you want to overwrite data in the past? (yes/no): ").strip().lower()
     return answer == "yes"
 
-user_data = read_user_data(ATP_file_path)
-api_key = user_data.get('API_KEY', "yourapikey")
-username = user_data.get('USERNAME', "API_KEY")
-athlete_id = user_data.get('ATHLETE_ID', "athleteid")
-unit_preference = user_data.get('DISTANCE_SYSTEM', "metric")
-note_ATP_color = user_data.get('NOTE_ATP_COLOR', "red")
-do_at_rest = user_data.get('Do_At_Rest', "Do nothing!")
-
-url_base = "https://intervals.icu/api/v1/athlete/{athlete_id}"
-url_profile = f"https://intervals.icu/api/v1/athlete/{athlete_id}/profile"
-url_activities = f"https://intervals.icu/api/v1/athlete/{athlete_id}/activities"
-API_headers = {"Content-Type": "application/json"}
-
 def clean_activity_name(col_name):
     return col_name.replace('_load_target', '').replace('_load', '')
 
@@ -78,21 +42,21 @@ def normalize(val):
     except (ValueError, TypeError):
         return 0
 
+# Only these fields of the existing TARGET events are compared or used for updates
+TARGET_EVENT_FIELDS = {"id": None, "start_date_local": None, "type": None, "load_target": 0, "time_target": 0, "distance_target": 0}
+
 def get_existing_events(athlete_id, oldest_date, newest_date, username, api_key):
-    url_get = f"https://intervals.icu/api/v1/athlete/{athlete_id}/eventsjson"
-    params = {"oldest": oldest_date, "newest": newest_date, "category": "TARGET"}
-    response = call_with_retries(requests.get, url_get, headers=API_headers, params=params, auth=HTTPBasicAuth(username, api_key))
-    if response.status_code == 200:
-        events = response.json()
-        event_map = {
-            (e['start_date_local'], e['type']): e
-            for e in events
-        }
-        return event_map
+    url_get = f"{url_base}/eventsjson"
+    events, status = fetch_records(url_get, oldest_date, newest_date, params={"category": "TARGET"}, fields=TARGET_EVENT_FIELDS,
+                                   convert=EventRecord.from_json, headers=API_headers, auth=HTTPBasicAuth(username, api_key))
+    if status == 200:
+        # Keyed by (start_date_local, type), see ATP_events
+        return EventIndex("start_type", events)
     else:
-        logging.error(f"Failed to fetch events ({response.status_code})")
-        return {}
+        logging.error(f"Failed to fetch events ({status})")
+        return EventIndex("start_type")
 
+@timer("diff")
 def get_desired_events(df):
     desired = {}
     dist_factor = distance_conversion_factor(unit_preference)
@@ -125,89 +89,152 @@ def get_desired_events(df):
                 }
     return desired
 
-def efficient_event_sync(df, athlete_id, username, api_key):
+def target_fingerprints(events):
+    """Fingerprint per week of the TARGET events; events without any target count as absent."""
+    weeks = {}
+    for (start_date, activity), event in events.items():
+        targets = [normalize(event.get(field, 0)) for field in ('load_target', 'time_target', 'distance_target')]
+        if any(targets):
+            weeks.setdefault(start_date, {})[activity] = targets
+    return {week: fingerprint(targets) for week, targets in weeks.items()}
+
+def target_event_ids(events):
+    ids = {}
+    for (start_date, activity), event in events.items():
+        ids.setdefault(start_date, {})[activity] = event.get('id')
+    return ids
+
+def efficient_event_sync(df, athlete_id, username, api_key, verify=False, prefetched_events=None, window=None):
+    """prefetched_events: a Future of get_existing_events over the window (used with verify).
+
+    window: (oldest, newest) week starts the sync is limited to; default the ATP window.
+    """
     if df.empty:
         logging.error("No valid dates found in 'start_date_local'.")
         return
 
-    oldest_date, newest_date = read_ATP_period(ATP_file_path)
-    existing_events = get_existing_events(athlete_id, oldest_date, newest_date, username, api_key)
+    if window is None:
+        with workbook_lock, timer("workbook_load"):
+            window = read_ATP_period(ATP_file_path)
+    oldest_date, newest_date = window
     desired_events = get_desired_events(df)
+    desired_fingerprints = target_fingerprints(desired_events)
+    ledger = open_ledger("1_ATP_LOAD")
 
-    # 1. Create or Update events
-    for key, new_event in desired_events.items():
-        old_event = existing_events.get(key)
-        if old_event:
-            # Normalize all compared values for robust equality
-            old_load = normalize(old_event.get('load_target', 0))
-            old_time = normalize(old_event.get('time_target', 0))
-            old_distance = normalize(old_event.get('distance_target', 0))
-            new_load = normalize(new_event['load_target'])
-            new_time = normalize(new_event['time_target'])
-            new_distance = normalize(new_event['distance_target'])
-
-            # Log comparison for debugging
-            logging.debug(f"Comparing load_target: old={old_load}, new={new_load}")
-            logging.debug(f"Comparing time_target: old={old_time}, new={new_time}")
-            logging.debug(f"Comparing distance_target: old={old_distance}, new={new_distance}")
-
-            if (
-                old_load != new_load or
-                old_time != new_time or
-                old_distance != new_distance
-            ):
-                url_put = f"https://intervals.icu/api/v1/athlete/{athlete_id}/events/{old_event['id']}"
-                put_data = {
-                    "load_target": new_event['load_target'],
-                    "time_target": new_event['time_target'],
-                    "distance_target": new_event['distance_target']
-                }
-                logging.info(f"Updating event {key}: {put_data}")
-                response_put = call_with_retries(requests.put, url_put, headers=API_headers, json=put_data, auth=HTTPBasicAuth(username, api_key))
-                if response_put.status_code == 200:
-                    logging.info(f"Updated event for {key}")
-                else:
-                    logging.error(f"Failed to update event for {key}: {response_put.status_code}")
+    if verify:
+        if prefetched_events is not None:
+            existing_events = prefetched_events.result()
+        else:
+            existing_events = get_existing_events(athlete_id, oldest_date, newest_date, username, api_key)
+        weeks = None
+        # Only the window was fetched, so only its weeks are recorded again
+        ledger_weeks = keys_between(oldest_date, newest_date, desired_fingerprints, target_fingerprints(existing_events), ledger.entries)
+    else:
+        # Only the weeks whose targets changed since the last successful sync are fetched and reconciled
+        first_week = df['start_date_local'].min().strftime("%Y-%m-%dT00:00:00")
+        last_week = df['start_date_local'].max().strftime("%Y-%m-%dT00:00:00")
+        weeks = ledger.changed(desired_fingerprints, first_week, last_week)
+        if not weeks:
+            logging.info("All weeks match the sync ledger; nothing to fetch or update (use --verify to check the server).")
+            return
+        logging.info(f"{len(weeks)} week(s) changed since the last sync.")
+        existing_events = EventIndex("start_type")
+        for range_oldest, range_newest in date_ranges((week, week_end(week)) for week in weeks):
+            existing_events.update(get_existing_events(athlete_id, range_oldest, range_newest, username, api_key))
+        ledger_weeks = weeks
+
+    apply_event_changes(desired_events, existing_events, username, api_key, weeks=weeks)
+    in_sync = ledger.update(desired_fingerprints, target_fingerprints(existing_events), ledger_weeks, target_event_ids(existing_events))
+    ledger.save()
+    logging.info(f"Sync ledger updated: {in_sync} week(s) in sync.")
+
+def sync_target_event(key, desired_events, existing_events, username, api_key):
+    """Create or update the TARGET event of one (week, activity) key."""
+    new_event = desired_events[key]
+    old_event = existing_events.get(key)
+    if old_event:
+        # Normalize all compared values for robust equality
+        old_load = normalize(old_event.get('load_target', 0))
+        old_time = normalize(old_event.get('time_target', 0))
+        old_distance = normalize(old_event.get('distance_target', 0))
+        new_load = normalize(new_event['load_target'])
+        new_time = normalize(new_event['time_target'])
+        new_distance = normalize(new_event['distance_target'])
+
+        # Log comparison for debugging
+        logging.debug(f"Comparing load_target: old={old_load}, new={new_load}")
+        logging.debug(f"Comparing time_target: old={old_time}, new={new_time}")
+        logging.debug(f"Comparing distance_target: old={old_distance}, new={new_distance}")
+
+        if (
+            old_load != new_load or
+            old_time != new_time or
+            old_distance != new_distance
+        ):
+            url_put = f"{url_base}/events/{old_event['id']}"
+            put_data = {
+                "load_target": new_event['load_target'],
+                "time_target": new_event['time_target'],
+                "distance_target": new_event['distance_target']
+            }
+            logging.info(f"Updating event {key}: {put_data}")
+            response_put = call_with_retries(http_session.put, url_put, headers=API_headers, json=put_data, auth=HTTPBasicAuth(username, api_key))
+            if response_put.status_code == 200:
+                old_event.update(put_data)
+                logging.info(f"Updated event for {key}")
             else:
-                logging.info(f"No changes needed for event {key}")
+                logging.error(f"Failed to update event for {key}: {response_put.status_code}")
         else:
-            if any([new_event['load_target'] > 0, new_event['time_target'] > 0, new_event['distance_target'] > 0]):
-                url_post = f"https://intervals.icu/api/v1/athlete/{athlete_id}/events"
-                post_data = {
-                    "load_target": new_event['load_target'],
-                    "time_target": new_event['time_target'],
-                    "distance_target": new_event['distance_target'],
-                    "category": "TARGET",
-                    "type": new_event['type'],
-                    "name": "Weekly",
-                    "start_date_local": new_event['start_date_local']
-                }
-                logging.info(f"Creating event {key}: {post_data}")
-                response_post = call_with_retries(requests.post, url_post, headers=API_headers, json=post_data, auth=HTTPBasicAuth(username, api_key))
-                if response_post.status_code == 200:
-                    logging.info(f"Created new event for {key}")
-                else:
-                    logging.error(f"Failed to create event for {key}: {response_post.status_code}")
+            logging.info(f"No changes needed for event {key}")
+    else:
+        if any([new_event['load_target'] > 0, new_event['time_target'] > 0, new_event['distance_target'] > 0]):
+            url_post = f"{url_base}/events"
+            post_data = {
+                "load_target": new_event['load_target'],
+                "time_target": new_event['time_target'],
+                "distance_target": new_event['distance_target'],
+                "category": "TARGET",
+                "type": new_event['type'],
+                "name": "Weekly",
+                "start_date_local": new_event['start_date_local']
+            }
+            logging.info(f"Creating event {key}: {post_data}")
+            response_post = call_with_retries(http_session.post, url_post, headers=API_headers, json=post_data, auth=HTTPBasicAuth(username, api_key))
+            if response_post.status_code == 200:
+                existing_events[key] = dict(post_data, id=response_post.json().get('id'))
+                logging.info(f"Created new event for {key}")
+            else:
+                logging.error(f"Failed to create event for {key}: {response_post.status_code}")
+
+def delete_target_event(key, existing_events, username, api_key):
+    url_del = f"{url_base}/events/{existing_events[key]['id']}"
+    logging.info(f"Deleting event {key}")
+    response_del = call_with_retries(http_session.delete, url_del, headers=API_headers, auth=HTTPBasicAuth(username, api_key))
+    if response_del.status_code == 200:
+        del existing_events[key]
+        logging.info(f"Deleted event for {key}")
+    else:
+        logging.error(f"Failed to delete event for {key}: {response_del.status_code}")
+
+def apply_event_changes(desired_events, existing_events, username, api_key, weeks=None):
+    """Create, update and delete TARGET events until existing_events matches desired_events.
+
+    weeks limits the sync to those week start dates ("%Y-%m-%dT00:00:00").
+    existing_events is updated along the way, so it can be reused for the next sync.
+    The calls of each step run concurrently, as many at once as the API limiter allows.
+    """
+    # 1. Create or Update events
+    keys = [key for key in desired_events if weeks is None or key[0] in weeks]
+    run_concurrently(partial(sync_target_event, desired_events=desired_events, existing_events=existing_events, username=username, api_key=api_key), keys)
 
     # 2. Delete events that are no longer needed
-    for key, old_event in existing_events.items():
-        if key not in desired_events:
-            url_del = f"https://intervals.icu/api/v1/athlete/{athlete_id}/events/{old_event['id']}"
-            logging.info(f"Deleting event {key}")
-            response_del = call_with_retries(requests.delete, url_del, headers=API_headers, auth=HTTPBasicAuth(username, api_key))
-            if response_del.status_code == 200:
-                logging.info(f"Deleted event for {key}")
-            else:
-                logging.error(f"Failed to delete event for {key}: {response_del.status_code}")
+    keys = [key for key in existing_events if (weeks is None or key[0] in weeks) and key not in desired_events]
+    run_concurrently(partial(delete_target_event, existing_events=existing_events, username=username, api_key=api_key), keys)
 
-def main():
-    overwrite_past = prompt_overwrite_past()
-    df = pd.read_excel(ATP_file_path, sheet_name=ATP_sheet_name)
+def select_target_weeks(df, oldest_date, newest_date, overwrite_past):
     df.fillna(0, inplace=True)
     df['start_date_local'] = pd.to_datetime(df['start_date_local'], errors='coerce')
     df = df.dropna(subset=['start_date_local'])
-
-    oldest_date, newest_date = read_ATP_period(ATP_file_path)
     oldest = pd.to_datetime(oldest_date)
     newest = pd.to_datetime(newest_date)
     df = df[(df['start_date_local'] >= oldest) & (df['start_date_local'] <= newest)]
@@ -215,8 +242,33 @@ def main():
     if not overwrite_past:
         now = datetime.now()
         df = df[df['start_date_local'] >= now]
+    return df
+
+def sync_targets(verify=False, overwrite_past=None, first=None, last=None, weeks=None):
+    """first, last and weeks limit the sync to a range of weeks, see ATP_ledger.sync_range."""
+    if overwrite_past is None:
+        overwrite_past = prompt_overwrite_past()
+    with workbook_lock, timer("workbook_load"):
+        oldest_date, newest_date = clip_window(*read_ATP_period(ATP_file_path), *sync_range(first, last, weeks))
+    if not overwrite_past:
+        # Only the weeks that start after now are desired (select_target_weeks): fetch and reconcile just those,
+        # so --verify doesn't delete the past TARGET events as orphans
+        tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%dT00:00:00")
+        oldest_date, newest_date = clip_window(oldest_date, newest_date, tomorrow)
+    # With --verify all events of the window are read anyway: fetch them while ATP_Data is parsed
+    prefetched_events = prefetch(get_existing_events, athlete_id, oldest_date, newest_date, username, api_key) if verify else None
+    with workbook_lock, timer("workbook_load"):
+        df = pd.read_excel(ATP_file_path, sheet_name=ATP_sheet_name)
+    df = select_target_weeks(df, oldest_date, newest_date, overwrite_past)
+
+    efficient_event_sync(df, athlete_id, username, api_key, verify, prefetched_events, (oldest_date, newest_date))
 
-    efficient_event_sync(df, athlete_id, username, api_key)
+def main(argv=None):
+    parser = add_range_arguments(add_ledger_arguments(stage_argument_parser("Send the ATP weekly load, time and distance targets to intervals.icu.")))
+    parser.add_argument("--overwrite-past", choices=["yes", "no"], help="Answer the overwrite question up front, for unattended runs.")
+    args = parser.parse_args(argv)
+    with profiled(args, "1_ATP_LOAD"):
+        sync_targets(args.verify, None if args.overwrite_past is None else args.overwrite_past == "yes", args.first, args.last, args.weeks)
 
 if __name__ == "__main__":
     main()
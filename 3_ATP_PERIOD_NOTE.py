@@ -3,28 +3,6 @@ import time
 import random
 import re
 
-# --- API Rate Limiting and Retry Logic (from 1_ATP_LOAD.py) ---
-MAX_RETRIES = 4
-INITIAL_BACKOFF = 0.5  # seconds
-MAX_BACKOFF = 8.0      # seconds
-RATE_LIMIT_DELAY = 0.25  # seconds
-
-def call_with_retries(request_func, *args, **kwargs):
-    """Call an API function with retries and exponential backoff."""
-    delay = INITIAL_BACKOFF
-    for attempt in range(MAX_RETRIES):
-        response = request_func(*args, **kwargs)
-        if response.status_code in (200, 201, 204):
-            time.sleep(RATE_LIMIT_DELAY)
-            return response
-        elif response.status_code in (429, 500, 502, 503, 504):  # Retryable errors
-            logging.warning(f"API call failed with {response.status_code}, retry #{attempt + 1} after {delay}s.")
-            time.sleep(delay + random.uniform(0, 0.25))
-            delay = min(MAX_BACKOFF, delay * 2)
-        else:
-            logging.error(f"API call failed with {response.status_code}: {getattr(response, 'text', '')}")
-            break
-    return response  # Return last response for error handling
 
 def get_note_color(period):
     """
@@ -100,28 +78,19 @@ def read_ATP_period(ATP_file_path, sheet_name="ATP_Conditions"):
 def get_last_day_of_week(date):
     return date + timedelta(days=(6 - date.weekday()))
 
-def get_period_end_date(df, start_index):
-    period = df.at[start_index, 'period']
-    for i in range(start_index, len(df)):
-        if df.at[i, 'period'] != period:
-            return get_last_day_of_week(df.at[i-1, 'start_date_local'])
-    return get_last_day_of_week(df.at[len(df)-1, 'start_date_local'])
-
 def delete_events(athlete_id, username, api_key, oldest_date, newest_date, category, name_prefix):
     url_get = f"{url_base}/eventsjson".format(athlete_id=athlete_id)
-    params = {"oldest": oldest_date, "newest": newest_date, "category": category}
-    response_get = call_with_retries(
-        requests.get, url_get, headers=API_headers, params=params, auth=HTTPBasicAuth(username, api_key)
+    keep = name_starts_with(name_prefix) if name_prefix else None
+    events, _ = fetch_records(
+        url_get, oldest_date, newest_date, params={"category": category}, fields={'id': None}, keep=keep,
+        headers=API_headers, auth=HTTPBasicAuth(username, api_key)
     )
-    events = response_get.json() if response_get.status_code == 200 else []
 
     for event in events:
-        if name_prefix and not event['name'].startswith(name_prefix):
-            continue
         event_id = event['id']
         url_del = f"{url_base}/events/{event_id}".format(athlete_id=athlete_id)
         response_del = call_with_retries(
-            requests.delete, url_del, headers=API_headers, auth=HTTPBasicAuth(username, api_key)
+            http_session.delete, url_del, headers=API_headers, auth=HTTPBasicAuth(username, api_key)
         )
         if response_del.status_code == 200:
             logging.info(f"Deleted {category.lower()} event ID={event_id}")
@@ -142,9 +111,7 @@ def handle_period_name(period):
     return period
 
 def create_note_event(start_date, end_date, description, period_name, athlete_id, username, api_key):
-    url_base = f"https://intervals.icu/api/v1/athlete/{athlete_id}"
     url_post = f"{url_base}/events"
-    API_headers = {"Content-Type": "application/json"}
 
     color = get_note_color(period_name)
 
@@ -158,20 +125,13 @@ def create_note_event(start_date, end_date, description, period_name, athlete_id
     }
 
     response_post = call_with_retries(
-        requests.post, url_post, headers=API_headers, json=post_data, auth=HTTPBasicAuth(username, api_key)
+        http_session.post, url_post, headers=API_headers, json=post_data, auth=HTTPBasicAuth(username, api_key)
     )
     if response_post.status_code == 200:
         logging.info(f"New event created from {start_date} to {end_date}!")
     else:
         logging.error(f"Error creating event: {response_post.status_code} - {response_post.text}")
-
-def get_first_a_event(df, note_event_date):
-    note_date = datetime.strptime(note_event_date, "%Y-%m-%dT00:00:00")
-    for index, row in df.iterrows():
-        event_date = pd.to_datetime(row.get('start_date_local'))
-        if event_date > note_date and str(row.get('cat', '')).upper() == 'A' and row.get('race', '').strip():
-            return row.get('race', '').strip()
-    return None
+    return response_post
 
 def populate_race_description(description, first_a_event):
     if first_a_event:
@@ -186,91 +146,117 @@ def create_description(period_name, start_date, end_date, first_a_event):
 
 def get_existing_period_notes(athlete_id, oldest_date, newest_date, username, api_key, note_name_PERIOD):
     url_get = f"{url_base}/eventsjson".format(athlete_id=athlete_id)
-    params = {"oldest": oldest_date, "newest": newest_date, "category": "NOTE"}
-    response = call_with_retries(
-        requests.get, url_get, headers=API_headers, params=params, auth=HTTPBasicAuth(username, api_key)
+    # Only pick notes with correct prefix, and only the fields the sync compares
+    fields = {'id': None, 'name': "", 'start_date_local': None, 'end_date_local': None, 'description': "", 'color': ""}
+    notes, status = fetch_records(
+        url_get, oldest_date, newest_date, params={"category": "NOTE"}, fields=fields, keep=name_starts_with(note_name_PERIOD),
+        convert=EventRecord.from_json, headers=API_headers, auth=HTTPBasicAuth(username, api_key)
     )
-    notes = response.json() if response.status_code == 200 else []
-    # Only pick notes with correct prefix
-    period_notes = {}
-    for note in notes:
-        if note['name'].startswith(note_name_PERIOD):
-            key = (
-                note['start_date_local'],
-                note['end_date_local'],
-                note['name']
-            )
-            period_notes[key] = note
-    return period_notes
+    if status != 200:
+        return EventIndex("period")
+    # Keyed by (start_date_local, end_date_local, name), see ATP_events
+    return EventIndex("period", notes)
 
-def get_desired_period_notes(df):
+@timer("diff")
+def get_desired_period_notes(plan):
     desired_notes = {}
-    for i in range(len(df)):
-        start_date = df.at[i, 'start_date_local']
-        period = df.at[i, 'period']
+    for first, last in plan.period_blocks():
+        start_date = plan.weeks[first].start
         # Use cleaned full period name
-        period_name = handle_period_name(period)
-        if i == 0 or df.at[i-1, 'period'] != period:
-            end_date = get_period_end_date(df, i)
-            first_a_event = get_first_a_event(df, start_date.strftime("%Y-%m-%dT00:00:00"))
-            description = create_description(period_name, start_date, end_date, first_a_event)
-            name = f"{note_name_PERIOD} {period_name}"
-            color = get_note_color(period_name)
-            key = (
-                start_date.strftime("%Y-%m-%dT00:00:00"),
-                (end_date + timedelta(days=1)).strftime("%Y-%m-%dT00:00:00"),
-                name
-            )
-            desired_notes[key] = {
-                "category": "NOTE",
-                "start_date_local": key[0],
-                "end_date_local": key[1],
-                "name": name,
-                "description": description,
-                "color": color,
-                "period_name": period_name  # For later use
-            }
+        period_name = handle_period_name(plan.weeks[first].period)
+        end_date = get_last_day_of_week(plan.weeks[last].start)
+        first_a_event = plan.first_a_race_after(start_date)
+        description = create_description(period_name, start_date, end_date, first_a_event)
+        name = f"{note_name_PERIOD} {period_name}"
+        color = get_note_color(period_name)
+        key = (
+            start_date.strftime("%Y-%m-%dT00:00:00"),
+            (end_date + timedelta(days=1)).strftime("%Y-%m-%dT00:00:00"),
+            name
+        )
+        desired_notes[key] = {
+            "category": "NOTE",
+            "start_date_local": key[0],
+            "end_date_local": key[1],
+            "name": name,
+            "description": description,
+            "color": color,
+            "period_name": period_name  # For later use
+        }
     return desired_notes
 
-def main():
-    oldest_date, newest_date = read_ATP_period(ATP_file_path)
+def period_fingerprint(note):
+    return fingerprint([note.get("name"), note.get("end_date_local"), note.get("description", ""), note.get("color", "")])
+
+def sync_period_notes(verify=False, overwrite_past=None, first=None, last=None, weeks=None):
+    """first, last and weeks limit the sync to the periods of a range of weeks, see ATP_ledger.sync_range."""
+    with workbook_lock, timer("workbook_load"):
+        oldest_date, newest_date = read_ATP_period(ATP_file_path)
     oldest = pd.to_datetime(oldest_date)
     newest = pd.to_datetime(newest_date)
     now = datetime.now()
 
     # Only prompt if ATP period includes today or past
-    if oldest < now:
+    if oldest >= now:
+        overwrite_past = True  # ATP is completely in the future, so no filter needed
+    elif overwrite_past is None:
         answer = input("Do you want to delete notes in the past? (yes/no): ").strip().lower()
         overwrite_past = answer == "yes"
-    else:
-        overwrite_past = True  # ATP is completely in the future, so no filter needed
 
-    df = pd.read_excel(ATP_file_path, sheet_name=ATP_sheet_name, engine='openpyxl')
-    df['start_date_local'] = pd.to_datetime(df['start_date_local'], format='%d-%b', errors='coerce')
-    df = df.dropna(subset=['start_date_local'])
+    with workbook_lock, timer("workbook_load"):
+        df = pd.read_excel(ATP_file_path, sheet_name=ATP_sheet_name, engine='openpyxl')
+    plan = read_week_plan(df, date_format='%d-%b')
 
     # Strictly limit data to ATP period
-    df = df[(df['start_date_local'] >= oldest) & (df['start_date_local'] <= newest)]
+    plan = plan.between(oldest, newest)
 
     # If not overwriting past, only keep future notes
     if not overwrite_past:
-        df = df[df['start_date_local'] >= now]
+        plan = plan.between(now)
 
     # Define date range for NOTE events syncing
-    if df.empty:
+    if not len(plan):
         logging.info("No notes to process for the selected ATP period.")
         return
 
-    oldest_date = df['start_date_local'].min().strftime("%Y-%m-%dT00:00:00")
-    newest_date = df['start_date_local'].max().strftime("%Y-%m-%dT00:00:00")
+    oldest_date = min(week.start for week in plan).strftime("%Y-%m-%dT00:00:00")
+    newest_date = max(week.start for week in plan).strftime("%Y-%m-%dT00:00:00")
 
     # Build the desired notes dictionary
-    desired_notes = get_desired_period_notes(df)
-    # Read all existing notes for this period and prefix
-    existing_notes = get_existing_period_notes(athlete_id, oldest_date, newest_date, username, api_key, note_name_PERIOD)
+    desired_notes = get_desired_period_notes(plan)
+    first, last = sync_range(first, last, weeks)
+    if first or last:
+        # Period notes are synced whole: a range takes in every period it touches, and nothing outside them
+        desired_notes = {key: note for key, note in desired_notes.items() if (last is None or key[0] <= last) and (first is None or key[1] > first)}
+        if not desired_notes:
+            logging.info("No periods in the selected range.")
+            return
+        oldest_date = min(key[0] for key in desired_notes)
+        newest_date = (pd.to_datetime(max(key[1] for key in desired_notes)) - timedelta(days=1)).strftime("%Y-%m-%dT00:00:00")
+    desired_fingerprints = {key[0]: period_fingerprint(note) for key, note in desired_notes.items()}
+    period_ends = {key[0]: key[1] for key in desired_notes}
+    ledger = open_ledger("3_ATP_PERIOD_NOTE")
+
+    if verify:
+        # Read all existing notes for this period and prefix
+        existing_notes = get_existing_period_notes(athlete_id, oldest_date, newest_date, username, api_key, note_name_PERIOD)
+        periods = None
+    else:
+        # Only periods whose note changed since the last successful sync are fetched and reconciled
+        periods = ledger.changed(desired_fingerprints, oldest_date, newest_date)
+        if not periods:
+            logging.info("All period notes match the sync ledger; nothing to fetch or update (use --verify to check the server).")
+            return
+        logging.info(f"{len(periods)} period note(s) changed since the last sync.")
+        spans = [(start, max(period_ends.get(start, start), ledger.until(start) or start)) for start in periods]
+        existing_notes = EventIndex("period")
+        for range_oldest, range_newest in date_ranges(spans):
+            existing_notes.update(get_existing_period_notes(athlete_id, range_oldest, range_newest, username, api_key, note_name_PERIOD))
 
     # 1. Update existing notes if different, or create new notes
     for key, desired_note in desired_notes.items():
+        if periods is not None and key[0] not in periods:
+            continue
         existing_note = existing_notes.get(key)
         if existing_note:
             # Compare fields: description, color
@@ -284,9 +270,10 @@ def main():
                     "color": desired_note["color"]
                 }
                 response_put = call_with_retries(
-                    requests.put, url_put, headers=API_headers, json=put_data, auth=HTTPBasicAuth(username, api_key)
+                    http_session.put, url_put, headers=API_headers, json=put_data, auth=HTTPBasicAuth(username, api_key)
                 )
                 if response_put.status_code == 200:
+                    existing_note.update(put_data)
                     logging.info(f"Updated NOTE {desired_note['name']}")
                 else:
                     logging.error(f"Failed to update NOTE {desired_note['name']}: {response_put.status_code}")
@@ -294,25 +281,43 @@ def main():
                 logging.info(f"NOTE {desired_note['name']} is unchanged; no update needed.")
         else:
             # Create new NOTE
-            create_note_event(
+            response_post = create_note_event(
                 pd.to_datetime(desired_note["start_date_local"]),
                 pd.to_datetime(desired_note["end_date_local"]) - timedelta(days=1),
                 desired_note["description"],
                 desired_note["period_name"],  # Pass full cleaned period name
                 athlete_id, username, api_key
             )
+            if response_post.status_code == 200:
+                existing_notes[key] = dict(desired_note, id=response_post.json().get("id"))
 
     # 2. Delete notes that are no longer needed
-    for key, existing_note in existing_notes.items():
+    for key, existing_note in list(existing_notes.items()):
         if key not in desired_notes:
             url_del = f"{url_base}/events/{existing_note['id']}".format(athlete_id=athlete_id)
             response_del = call_with_retries(
-                requests.delete, url_del, headers=API_headers, auth=HTTPBasicAuth(username, api_key)
+                http_session.delete, url_del, headers=API_headers, auth=HTTPBasicAuth(username, api_key)
             )
             if response_del.status_code == 200:
+                del existing_notes[key]
                 logging.info(f"Deleted NOTE {existing_note['name']}")
             else:
                 logging.error(f"Failed to delete NOTE {existing_note['name']}: {response_del.status_code}")
 
+    actual_fingerprints = {key[0]: period_fingerprint(note) for key, note in existing_notes.items()}
+    event_ids = {key[0]: {key[2]: note.get("id")} for key, note in existing_notes.items()}
+    if periods is None:  # Only the notes from oldest_date to newest_date were fetched, so only those are recorded again
+        periods = keys_between(oldest_date, newest_date, desired_fingerprints, actual_fingerprints, ledger.entries)
+    in_sync = ledger.update(desired_fingerprints, actual_fingerprints, periods, event_ids, until=period_ends)
+    ledger.save()
+    logging.info(f"Sync ledger updated: {in_sync} period(s) in sync.")
+
+def main(argv=None):
+    parser = add_range_arguments(add_ledger_arguments(stage_argument_parser("Create or update a note for every ATP period on intervals.icu.")))
+    parser.add_argument("--overwrite-past", choices=["yes", "no"], help="Answer the delete-past question up front, for unattended runs.")
+    args = parser.parse_args(argv)
+    with profiled(args, "3_ATP_PERIOD_NOTE"):
+        sync_period_notes(args.verify, None if args.overwrite_past is None else args.overwrite_past == "yes", args.first, args.last, args.weeks)
+
 if __name__ == "__main__":
     main()
@@ -3,56 +3,33 @@ from ATP_common_config import *
 
 def get_events(athlete_id, username, api_key, oldest_date, newest_date, category):
     url_get = f"{url_base}/eventsjson".format(athlete_id=athlete_id)
-    params = {"oldest": oldest_date.strftime("%Y-%m-%dT00:00:00"), "newest": newest_date.strftime("%Y-%m-%dT00:00:00"), "category": category}
-    response = requests.get(url_get, headers=API_headers, params=params, auth=HTTPBasicAuth(username, api_key))
-    if response.status_code == 200:
-        return response.json()
+    events, status = fetch_records(
+        url_get, oldest_date.strftime("%Y-%m-%dT00:00:00"), newest_date.strftime("%Y-%m-%dT00:00:00"), params={"category": category},
+        headers=API_headers, auth=HTTPBasicAuth(username, api_key)
+    )
+    if status == 200:
+        return events
     else:
-        logging.error(f"Error fetching events for category {category}: {response.status_code}")
+        logging.error(f"Error fetching events for category {category}: {status}")
         return []
 
-def calculate_weekly_type_loads(workouts, race_b_events, race_c_events):
-    weekly_type_loads = {}
-    for workout in workouts + race_b_events + race_c_events:
-        if 'id' not in workout:
-            continue
-        date = datetime.strptime(workout['start_date_local'], "%Y-%m-%dT%H:%M:%S")
-        week = f"{date.isocalendar()[1]:02d}"  # Format week to two digits
-        year = date.isocalendar()[0]
-        year_week = f"{year}-{week}"
-        icu_training_load = workout.get('icu_training_load') or 0
-        workout_type = workout.get('type', 'Unknown')
-        if year_week not in weekly_type_loads:
-            weekly_type_loads[year_week] = {}
-        if workout_type not in weekly_type_loads[year_week]:
-            weekly_type_loads[year_week][workout_type] = 0
-        weekly_type_loads[year_week][workout_type] += icu_training_load
-    return weekly_type_loads
+@timer("diff")
+def calculate_weekly_type_loads(workouts, race_b_events, race_c_events, targeted=None):
+    events = [event for event in workouts + race_b_events + race_c_events if 'id' in event]
+    return weekly_type_totals(activity_table(events), targeted=targeted).to_dict(orient="index")
 
+@timer("diff")
 def calculate_weekly_target_loads(target_loads):
-    weekly_target_loads = {}
-    for target in target_loads:
-        if 'id' not in target:
-            continue
-        date = datetime.strptime(target['start_date_local'], "%Y-%m-%dT%H:%M:%S")
-        week = f"{date.isocalendar()[1]:02d}"  # Format week to two digits
-        year = date.isocalendar()[0]
-        year_week = f"{year}-{week}"
-        load_target = target.get('load_target') or 0
-        target_type = target.get('type', 'Unknown')
-        if year_week not in weekly_target_loads:
-            weekly_target_loads[year_week] = {}
-        if target_type not in weekly_target_loads[year_week]:
-            weekly_target_loads[year_week][target_type] = 0
-        weekly_target_loads[year_week][target_type] += load_target
-    return weekly_target_loads
+    return weekly_type_totals(target_table([target for target in target_loads if 'id' in target]), "load_target")
 
 def set_column_widths(sheet, df, start_col=1):
     for i, col in enumerate(df.columns, start=start_col):
         maxlen = max(df[col].astype(str).map(len).max(), len(col))
         sheet.range((1, i)).column_width = maxlen + 2
 
-def export_to_excel(weekly_type_loads, weekly_target_loads, file_path):
+@timer("diff")
+def build_load_check_tables(weekly_type_loads, weekly_target_loads, weekly_done_loads=None):
+    weekly_done_loads = weekly_done_loads or {}
     # Create DataFrames as before (pandas is the best tool for this!)
     rows = []
     all_types = set()
@@ -69,24 +46,39 @@ def export_to_excel(weekly_type_loads, weekly_target_loads, file_path):
             planned_df[col] = 0
     planned_df = planned_df[["Week"] + actual_columns].sort_values(by="Week")
 
+    # Done = what the athlete actually recorded (activities), next to the planned workouts and the targets
+    done_types = {t for loads in weekly_done_loads.values() for t, load in loads.items() if load}
     rows = []
-    for year_week in set(weekly_type_loads.keys()).union(weekly_target_loads.keys()):
+    for year_week in set(weekly_type_loads.keys()).union(weekly_target_loads.keys()).union(weekly_done_loads.keys()):
         row = {"Week": year_week}
         for workout_type in weekly_type_loads.get(year_week, {}):
             row[f"Actual {workout_type}"] = weekly_type_loads[year_week][workout_type]
         for target_type in weekly_target_loads.get(year_week, {}):
             row[f"Target {target_type}"] = weekly_target_loads[year_week][target_type]
+        for done_type in done_types:
+            row[f"Done {done_type}"] = round(weekly_done_loads.get(year_week, {}).get(done_type, 0))
         row["Total Actual_Load"] = sum(row.get(f"Actual {t}", 0) for t in all_types)
         row["Total Target_Load"] = sum(row.get(f"Target {t}", 0) for t in all_types)
+        row["Total Done_Load"] = sum(row.get(f"Done {t}", 0) for t in done_types)
         row["Load Difference"] = row["Total Actual_Load"] - row["Total Target_Load"]
+        row["Done Difference"] = row["Total Done_Load"] - row["Total Target_Load"]
         rows.append(row)
     compare_df = pd.DataFrame(rows).fillna(0)
     target_columns = sorted([f"Target {t}" for t in all_types])
+    done_columns = sorted([f"Done {t}" for t in done_types])
     for col in actual_columns + target_columns:
         if col not in compare_df.columns:
             compare_df[col] = 0
-    compare_df = compare_df[["Week"] + actual_columns + target_columns + ["Total Actual_Load", "Total Target_Load", "Load Difference"]].sort_values(by="Week")
+    compare_df = compare_df[["Week"] + actual_columns + target_columns + done_columns + ["Total Actual_Load", "Total Target_Load", "Total Done_Load", "Load Difference", "Done Difference"]].sort_values(by="Week")
+    return planned_df, compare_df
+
+def events_table(events):
+    # The per-event rows behind WTL/WLC, for the columnar export
+    columns = ["id", "category", "start_date_local", "type", "name", "icu_training_load", "load_target"]
+    return pd.DataFrame([{column: event.get(column) for column in columns} for event in events], columns=columns)
 
+@timer("export")
+def export_to_excel(planned_df, compare_df, file_path):
     # Use xlwings to write to the .xlsm file
     app = xw.App(visible=False)
     try:
@@ -116,8 +108,9 @@ def export_to_excel(weekly_type_loads, weekly_target_loads, file_path):
     finally:
         app.quit()
 
-def main():
-    df = pd.read_excel(ATP_file_path, sheet_name=ATP_sheet_name)
+def load_check(exporter=None, excel=True):
+    with workbook_lock, timer("workbook_load"):
+        df = pd.read_excel(ATP_file_path, sheet_name=ATP_sheet_name)
 
     # Ensure start_date_local is parsed as datetime (coerce errors to NaT)
     df['start_date_local'] = pd.to_datetime(df['start_date_local'], errors='coerce')
@@ -131,18 +124,43 @@ def main():
     oldest_date = df['start_date_local'].min()
     newest_date = df['start_date_local'].max()
 
+    # The four event reads and the activity sync are independent: run them side by side
+    prefetched = {category: prefetch(get_events, athlete_id, username, api_key, oldest_date, newest_date, category) for category in ("WORKOUT", "RACE_B", "RACE_C", "TARGET")}
+    # Recorded activities come from the local activity cache; only new or recent days are fetched
+    prefetched_activities = prefetch(
+        ActivityStore(ATP_cache_dir, athlete_id).sync,
+        url_activities, oldest_date, newest_date + timedelta(days=6), headers=API_headers, auth=HTTPBasicAuth(username, api_key)
+    )
+
     # Now safely fill numeric columns only (avoid replacing datetime NaT with 0)
     numeric_cols = df.select_dtypes(include=['number']).columns
     if len(numeric_cols) > 0:
         df[numeric_cols] = df[numeric_cols].fillna(0)
 
-    workouts = get_events(athlete_id, username, api_key, oldest_date, newest_date, "WORKOUT")
-    race_b_events = get_events(athlete_id, username, api_key, oldest_date, newest_date, "RACE_B")
-    race_c_events = get_events(athlete_id, username, api_key, oldest_date, newest_date, "RACE_C")
-    target_loads = get_events(athlete_id, username, api_key, oldest_date, newest_date, "TARGET")
-    weekly_type_loads = calculate_weekly_type_loads(workouts, race_b_events, race_c_events)
-    weekly_target_loads = calculate_weekly_target_loads(target_loads)
-    export_to_excel(weekly_type_loads, weekly_target_loads, ATP_loadcheck_file_path)
+    workouts, race_b_events, race_c_events, target_loads = (prefetched[category].result() for category in ("WORKOUT", "RACE_B", "RACE_C", "TARGET"))
+    # Planned workouts and activities count toward the types that have targets (a VirtualRide toward Ride)
+    weekly_targets = calculate_weekly_target_loads(target_loads)
+    weekly_type_loads = calculate_weekly_type_loads(workouts, race_b_events, race_c_events, targeted=weekly_targets.columns)
+    weekly_target_loads = weekly_targets.to_dict(orient="index")
+    activities = prefetched_activities.result()
+    with timer("diff"):
+        weekly_done_loads = weekly_type_totals(activities, targeted=weekly_targets.columns).to_dict(orient="index")
+    planned_df, compare_df = build_load_check_tables(weekly_type_loads, weekly_target_loads, weekly_done_loads)
+    if exporter is not None:
+        exporter.write({
+            ATP_loadcheck_sheet_name: planned_df,
+            ATP_loadcheck_compare_sheet_name: compare_df,
+            "load_check_events": events_table(workouts + race_b_events + race_c_events + target_loads),
+            "activities": activities,
+        })
+    if excel:
+        with workbook_lock:
+            export_to_excel(planned_df, compare_df, ATP_loadcheck_file_path)
+
+def main(argv=None):
+    args = add_export_arguments(stage_argument_parser("Write planned and target loads per activity type from intervals.icu to the workbook.")).parse_args(argv)
+    with profiled(args, "4_LOAD_CHECK"):
+        load_check(open_exporter(args, athlete_TLA, ATP_year), excel=not args.no_excel)
 
 if __name__ == "__main__":
     main()
@@ -2,28 +2,6 @@ from ATP_common_config import *
 import time
 import random
 
-# --- API Rate Limiting and Retry Logic ---
-MAX_RETRIES = 4
-INITIAL_BACKOFF = 0.5  # seconds
-MAX_BACKOFF = 8.0      # seconds
-RATE_LIMIT_DELAY = 0.25  # seconds
-
-def call_with_retries(request_func, *args, **kwargs):
-    delay = INITIAL_BACKOFF
-    for attempt in range(MAX_RETRIES):
-        response = request_func(*args, **kwargs)
-        if response.status_code in (200, 201, 204):
-            time.sleep(RATE_LIMIT_DELAY)
-            return response
-        elif response.status_code in (429, 500, 502, 503, 504):
-            logging.warning(f"API call failed with {response.status_code}, retry #{attempt + 1} after {delay}s.")
-            time.sleep(delay + random.uniform(0, 0.25))
-            delay = min(MAX_BACKOFF, delay * 2)
-        else:
-            logging.error(f"API call failed with {response.status_code}: {getattr(response, 'text', '')}")
-            break
-    return response
-
 def format_activity_name(activity):
     return ''.join(word.capitalize() for word in activity.split('_'))
 
@@ -53,62 +31,53 @@ def get_previous_week(year, week):
         return year, week - 1
 
 # --- Date Handling Based on ATP Period ---
-start_atp_date, end_atp_date, oldest_date_str, newest_date_str = read_ATP_period(ATP_file_path, sheet_name=ATP_sheet_Conditions)
+with timer("workbook_load"):
+    start_atp_date, end_atp_date, oldest_date_str, newest_date_str = read_ATP_period(ATP_file_path, sheet_name=ATP_sheet_Conditions)
 oldest_date = start_atp_date
 newest_date = end_atp_date
 
-def get_athlete_name(athlete_id, username, api_key):
-    response = call_with_retries(requests.get, url_profile, auth=HTTPBasicAuth(username, api_key), headers=API_headers)
-    logging.info(f"Response Status Code: {response.status_code}")
-    if response.status_code == 200:
-        profile = response.json()
-        full_name = profile.get('athlete', {}).get('name', 'Athlete without name')
-        first_name = full_name.split()[0] if full_name else 'Athlete'
-        return first_name
-    else:
-        logging.error(f"Error fetching athlete profile: {response.status_code}")
-        try:
-            logging.error(f"Response JSON: {response.json()}")
-        except ValueError:
-            logging.error("Response content is not in JSON format")
-        raise Exception(f"Error fetching athlete profile: {response.status_code}")
-
 athlete_name = get_athlete_name(athlete_id, username, api_key)
 logging.info(f"Using athlete first name: {athlete_name} for further processing.")
 
 def get_wellness_data(athlete_id, username, api_key, oldest_date, newest_date):
-    url_wellness = f"https://intervals.icu/api/v1/athlete/{athlete_id}/wellness"
-    response = call_with_retries(requests.get, url_wellness, headers=API_headers, auth=HTTPBasicAuth(username, api_key))
-    if response.status_code == 200:
-        data = response.json()
-        filtered_data = [
-            { "id": entry["id"], "ctlLoad": entry.get("ctlLoad", 0), "atlLoad": entry.get("atlLoad", 0) }
-            for entry in data
-            if oldest_date <= datetime.strptime(entry["id"], "%Y-%m-%d") <= newest_date
-        ]
+    url_wellness = f"{url_base}/wellness"
+    filtered_data, status = fetch_records(
+        url_wellness, oldest_date.strftime("%Y-%m-%d"), newest_date.strftime("%Y-%m-%d"),
+        fields={"id": None, "ctlLoad": 0, "atlLoad": 0},
+        keep=in_date_window("id", oldest_date, newest_date),
+        headers=API_headers, auth=HTTPBasicAuth(username, api_key)
+    )
+    if status == 200:
         logging.info(f"Fetched wellness data for athlete {athlete_id}")
         return filtered_data
     else:
-        logging.error(f"Error fetching wellness data: {response.status_code}")
+        logging.error(f"Error fetching wellness data: {status}")
         return []
 
+@timer("diff")
 def calculate_weekly_loads(wellness_data):
     weekly_loads = {}
     for entry in wellness_data:
         if 'id' not in entry:
             continue
         date = datetime.strptime(entry['id'], "%Y-%m-%d")
-        week = date.isocalendar()[1]
-        year = date.isocalendar()[0]
-        year_week = f"{year}-{week}"
-        if year_week not in weekly_loads:
-            weekly_loads[year_week] = {'ctlLoad': 0, 'atlLoad': 0}
-        weekly_loads[year_week]['ctlLoad'] += round(entry.get('ctlLoad', 0))
-        weekly_loads[year_week]['atlLoad'] += round(entry.get('atlLoad', 0))
-        logging.debug(f"Year-Week {year_week}: ctlLoad={weekly_loads[year_week]['ctlLoad']}, atlLoad={weekly_loads[year_week]['atlLoad']}")
+        week = year_week(date)
+        if week not in weekly_loads:
+            weekly_loads[week] = {'ctlLoad': 0, 'atlLoad': 0}
+        weekly_loads[week]['ctlLoad'] += round(entry.get('ctlLoad', 0))
+        weekly_loads[week]['atlLoad'] += round(entry.get('atlLoad', 0))
+        logging.debug(f"Year-Week {week}: ctlLoad={weekly_loads[week]['ctlLoad']}, atlLoad={weekly_loads[week]['atlLoad']}")
     logging.info("Calculated weekly loads from wellness data")
     return weekly_loads
 
+def get_model_weekly_loads(activities, oldest_date, newest_date):
+    # The activities start WARMUP_DAYS before oldest_date, so the model's CTL has settled by the first week
+    daily_loads = daily_load_series(activities, oldest_date - timedelta(days=WARMUP_DAYS), newest_date, date_key="date")
+    with timer("diff"):
+        weekly_loads = weekly_loads_from_model(fitness_frame(daily_loads))
+    logging.info("Calculated weekly loads with the local CTL/ATL model")
+    return weekly_loads
+
 def format_focus_items_notes(focus_items_notes):
     if len(focus_items_notes) > 1:
         return ', '.join(focus_items_notes[:-1]) + ' and ' + focus_items_notes[-1]
@@ -121,7 +90,8 @@ def populate_description(description):
     description += note_underline_FEEDBACK 
     return description
 
-def add_load_check_description(row, previous_week_loads, previous_week_sheet_load, description):
+@timer("diff")
+def add_load_check_description(previous_week_loads, previous_week_sheet_load, description):
     ctl_load = round(previous_week_loads['ctlLoad'])
     atl_load = round(previous_week_loads['atlLoad'])
     delta_ctl = ctl_load - previous_week_sheet_load
@@ -140,24 +110,47 @@ def add_load_check_description(row, previous_week_loads, previous_week_sheet_loa
     elif delta_ctl < -compliance_treshold * previous_week_sheet_load or delta_atl < -compliance_treshold * previous_week_sheet_load:
         feedback = "You did too little. No problem, but don't make a habit of it."
     description += f"- Your **total trainingload** for the last week was: **{ctl_load}**. Compared to the **planned trainingload**: **{previous_week_sheet_load}**.\n\n- **Feedback**: {feedback} \n\n"
+    if 'tsb' in previous_week_loads:
+        description += f"- At the end of the week your **fitness** (CTL) was **{previous_week_loads['ctl']}**, your **fatigue** (ATL) **{previous_week_loads['atl']}** and your **form** (TSB) **{previous_week_loads['tsb']}**.\n\n"
+    return description
+
+def get_target_events(athlete_id, username, api_key, oldest_date, newest_date):
+    url_get = f"{url_base}/eventsjson"
+    events, status = fetch_records(
+        url_get, oldest_date.strftime("%Y-%m-%dT00:00:00"), newest_date.strftime("%Y-%m-%dT00:00:00"),
+        params={"category": "TARGET"}, fields={"start_date_local": None, "type": None, "load_target": 0},
+        headers=API_headers, auth=HTTPBasicAuth(username, api_key)
+    )
+    if status == 200:
+        targets = target_table(events)
+        logging.info(f"Fetched TARGET events for athlete {athlete_id}")
+        return targets
+    logging.error(f"Failed to fetch TARGET events: {status}")
+    return target_table([])
+
+def add_compliance_description(compliance, year_week, description):
+    lines = compliance_lines(compliance, year_week)
+    if lines:
+        description += "- **Per activity type**:\n" + "\n".join(f"  {line}" for line in lines) + "\n\n"
     return description
 
 def get_existing_feedback_notes(athlete_id, username, api_key, oldest_date, newest_date, note_name_template_FEEDBACK):
     # Fetch NOTE events in the ATP window. We'll look up any existing NOTE that starts with our note name prefix.
     url_get = f"{url_base}/eventsjson"
-    params = {
-        "oldest": oldest_date.strftime("%Y-%m-%dT00:00:00"),
-        "newest": newest_date.strftime("%Y-%m-%dT00:00:00"),
-        "category": "NOTE"
-    }
-    response = call_with_retries(requests.get, url_get, headers=API_headers, params=params, auth=HTTPBasicAuth(username, api_key))
-    if response.status_code == 200:
-        events = response.json()
+    prefix = note_name_template_FEEDBACK.split('{')[0]
+    events, status = fetch_records(
+        url_get, oldest_date.strftime("%Y-%m-%dT00:00:00"), newest_date.strftime("%Y-%m-%dT00:00:00"),
+        params={"category": "NOTE"},
+        fields={'id': None, 'name': ""},
+        keep=lambda ev: ev.get('category') == 'NOTE' and (ev.get('name') or '').startswith(prefix),
+        convert=EventRecord.from_json, headers=API_headers, auth=HTTPBasicAuth(username, api_key)
+    )
+    if status == 200:
+        existing = EventIndex("name", events)
         logging.info(f"Fetched existing feedback NOTE events for athlete {athlete_id}")
-        prefix = note_name_template_FEEDBACK.split('{')[0]
-        return {ev['name']: ev for ev in events if ev.get('category') == 'NOTE' and ev.get('name', '').startswith(prefix)}
-    logging.error(f"Failed to fetch existing feedback NOTE events: {response.status_code}")
-    return {}
+        return existing
+    logging.error(f"Failed to fetch existing feedback NOTE events: {status}")
+    return EventIndex("name")
 
 def update_note_event(event_id, start_date, description, color, athlete_id, username, api_key, last_week):
     url_put = f"{url_base}/events/{event_id}"
@@ -165,7 +158,7 @@ def update_note_event(event_id, start_date, description, color, athlete_id, user
         "description": description,
         "color": color
     }
-    response_put = call_with_retries(requests.put, url_put, headers=API_headers, json=put_data, auth=HTTPBasicAuth(username, api_key))
+    response_put = call_with_retries(http_session.put, url_put, headers=API_headers, json=put_data, auth=HTTPBasicAuth(username, api_key))
     if response_put.status_code in (200, 201):
         logging.info(f"Updated feedback NOTE event for week {last_week}")
     else:
@@ -188,7 +181,7 @@ def create_note_event(start_date, description, color, athlete_id, username, api_
         "for_week": "true"
     }
     url_post = f"{url_base}/events"
-    response_post = call_with_retries(requests.post, url_post, headers=API_headers, json=post_data, auth=HTTPBasicAuth(username, api_key))
+    response_post = call_with_retries(http_session.post, url_post, headers=API_headers, json=post_data, auth=HTTPBasicAuth(username, api_key))
     if response_post.status_code in (200, 201, 204):
         logging.info(f"Created feedback NOTE event for week {last_week}")
     else:
@@ -196,51 +189,74 @@ def create_note_event(start_date, description, color, athlete_id, username, api_
 
 def delete_note_event(event_id, athlete_id, username, api_key, last_week):
     url_del = f"{url_base}/events/{event_id}"
-    response_del = call_with_retries(requests.delete, url_del, headers=API_headers, auth=HTTPBasicAuth(username, api_key))
+    response_del = call_with_retries(http_session.delete, url_del, headers=API_headers, auth=HTTPBasicAuth(username, api_key))
     if response_del.status_code == 200:
         logging.info(f"Deleted feedback NOTE event for week {last_week}")
     else:
         logging.error(f"Error deleting feedback NOTE event for week {last_week}: {response_del.status_code}")
 
-def main():
-    df = pd.read_excel(ATP_file_path, sheet_name=ATP_sheet_name)
-    df.fillna(0, inplace=True)
-    df['start_date_local'] = pd.to_datetime(df['start_date_local'], errors='coerce')
-    df = df.dropna(subset=['start_date_local'])
-    df = df[(df['start_date_local'] >= oldest_date) & (df['start_date_local'] <= newest_date)]
-    df['year_week'] = df['start_date_local'].apply(lambda x: f"{x.isocalendar()[0]}-{x.isocalendar()[1]}")
+def sync_feedback_notes(first=None, last=None, weeks=None):
+    """first, last and weeks limit the notes to a range of weeks, see ATP_ledger.sync_range."""
+    sync_oldest, sync_newest = (
+        datetime.strptime(value[:10], "%Y-%m-%d") for value in clip_window(oldest_date_str, newest_date_str, *sync_range(first, last, weeks))
+    )
+    # The feedback of a week is about the week before it
+    history_oldest = max(oldest_date, sync_oldest - timedelta(days=7))
+    # The reads below only need the window: they run in the background while ATP_Data is parsed
+    prefetched_notes = prefetch(get_existing_feedback_notes, athlete_id, username, api_key, sync_oldest, sync_newest, note_name_template_FEEDBACK)
+    if load_source != "model":
+        prefetched_wellness = prefetch(get_wellness_data, athlete_id, username, api_key, history_oldest, sync_newest)
+    prefetched_targets = prefetch(get_target_events, athlete_id, username, api_key, history_oldest, sync_newest + timedelta(days=6))
+    # One activity sync serves the compliance check and, with the warm-up before it, the local model
+    activities_oldest = history_oldest - timedelta(days=WARMUP_DAYS) if load_source == "model" else history_oldest
+    prefetched_activities = prefetch(
+        ActivityStore(ATP_cache_dir, athlete_id).sync,
+        url_activities, activities_oldest, sync_newest + timedelta(days=6), headers=API_headers, auth=HTTPBasicAuth(username, api_key)
+    )
+    with workbook_lock, timer("workbook_load"):
+        df = pd.read_excel(ATP_file_path, sheet_name=ATP_sheet_name)
+    plan = read_week_plan(df).between(oldest_date, newest_date)
+    sheet_loads = plan.load_by_year_week()
+    plan = plan.between(sync_oldest, sync_newest)
     start_week = start_atp_date.isocalendar()[1]
     start_year = start_atp_date.isocalendar()[0]
     today = datetime.today().date()
 
-    # Batch fetch existing feedback NOTE events
-    existing_notes = get_existing_feedback_notes(
-        athlete_id, username, api_key,
-        oldest_date,
-        newest_date,
-        note_name_template_FEEDBACK
-    )
+    existing_notes = prefetched_notes.result()
+
+    # Loads for the whole ATP window are fetched once, not once per week
+    activities = prefetched_activities.result()
+    if load_source == "model":
+        weekly_loads = get_model_weekly_loads(activities, history_oldest, sync_newest)
+    else:
+        weekly_loads = calculate_weekly_loads(prefetched_wellness.result())
+
+    # Per activity type: the TARGET events against the recorded activities, for all weeks at once
+    target_events = prefetched_targets.result()
+    activities = activities[activities["date"] >= pd.Timestamp(history_oldest)]
+    with timer("diff"):
+        weekly_targets = weekly_type_totals(target_events, "load_target")
+        compliance = compliance_table(weekly_targets, weekly_type_totals(activities, targeted=weekly_targets.columns), compliance_treshold)
 
     # Determine desired feedback notes for each week
     desired_notes = {}
-    for index, row in df.iterrows():
-        start_date = row['start_date_local'].date()
+    for atp_week in plan:
+        start_date = atp_week.start.date()
         if start_date > today:
             continue
         start_date_str = start_date.strftime("%Y-%m-%dT00:00:00")
-        week = row['start_date_local'].isocalendar()[1]
-        year = row['start_date_local'].isocalendar()[0]
+        week = atp_week.iso_week
+        year = atp_week.iso_year
         previous_year, previous_week = get_previous_week(year, week)
-        previous_year_week = f"{previous_year}-{previous_week}"
-        previous_week_sheet_load = df[df['year_week'] == previous_year_week]['Total_load_target'].sum()
-        wellness_data = get_wellness_data(athlete_id, username, api_key, oldest_date, newest_date)
-        weekly_loads = calculate_weekly_loads(wellness_data)
+        previous_year_week = year_week(atp_week.start - timedelta(days=7))
+        previous_week_sheet_load = sheet_loads.get(previous_year_week, 0)
         previous_week_loads = weekly_loads.get(previous_year_week, {'ctlLoad': 0, 'atlLoad': 0})
         feedback_note_name = note_name_template_FEEDBACK.format(last_week=previous_week)
         if year == start_year and week == start_week:
             current_description = "- No feedback for the first week of the ATP"
         else:
-            current_description = add_load_check_description(row, previous_week_loads, previous_week_sheet_load, "")
+            current_description = add_load_check_description(previous_week_loads, previous_week_sheet_load, "")
+            current_description = add_compliance_description(compliance, previous_year_week, current_description)
         full_description = populate_description(current_description)
         desired_notes[feedback_note_name] = {
             "start_date": start_date_str,
@@ -263,5 +279,10 @@ def main():
     # We're intentionally NOT deleting obsolete notes and NOT updating existing notes.
     # This script will only add new feedback NOTES when none exist for the week.
 
+def main(argv=None):
+    args = add_range_arguments(stage_argument_parser("Create weekly feedback notes about ATP compliance on intervals.icu.")).parse_args(argv)
+    with profiled(args, "5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES"):
+        sync_feedback_notes(args.first, args.last, args.weeks)
+
 if __name__ == "__main__":
     main()
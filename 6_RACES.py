@@ -20,25 +20,25 @@ def get_race_events(athlete_id: str, username: str, api_key: str, oldest: str, n
     Fetch events for all categories and return a flat list of event dicts.
     Each event will have a 'category' key (taken from API or the requested category).
     """
-    url = f"https://intervals.icu/api/v1/athlete/{athlete_id}/eventsjson"
+    url = f"{url_base}/eventsjson"
     all_events = []
     for cat in API_RACE_CATEGORIES:
-        params = {"oldest": oldest, "newest": newest, "category": cat}
-        logging.info("Requesting %s params=%s", url, params)
-        resp = requests.get(url, headers=API_HEADERS, params=params, auth=HTTPBasicAuth(username, api_key))
-        logging.info("Status %s", resp.status_code)
-        if resp.status_code == 200:
-            try:
-                events = resp.json()
-                for e in events:
-                    # ensure category is present so we can map to short label later
-                    e.setdefault("category", cat)
-                    all_events.append(e)
-                logging.info("Fetched %d events for %s", len(events), cat)
-            except Exception as ex:
-                logging.error("JSON parse error for %s: %s", cat, ex)
+        logging.info("Requesting %s from %s to %s, category=%s", url, oldest, newest, cat)
+        try:
+            # A year is read in quarters side by side; races on a window boundary are returned once
+            events, status = fetch_records(url, oldest, newest, params={"category": cat}, headers=API_HEADERS, auth=HTTPBasicAuth(username, api_key))
+        except ValueError as ex:
+            logging.error("JSON parse error for %s: %s", cat, ex)
+            continue
+        logging.info("Status %s", status)
+        if status == 200:
+            for e in events:
+                # ensure category is present so we can map to short label later
+                e.setdefault("category", cat)
+                all_events.append(e)
+            logging.info("Fetched %d events for %s", len(events), cat)
         else:
-            logging.error("Failed to fetch %s: %s %s", cat, resp.status_code, resp.text[:200])
+            logging.error("Failed to fetch %s: %s", cat, status)
     return all_events
 
 
@@ -57,6 +57,7 @@ def events_to_dataframe(events):
     return df
 
 
+@timer("export")
 def save_all_races_sheet(df: pd.DataFrame, output_file: str, sheet_name: str = "Races"):
     """Write a single combined sheet sorted by racecategory and date, but preserve all other sheets.
     If the sheet already exists, overwrite its contents in-place and clear any leftover rows below.
@@ -242,8 +243,9 @@ def save_all_races_sheet(df: pd.DataFrame, output_file: str, sheet_name: str = "
             pass
 
 
-def main():
-    user_data = read_user_data(ATP_file_path)
+def export_races(exporter=None, excel=True):
+    with workbook_lock, timer("workbook_load"):
+        user_data = read_user_data(ATP_file_path)
     api_key = user_data.get("API_KEY")
     username = user_data.get("USERNAME")
     athlete_id = user_data.get("ATHLETE_ID")
@@ -256,8 +258,22 @@ def main():
         print("No RACE events found.")
         return
 
-    save_all_races_sheet(df, RACE_file_path)
-    print(f"All races (combined) saved to {RACE_file_path}")
+    if exporter is not None:
+        event_columns = ["id", "category", "start_date_local", "end_date_local", "name", "type"]
+        exporter.write({
+            "Races": df.sort_values(by=["racecategory", "date", "racename"]).reset_index(drop=True),
+            "race_events": pd.DataFrame([{c: e.get(c) for c in event_columns} for e in events], columns=event_columns),
+        })
+    if excel:
+        with workbook_lock:
+            save_all_races_sheet(df, RACE_file_path)
+        print(f"All races (combined) saved to {RACE_file_path}")
+
+
+def main(argv=None):
+    args = add_export_arguments(stage_argument_parser("Export the race events from intervals.icu to the Races sheet.")).parse_args(argv)
+    with profiled(args, "6_RACES"):
+        export_races(open_exporter(args, athlete_TLA, ATP_year), excel=not args.no_excel)
 
 
 if __name__ == "__main__":
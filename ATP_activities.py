@@ -0,0 +1,183 @@
+"""
+Actual activities of the athlete, fetched incrementally and cached on disk.
+
+The activities of a date window are fetched from intervals.icu in pages of
+ACTIVITY_PAGE_DAYS days, each page parsed as a stream and reduced to a compact
+columnar table: date, id, type, icu_training_load, moving_time (s) and
+distance (m). The table is kept in ATP_cache_dir (Parquet when pyarrow is
+installed, CSV otherwise) together with the date range it covers. The next run
+only fetches the days outside that range plus the last REFRESH_DAYS before the
+previous fetch, since recent activities are still uploaded or edited.
+
+weekly_type_totals aggregates the table to ISO weeks (ATP_model.year_week)
+per activity type. Given the types that have TARGET events, activity types
+without targets of their own count toward their TARGET_TYPES type, so a
+VirtualRide is done for a Ride target.
+"""
+import importlib.util
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from ATP_api import call_with_retries, http_session, stream_records
+from ATP_ledger import date_ranges
+from ATP_metrics import metrics
+from ATP_model import year_weeks
+
+ACTIVITY_FIELDS = {"id": None, "start_date_local": None, "type": None, "icu_training_load": 0, "moving_time": 0, "distance": 0}
+ACTIVITY_COLUMNS = ["date", "id", "type", "icu_training_load", "moving_time", "distance"]
+ACTIVITY_PAGE_DAYS = 90
+REFRESH_DAYS = 7
+PARQUET = importlib.util.find_spec("pyarrow") is not None
+DAY = "%Y-%m-%d"
+# Activity types that count toward the TARGET of another type, unless they have targets of their own
+TARGET_TYPES = {
+    "VirtualRide": "Ride", "GravelRide": "Ride", "MountainBikeRide": "Ride", "EBikeRide": "Ride",
+    "EMountainBikeRide": "Ride", "TrackRide": "Ride", "Velomobile": "Ride", "Handcycle": "Ride",
+    "TrailRun": "Run", "VirtualRun": "Run", "OpenWaterSwim": "Swim", "VirtualRow": "Rowing",
+}
+_sync_lock = threading.Lock()  # Stages running side by side (ATP_pipeline) share the cache files
+
+
+def activity_table(records):
+    """Compact table of activity records (as streamed with ACTIVITY_FIELDS)."""
+    df = pd.DataFrame.from_records(records, columns=list(ACTIVITY_FIELDS))
+    df["date"] = pd.to_datetime(df["start_date_local"].astype(str).str[:10], errors="coerce")
+    df = df.dropna(subset=["date"])
+    for column in ("icu_training_load", "moving_time", "distance"):
+        df[column] = pd.to_numeric(df[column], errors="coerce").fillna(0)
+    df["type"] = df["type"].fillna("Unknown").astype(str)
+    df["id"] = df["id"].astype(str)
+    return df[ACTIVITY_COLUMNS].reset_index(drop=True)
+
+
+def pages(first_day, last_day, page_days=ACTIVITY_PAGE_DAYS):
+    """Split a (first_day, last_day) range of YYYY-MM-DD strings into pages of at most page_days days."""
+    start, end = datetime.strptime(first_day[:10], DAY), datetime.strptime(last_day[:10], DAY)
+    while start <= end:
+        page_end = min(start + timedelta(days=page_days - 1), end)
+        yield start.strftime(DAY), page_end.strftime(DAY)
+        start = page_end + timedelta(days=1)
+
+
+def target_type(activity_type, targeted):
+    """The type an activity counts toward: its own when it is in targeted, else its TARGET_TYPES type."""
+    if activity_type in targeted:
+        return activity_type
+    return TARGET_TYPES.get(activity_type, activity_type)
+
+
+def weekly_type_totals(table, column="icu_training_load", targeted=None):
+    """Sum of column per ISO week ("YYYY-WW") and type, as a week x type DataFrame.
+
+    With targeted (the types that have TARGET events) the types are mapped with target_type first.
+    """
+    if table.empty:
+        return pd.DataFrame(dtype=float)
+    types = table["type"]
+    if targeted is not None:
+        targeted = set(targeted)
+        types = types.map(lambda activity_type: target_type(activity_type, targeted))
+    return table.groupby([year_weeks(table["date"]), types])[column].sum().unstack(fill_value=0)
+
+
+class ActivityStore:
+    def __init__(self, cache_dir, athlete_id):
+        base = os.path.join(cache_dir, f"activities_{athlete_id}")
+        self.path = f"{base}.parquet" if PARQUET else f"{base}.csv"
+        self.meta_path = f"{base}.json"
+        self.load()
+
+    def load(self):
+        self.table = pd.DataFrame(columns=ACTIVITY_COLUMNS)
+        self.meta = {}
+        if os.path.exists(self.path) and os.path.exists(self.meta_path):
+            try:
+                with open(self.meta_path, encoding="utf-8") as f:
+                    self.meta = json.load(f)
+                if PARQUET:
+                    self.table = pd.read_parquet(self.path)
+                else:
+                    self.table = pd.read_csv(self.path, parse_dates=["date"], dtype={"id": str, "type": str})
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable activity cache {self.path}: {e}")
+                self.table, self.meta = pd.DataFrame(columns=ACTIVITY_COLUMNS), {}
+
+    def stale_ranges(self, oldest, newest, today=None):
+        """Date ranges of the window that have to be (re)fetched."""
+        oldest, newest = oldest[:10], newest[:10]
+        covered_oldest, covered_newest = self.meta.get("oldest"), self.meta.get("newest")
+        if not covered_oldest:
+            return [(oldest, newest)]
+        spans = []
+        if oldest < covered_oldest:
+            spans.append((oldest, (datetime.strptime(covered_oldest, DAY) - timedelta(days=1)).strftime(DAY)))
+        if newest > covered_newest:
+            spans.append(((datetime.strptime(covered_newest, DAY) + timedelta(days=1)).strftime(DAY), newest))
+        fetched = datetime.strptime(self.meta.get("fetched", covered_newest), DAY)
+        refresh_from = max(oldest, (fetched - timedelta(days=REFRESH_DAYS)).strftime(DAY))
+        refresh_to = min(newest, covered_newest, (today or datetime.now()).strftime(DAY))
+        if refresh_from <= refresh_to:
+            spans.append((refresh_from, refresh_to))
+        return date_ranges(spans)
+
+    def fetch(self, url, first_day, last_day, **request_kwargs):
+        """Stream the activities of a date range page by page; None when a page can't be fetched."""
+        tables = []
+        for page_oldest, page_newest in pages(first_day, last_day):
+            params = {"oldest": page_oldest, "newest": page_newest}
+            response = call_with_retries(http_session.get, url, params=params, stream=True, **request_kwargs)
+            if response.status_code != 200:
+                logging.error(f"Error fetching activities {page_oldest} to {page_newest}: {response.status_code}")
+                return None
+            tables.append(activity_table(stream_records(response, fields=ACTIVITY_FIELDS)))
+            metrics.count("activity_pages")
+        return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=ACTIVITY_COLUMNS)
+
+    def sync(self, url, oldest, newest, **request_kwargs):
+        """Activities between oldest and newest (YYYY-MM-DD...), fetching only what the cache lacks."""
+        with _sync_lock:
+            self.load()  # Another stage may have updated the cache since
+            return self._sync(url, str(oldest)[:10], str(newest)[:10], **request_kwargs)
+
+    def _sync(self, url, oldest, newest, **request_kwargs):
+        ranges = self.stale_ranges(oldest, newest)
+        fetched = []
+        for first_day, last_day in ranges:
+            table = self.fetch(url, first_day, last_day, **request_kwargs)
+            if table is None:
+                logging.warning("Using the cached activities only.")
+                fetched = None
+                break
+            fetched.append((first_day, last_day, table))
+        if fetched:
+            keep = pd.Series(True, index=self.table.index)
+            for first_day, last_day, _ in fetched:
+                keep &= ~self.table["date"].between(pd.Timestamp(first_day), pd.Timestamp(last_day))
+            kept = [self.table[keep]] if keep.any() else []
+            self.table = pd.concat(kept + [table for _, _, table in fetched], ignore_index=True)
+            self.table = self.table.drop_duplicates("id", keep="last").sort_values("date").reset_index(drop=True)
+            self.meta = {
+                "oldest": min(oldest, self.meta.get("oldest", oldest)),
+                "newest": max(newest, self.meta.get("newest", newest)),
+                "fetched": datetime.now().strftime(DAY),
+            }
+            self.save()
+        logging.info(f"Activities {oldest} to {newest}: fetched {len(ranges) if fetched else 0} range(s), {len(self.table)} cached")
+        return self.table[self.table["date"].between(pd.Timestamp(oldest), pd.Timestamp(newest))]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        if PARQUET:
+            self.table.to_parquet(tmp_path, index=False)
+        else:
+            self.table.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, self.path)
+        with open(f"{self.meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(f"{self.meta_path}.tmp", self.meta_path)
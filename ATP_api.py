@@ -0,0 +1,400 @@
+"""
+Shared intervals.icu request helpers for the ATP scripts.
+
+Every API call goes through call_with_retries, which retries throttled and
+failing calls with exponential backoff and reports calls, retries, sleeps and
+bytes to ATP_metrics. A Retry-After of the server pauses the calls of all
+threads for that long. Broken connections and timeouts are retried for GET,
+PUT and DELETE only: a create may have been applied before the connection
+broke, so sending it again could duplicate the event. It is returned as a
+failed call instead (status_code None), which the stage logs and its sync
+ledger checks on the next run. Calls are spaced at least RATE_LIMIT_DELAY apart by one
+rate limiter shared by all threads of the process, so stages that run side by
+side (ATP_pipeline) stay within the same rate as a single stage. Reads are
+timed as the "fetch" phase and creates, updates and deletes as the "write"
+phase, backoff and rate-limit sleeps included.
+
+How many calls are in flight at once is decided by concurrency_limiter (AIMD):
+the limit grows by one for every limit successful responses and is halved on
+a 429 or 5xx, a failed connection, or a response much slower than the
+baseline latency of the server. run_concurrently spreads a batch of calls over
+threads, so bulk syncs run at what the server can take. The current limit and
+the p50/p90/p99 latency are reported as gauges.
+
+Reads go through read_cache (ATP_http_cache) once a script has opened it:
+conditional GETs against cached responses, and one request for identical
+reads in flight at the same time. Successful writes drop the cached reads of
+the athlete.
+
+prefetch starts a read on a small background pool and returns its Future, so
+a script can fetch from intervals.icu while it is still parsing the workbook.
+
+Large list responses (eventsjson, wellness) can be read with stream_records
+instead of response.json(): records are decoded one at a time while the body
+downloads, filtered, and cut down to the fields the stage needs, so the full
+payload never sits in memory as Python objects. fetch_records does the same
+for a long date range in windows of FETCH_WINDOW_MONTHS calendar months,
+fetched side by side, and returns every record once even when a multi-day
+event is listed by more than one window.
+"""
+import codecs
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+
+from ATP_http_cache import ReadCache
+from ATP_metrics import metrics
+from ATP_profiling import in_worker
+
+# --- API Rate Limiting and Retry Logic ---
+MAX_RETRIES = 4
+INITIAL_BACKOFF = 0.5  # seconds
+MAX_BACKOFF = 8.0      # seconds
+RATE_LIMIT_DELAY = 0.05  # seconds between call starts; the concurrency limit adapts to the server on top of this
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")  # Safe to send again when the connection failed
+MAX_RETRY_AFTER = 60.0  # seconds; longer Retry-After answers are capped
+REQUEST_TIMEOUT = (10, 60)  # seconds to connect, seconds between bytes of the answer
+INITIAL_CONCURRENCY = 2
+MAX_CONCURRENCY = 16
+DECREASE_FACTOR = 0.5
+LATENCY_TOLERANCE = 2.0  # Responses slower than this times the baseline count as congestion
+LATENCY_WINDOW = 200  # Responses kept for the latency percentiles
+PREFETCH_WORKERS = 4
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes
+FETCH_WINDOW_MONTHS = 3  # Calendar months per request of fetch_records (ATP_FETCH_WINDOW_MONTHS in ATP_common_config)
+
+# One keep-alive session per process, so consecutive calls reuse the connection
+http_session = requests.Session()
+read_cache = ReadCache()
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    return len(body) if isinstance(body, (bytes, bytearray)) else len(str(body).encode("utf-8"))
+
+
+def _record(method, response, seconds, stream=False):
+    request = getattr(response, "request", None)
+    bytes_sent = _body_size(getattr(request, "body", None))
+    # A streamed body is counted by iter_json_array while it is read
+    bytes_received = 0 if stream and response.status_code == 200 else len(response.content or b"")
+    metrics.record_http(method, response.status_code, bytes_sent, bytes_received, seconds)
+
+
+def _sleep(seconds, reason):
+    metrics.count(f"sleep_seconds_{reason}", seconds)
+    time.sleep(seconds)
+
+
+class RateLimiter:
+    """Spaces the starts of API calls at least interval seconds apart, over all threads."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next_call - now)
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay:
+            _sleep(delay, "rate_limit")
+
+    def hold(self, seconds):
+        """No call of any thread starts within the next seconds (a Retry-After of the server)."""
+        with self.lock:
+            self.next_call = max(self.next_call, time.monotonic() + seconds)
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_DELAY)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+class ConcurrencyLimiter:
+    """Additive increase, multiplicative decrease limit on the API calls in flight, over all threads."""
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.baseline = None
+        self.recent = None
+        self.last_decrease = 0.0
+
+    def acquire(self):
+        """Wait for a free slot; returns the start time to pass to release."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, status):
+        """Free the slot of a call and adjust the limit to its outcome (status None: no response)."""
+        seconds = time.monotonic() - started
+        with self.condition:
+            self.in_flight -= 1
+            overloaded = status is None or status in RETRYABLE_STATUS
+            if not overloaded:
+                self.latencies.append(seconds)
+                # Slowly following baseline: drops at once to a faster response, rises 5% of the way to a slower one.
+                # Congestion is the recent (smoothed) latency rising well above it, not a single slow response.
+                self.baseline = seconds if self.baseline is None else min(seconds, self.baseline + 0.05 * (seconds - self.baseline))
+                self.recent = seconds if self.recent is None else self.recent + 0.2 * (seconds - self.recent)
+                overloaded = len(self.latencies) >= 10 and self.recent > LATENCY_TOLERANCE * self.baseline
+            if overloaded:
+                # Calls started before the last decrease saw the old limit; count one congestion event once
+                if started > self.last_decrease:
+                    self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+                    self.last_decrease = time.monotonic()
+                    metrics.count("concurrency_decreases")
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+            limit, latencies = self.limit, list(self.latencies)
+        metrics.gauge("api_concurrency_limit", round(limit, 2))
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            metrics.gauge(f"api_latency_{name}_ms", round(percentile(latencies, fraction) * 1000, 1))
+
+
+concurrency_limiter = ConcurrencyLimiter()
+
+
+prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+
+def prefetch(function, *args, **kwargs):
+    """Start function(*args, **kwargs) in the background; .result() of the returned Future waits for it."""
+    metrics.count("prefetches")
+    return prefetch_pool.submit(in_worker(function), *args, **kwargs)
+
+
+def run_concurrently(function, items, max_workers=MAX_CONCURRENCY):
+    """function(item) for every item, on a thread pool; concurrency_limiter decides how many calls are in flight."""
+    items = list(items)
+    if len(items) <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix="api") as executor:
+        return list(executor.map(in_worker(function), items))
+
+
+def call_with_retries(request_func, *args, **kwargs):
+    """Call an API function with retries and exponential backoff."""
+    method = getattr(request_func, "__name__", "request").upper()
+    with metrics.timer("fetch" if method == "GET" else "write"):
+        if method == "GET" and read_cache.enabled:
+            return read_cache.get(args[0], kwargs, lambda headers: _call_with_retries(method, request_func, *args, **dict(kwargs, headers=headers)))
+        response = _call_with_retries(method, request_func, *args, **kwargs)
+        if method != "GET" and response.status_code in (200, 201, 204):
+            read_cache.invalidate(args[0])
+        return response
+
+
+def retry_after(response):
+    """Seconds the server asked to wait in its Retry-After header (capped at MAX_RETRY_AFTER), or None."""
+    value = (getattr(response, "headers", None) or {}).get("Retry-After", "")
+    try:
+        return min(MAX_RETRY_AFTER, max(0.0, float(value)))
+    except ValueError:
+        return None  # Absent, or an HTTP date, which intervals.icu doesn't send
+
+
+def unanswered(url, error):
+    """Stand-in response for a call whose answer never came; its status_code is None."""
+    response = requests.Response()
+    response.status_code = None
+    response._content = b""
+    response.reason = f"{type(error).__name__}: {error}"
+    response.url = url
+    return response
+
+
+def _call_with_retries(method, request_func, *args, **kwargs):
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    delay = INITIAL_BACKOFF
+    for attempt in range(MAX_RETRIES):
+        rate_limiter.wait()
+        slot = concurrency_limiter.acquire()
+        started = time.perf_counter()
+        response = None
+        try:
+            response = request_func(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if method not in IDEMPOTENT_METHODS:
+                # The create may have been applied before the connection broke: sending it again could duplicate it
+                logging.error(f"API call got no answer ({type(e).__name__}); not repeated, as it may have been applied.")
+                metrics.count("http_unanswered_writes")
+                return unanswered(args[0], e)
+            if attempt == MAX_RETRIES - 1:
+                raise
+            logging.warning(f"API call failed ({type(e).__name__}), retry #{attempt + 1} after {delay}s.")
+            metrics.count("http_retries")
+            metrics.count("http_connection_errors")
+            _sleep(delay + random.uniform(0, 0.25), "backoff")
+            delay = min(MAX_BACKOFF, delay * 2)
+            continue
+        finally:
+            concurrency_limiter.release(slot, getattr(response, "status_code", None))
+        _record(method, response, time.perf_counter() - started, kwargs.get("stream", False))
+        if response.status_code in (200, 201, 204, 304):  # 304: answer to a conditional GET of read_cache
+            return response
+        elif response.status_code in RETRYABLE_STATUS:  # Retryable errors
+            wait = delay
+            server_wait = retry_after(response)
+            if server_wait is not None:
+                rate_limiter.hold(server_wait)  # Every thread waits, not only this one
+                wait = max(delay, server_wait)
+            logging.warning(f"API call failed with {response.status_code}, retry #{attempt + 1} after {wait}s.")
+            metrics.count("http_retries")
+            _sleep(wait + random.uniform(0, 0.25), "backoff")
+            delay = min(MAX_BACKOFF, delay * 2)
+        else:
+            logging.error(f"API call failed with {response.status_code}: {getattr(response, 'text', '')}")
+            break
+    return response  # Return last response for error handling
+
+
+def iter_json_array(response, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the items of a JSON array response one by one while the body downloads."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+    chunks = response.iter_content(chunk_size=chunk_size)
+    buffer, pos, started, finished = "", 0, False, False
+    try:
+        while True:
+            # Skip whitespace and separators up to the next item
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer):
+                if not started:
+                    if buffer[pos] != "[":
+                        raise ValueError(f"Expected a JSON array, got {buffer[pos:pos + 20]!r}")
+                    started, pos = True, pos + 1
+                    continue
+                if buffer[pos] == "]":
+                    for _ in chunks:  # Normally nothing is left; reading to the end completes the copy of ATP_http_cache
+                        pass
+                    return
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if finished:
+                        raise
+                    end = None
+                # Only trust an item once a delimiter follows it: "12" may still become "12.5"
+                if end is not None and (finished or (end < len(buffer) and buffer[end] in " \t\r\n,]")):
+                    pos = end
+                    yield item
+                    continue
+            elif finished:
+                raise ValueError("JSON array ended before its closing bracket")
+            chunk = next(chunks, None)
+            if chunk is None:
+                finished = True
+                buffer = buffer[pos:] + text.decode(b"", final=True)
+            else:
+                if not getattr(response, "from_cache", False):
+                    metrics.count("http_bytes_received", len(chunk))
+                buffer = buffer[pos:] + text.decode(chunk)
+            pos = 0
+    finally:
+        response.close()
+
+
+def stream_records(response, fields=None, keep=None):
+    """Stream the records of a list response, keeping only those that pass keep and only the given fields.
+
+    fields maps each field to keep to its default, like record.get(field, default).
+    """
+    for record in iter_json_array(response):
+        if keep is not None and not keep(record):
+            continue
+        yield {field: record.get(field, default) for field, default in fields.items()} if fields else record
+
+
+def in_date_window(key, oldest_date, newest_date):
+    """Record filter for a YYYY-MM-DD window (both ends included) on the date part of record[key]."""
+    oldest_day, newest_day = str(oldest_date)[:10], str(newest_date)[:10]
+    return lambda record: oldest_day <= str(record.get(key) or "")[:10] <= newest_day
+
+
+def name_starts_with(prefix):
+    """Record filter on the event name prefix."""
+    return lambda record: (record.get("name") or "").startswith(prefix)
+
+
+def date_windows(oldest, newest, months=None):
+    """Split a YYYY-MM-DD[Thh:mm:ss] range into (oldest, newest) windows of whole blocks of calendar months.
+
+    The first window starts at oldest and the last one ends at newest; in between, windows run from
+    00:00:00 of their first day to 23:59:59 of their last (plain days when the range has no times).
+    A range no longer than one window stays a single window, wherever it falls.
+    """
+    months = months or FETCH_WINDOW_MONTHS
+    first_day, last_day = date.fromisoformat(oldest[:10]), date.fromisoformat(newest[:10])
+    if (last_day - first_day).days < months * 28:
+        return [(oldest, newest)] if first_day <= last_day else []
+    start_time, end_time = ("T00:00:00" if len(oldest) > 10 else ""), ("T23:59:59" if len(newest) > 10 else "")
+    windows, start = [], first_day
+    while start <= last_day:
+        boundary = ((start.year * 12 + start.month - 1) // months + 1) * months
+        end = min(date(boundary // 12, boundary % 12 + 1, 1) - timedelta(days=1), last_day)
+        windows.append((start.isoformat() + start_time, end.isoformat() + end_time))
+        start = end + timedelta(days=1)
+    if windows:
+        windows[0] = (oldest, windows[0][1])
+        windows[-1] = (windows[-1][0], newest)
+    return windows
+
+
+def fetch_records(url, oldest, newest, params=None, fields=None, keep=None, key="id", months=None, convert=None, **request_kwargs):
+    """Records of a list endpoint from oldest to newest, read per date window (date_windows) side by side.
+
+    fields and keep work as in stream_records; key is the field that identifies a record, for the
+    events listed by two windows. convert turns every record into what is returned, as soon as it
+    is parsed (e.g. ATP_events.EventRecord.from_json). Returns (records in date order, 200), or
+    ([], status) of the first window that failed.
+    """
+    def fetch_window(window):
+        window_params = dict(params or {}, oldest=window[0], newest=window[1])
+        response = call_with_retries(http_session.get, url, params=window_params, stream=True, **request_kwargs)
+        if response.status_code != 200:
+            response.close()
+            return response.status_code, []
+        kept = (
+            (record.get(key), {field: record.get(field, default) for field, default in fields.items()} if fields else record)
+            for record in iter_json_array(response)
+            if keep is None or keep(record)
+        )
+        return 200, [(record_key, convert(record) if convert else record) for record_key, record in kept]
+
+    windows = date_windows(oldest, newest, months)
+    metrics.count("fetch_windows", len(windows))
+    seen, records = set(), []
+    for status, window_records in run_concurrently(fetch_window, windows):
+        if status != 200:
+            return [], status
+        for record_key, record in window_records:
+            if record_key is not None:
+                if record_key in seen:
+                    continue
+                seen.add(record_key)
+            records.append(record)
+    return records, 200
@@ -0,0 +1,69 @@
+"""
+Athlete profile cache for the ATP scripts.
+
+The scripts that personalise notes only need a few fields of the athlete's
+intervals.icu profile (the name, mostly), which hardly ever change. The
+profile is kept per athlete in ATP_cache_dir and only fetched again when it is
+older than the TTL (ATP_PROFILE_TTL seconds, default one day). When the
+profile can't be fetched, the last cached copy is used whatever its age, so
+notes keep their greeting when intervals.icu is slow or unreachable.
+"""
+import json
+import logging
+import os
+import time
+
+import requests
+
+from ATP_metrics import metrics
+
+PROFILE_TTL = 24 * 3600  # seconds
+PROFILE_FIELDS = ("id", "name", "firstname", "lastname", "timezone", "locale")
+
+
+class ProfileCache:
+    def __init__(self, cache_dir, athlete_id, ttl=PROFILE_TTL):
+        self.path = os.path.join(cache_dir, f"profile_{athlete_id}.json")
+        self.ttl = ttl
+        self.entry = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self.entry = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable profile cache {self.path}: {e}")
+
+    def fresh(self):
+        return self.entry is not None and time.time() - self.entry.get("fetched", 0) < self.ttl
+
+    def get(self, fetch):
+        """The cached athlete fields while fresh, else fetch() them; None when there is neither."""
+        if self.fresh():
+            metrics.count("profile_cache_hits")
+            return self.entry["athlete"]
+        try:
+            profile = fetch()
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Could not fetch the athlete profile: {e}")
+            profile = None
+        if profile is not None:
+            athlete = {field: profile.get("athlete", {}).get(field) for field in PROFILE_FIELDS}
+            self.entry = {"fetched": time.time(), "athlete": athlete}
+            self.save()
+            return athlete
+        if self.entry is not None:
+            logging.warning(f"Using the cached athlete profile from {time.strftime('%Y-%m-%d %H:%M', time.localtime(self.entry.get('fetched', 0)))}.")
+            return self.entry["athlete"]
+        return None
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entry, f)
+        os.replace(tmp_path, self.path)
+
+
+def first_name(athlete, default="Athlete"):
+    full_name = (athlete or {}).get("name") or ""
+    return full_name.split()[0] if full_name.strip() else default
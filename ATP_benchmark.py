@@ -0,0 +1,190 @@
+"""
+End-to-end benchmark of the ATP scripts against the local intervals.icu stand-in.
+
+For every requested season count a synthetic workbook is written with
+ATP_workbook_generator, a fresh ATP_mock_server is started and each stage
+(1-6 and NOTE_REMOVER) is run as its own process, exactly as a coach would
+run it. Per stage the wall time, exit code, API calls and bytes transferred
+are recorded, together with the phase timers and retry/sleep counters the
+stage exports through ATP_metrics, and appended as one JSON object per line
+to the results file so runs can be tracked over time.
+
+Example:
+    python ATP_benchmark.py --seasons 1 3 10 --latency 0.02 --output bench_results.jsonl
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from ATP_mock_server import MockIntervalsServer
+from ATP_workbook_generator import generate_roster
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = {
+    "1_ATP_LOAD": ["1_ATP_LOAD.py"],
+    "2_ATP_NOTES": ["2_ATP_NOTES.py"],
+    "3_ATP_PERIOD_NOTE": ["3_ATP_PERIOD_NOTE.py"],
+    "4_LOAD_CHECK": ["4_LOAD_CHECK.py"],
+    "5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES": ["5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES.py"],
+    "6_RACES": ["6_RACES.py"],
+    "NOTE_REMOVER": ["NOTE_REMOVER.py", "--year", "{year}", "--rip_word", "Weekly"],
+}
+
+
+def benchmark_start_date(seasons):
+    """Monday roughly half the plan before today, so stages see both past and future weeks."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = today - timedelta(weeks=26 * seasons)
+    return start - timedelta(days=start.weekday())
+
+
+def seed_mock_state(state, athlete_id, rows, history_years=0, seed=0):
+    """Give the stand-in the history a real athlete would have: wellness, workouts and races."""
+    rng = random.Random(seed)
+    state.set_profile(athlete_id, "Bench Athlete")
+    first = rows[0]["start_date_local"] - timedelta(days=365 * history_years)
+    last = rows[-1]["start_date_local"] + timedelta(days=6)
+    wellness = []
+    activities = []
+    ctl = atl = 0.0
+    day = first
+    while day <= last:
+        load = rng.randrange(0, 150)
+        # Same recursion as intervals.icu, so ATP_fitness can be validated against the stand-in
+        ctl += (load - ctl) * (1 - math.exp(-1 / 42))
+        atl += (load - atl) * (1 - math.exp(-1 / 7))
+        if load:
+            activities.append({
+                "id": f"i{len(activities) + 1}", "type": "Ride", "name": "Ride",
+                "start_date_local": day.strftime("%Y-%m-%dT07:00:00"), "icu_training_load": load,
+                "moving_time": load * 50, "distance": load * 400.0,
+            })
+        wellness.append({
+            "id": day.strftime("%Y-%m-%d"), "ctlLoad": load, "atlLoad": load, "ctl": ctl, "atl": atl,
+            "restingHR": rng.randrange(40, 60), "hrv": rng.uniform(40, 90), "weight": 70.0, "sleepSecs": 28800,
+            "comments": None, "sportInfo": [{"type": "Ride", "eftp": 250, "wPrime": 20000}],
+        })
+        day += timedelta(days=1)
+    state.add_wellness(athlete_id, wellness)
+    state.add_activities(athlete_id, activities)
+    for row in rows:
+        for offset, sport in ((1, "Run"), (3, "Ride"), (5, "Swim")):
+            state.add_event(athlete_id, {
+                "category": "WORKOUT",
+                "type": sport,
+                "name": f"{sport} session",
+                "start_date_local": (row["start_date_local"] + timedelta(days=offset)).strftime("%Y-%m-%dT00:00:00"),
+                "icu_training_load": rng.randrange(20, 120),
+            })
+        if row["race"] != "-":
+            state.add_event(athlete_id, {
+                "category": f"RACE_{row['cat']}",
+                "type": "Ride",
+                "name": row["race"],
+                "start_date_local": row["race_date"].strftime("%Y-%m-%dT00:00:00"),
+                "end_date_local": row["race_date"].strftime("%Y-%m-%dT00:00:00"),
+            })
+
+
+def run_stage(stage, athlete, server, timeout, workdir, cache_dir):
+    year = athlete["year"]
+    command = [sys.executable] + [arg.format(year=year) for arg in STAGES[stage]]
+    metrics_file = os.path.join(workdir, f"metrics_{athlete['tla']}_{stage}.json")
+    env = dict(os.environ, ATP_FILE_PATH=athlete["path"], ATP_API_URL=server.url, ATP_ATHLETE_TLA=athlete["tla"], ATP_YEAR=str(year),
+               ATP_METRICS_JSON=metrics_file, ATP_CACHE_DIR=cache_dir)
+    server.state.reset_stats()
+    started = time.perf_counter()
+    try:
+        proc = subprocess.run(command, cwd=REPO_DIR, env=env, input="yes\n", capture_output=True, text=True, timeout=timeout)
+        returncode, stderr = proc.returncode, proc.stderr
+    except subprocess.TimeoutExpired:
+        returncode, stderr = None, f"timeout after {timeout}s"
+    wall_time = time.perf_counter() - started
+    result = {"wall_time_s": round(wall_time, 3), "returncode": returncode}
+    result.update(server.state.stats())
+    if os.path.exists(metrics_file):
+        # Phase timers, retries and sleeps as seen from inside the stage
+        with open(metrics_file, encoding="utf-8") as f:
+            stage_metrics = json.load(f)
+        os.remove(metrics_file)
+        result["phases"] = stage_metrics["timers"]
+        result["client_counters"] = stage_metrics["counters"]
+        result["client_gauges"] = stage_metrics["gauges"]
+    if returncode != 0:
+        result["error"] = (stderr or "").strip().splitlines()[-1:] or [""]
+        result["error"] = result["error"][0][:300]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ATP scripts end to end against a local intervals.icu stand-in.")
+    parser.add_argument("--seasons", type=int, nargs="+", default=[1, 3, 10], help="Season counts to benchmark.")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES), help="Stages to run, in order.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency added by the stand-in per request.")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Requests per window before the stand-in answers 429.")
+    parser.add_argument("--rate-window", type=float, default=1.0, help="Rate limit window in seconds.")
+    parser.add_argument("--activity-types", type=int, default=3, help="Activity types in the synthetic workbooks.")
+    parser.add_argument("--race-density", type=int, default=3, help="Races per season in the synthetic workbooks.")
+    parser.add_argument("--history-years", type=int, default=2, help="Years of wellness history before the ATP on the stand-in.")
+    parser.add_argument("--timeout", type=float, default=3600, help="Per stage timeout in seconds.")
+    parser.add_argument("--output", default="bench_results.jsonl", help="JSON lines file the results are appended to.")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic workbooks (default: temp dir).")
+    args = parser.parse_args()
+
+    run_id = datetime.now().strftime("%Y%m%dT%H%M%S")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="atp_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for seasons in args.seasons:
+        athlete = generate_roster(
+            os.path.join(workdir, f"{seasons}_seasons"), athletes=1, seasons=seasons,
+            activity_types=args.activity_types, race_density=args.race_density,
+            start_date=benchmark_start_date(seasons),
+        )[0]
+        rows = athlete["rows"]
+        server = MockIntervalsServer(latency=args.latency, rate_limit=args.rate_limit, rate_window=args.rate_window).start()
+        seed_mock_state(server.state, athlete["athlete_id"], rows, args.history_years)
+        cache_dir = tempfile.mkdtemp(prefix="cache_", dir=workdir)  # A fresh stand-in needs fresh sync ledgers
+        try:
+            for stage in args.stages:
+                logging.info(f"Running {stage} on {seasons} season(s)")
+                result = {
+                    "run_id": run_id,
+                    "stage": stage,
+                    "seasons": seasons,
+                    "weeks": len(rows),
+                    "activity_types": args.activity_types,
+                    "race_density": args.race_density,
+                    "history_years": args.history_years,
+                    "latency_s": args.latency,
+                    "rate_limit": args.rate_limit,
+                }
+                result.update(run_stage(stage, athlete, server, args.timeout, workdir, cache_dir))
+                results.append(result)
+                logging.info(f"{stage}: {result['wall_time_s']}s, {result['api_calls']} calls, rc={result['returncode']}")
+        finally:
+            server.stop()
+
+    with open(args.output, "a", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+    print(f"{'stage':<36}{'seasons':>8}{'wall(s)':>10}{'calls':>8}{'sent':>10}{'recv':>12}{'rc':>5}")
+    for r in results:
+        print(f"{r['stage']:<36}{r['seasons']:>8}{r['wall_time_s']:>10}{r['api_calls']:>8}{r['bytes_sent']:>10}{r['bytes_received']:>12}{str(r['returncode']):>5}")
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
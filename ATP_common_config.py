@@ -9,22 +9,43 @@ import time
 import random
 from functools import wraps
 import os
+import argparse
+import threading
+from ATP_metrics import metrics, timer
+from ATP_profiling import profiled, start_profile, in_worker
+import sys
+if "--profile" in sys.argv[1:]:
+    start_profile()  # Before the reads below that run when a stage is imported
+from ATP_ledger import Ledger, fingerprint, date_ranges, week_end, add_ledger_arguments, add_range_arguments, sync_range, clip_window, keys_between
+from ATP_fitness import WARMUP_DAYS, daily_load_series, fitness_frame, weekly_loads_from_model
+from ATP_activities import ActivityStore, activity_table, weekly_type_totals
+from ATP_athlete_profile import ProfileCache, first_name, PROFILE_TTL
+from ATP_export import add_export_arguments, open_exporter
+from ATP_compliance import target_table, compliance_table, compliance_lines
+from ATP_model import read_week_plan, year_week
+from ATP_events import EventIndex, EventRecord
+from ATP_templates import TEMPLATE_SHEET, load_note_templates, render_week_notes, week_note_columns
+from ATP_http_cache import HTTP_CACHE_TTL
+import ATP_api
+from ATP_api import call_with_retries, run_concurrently, prefetch, fetch_records, http_session, read_cache, stream_records, in_date_window, name_starts_with, MAX_RETRIES, INITIAL_BACKOFF, MAX_BACKOFF, RATE_LIMIT_DELAY
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Configuration ---
-athlete_TLA = "TLA"  # Three letter Acronym of athlete.
-ATP_year = "YYYY"    # Year of the ATP
+athlete_TLA = os.environ.get("ATP_ATHLETE_TLA", "TLA")  # Three letter Acronym of athlete.
+ATP_year = os.environ.get("ATP_YEAR", "YYYY")    # Year of the ATP
 parse_delay = .00
 coach_name = "CozyCoach"
 
 ATP_sheet_name = "ATP_Data"
 ATP_sheet_Conditions = "ATP_Conditions"
-ATP_file_path = rf"C:\TEMP\{athlete_TLA}\ATP2intervals_{athlete_TLA}_{ATP_year}.xlsm"
+ATP_file_path = os.environ.get("ATP_FILE_PATH", rf"C:\TEMP\{athlete_TLA}\ATP2intervals_{athlete_TLA}_{ATP_year}.xlsm")
 ATP_loadcheck_sheet_name = "WTL"  # "Weekly Type Loads"
 ATP_loadcheck_compare_sheet_name = "WLC"  # "Weekly Load Compare"
 ATP_loadcheck_file_path = ATP_file_path   # Now writing directly to the macro file!
+RACE_file_path = ATP_file_path  # Races sheet lives in the same macro file
+ATP_cache_dir = os.environ.get("ATP_CACHE_DIR", os.path.join(os.path.dirname(ATP_file_path), ".atp_cache"))  # Sync ledgers
 
 compliance_treshold = 0.3
 note_underline_ATP = f"\n---\n *made with the {os.path.basename(__file__)} script / From coach {coach_name}*"
@@ -34,14 +55,27 @@ note_name_prefix_ATP = "Weekly training and focus summary of your ATP"
 note_name_PERIOD = 'Period:'
 note_name_template_FEEDBACK = "Weekly feedback about your trainingload in week {last_week}"
 
+metrics.labels["athlete"] = athlete_TLA
+
 change_whole_range = True  # Control whether to change the whole range or only upcoming targets
 
+# ATP_pipeline runs stages side by side in threads: one of them reads or writes the workbook at a time
+workbook_lock = threading.RLock()
+
+def stage_argument_parser(description):
+    """Command line options shared by the numbered scripts."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--profile", action="store_true", help="Save a cProfile profile, peak memory and top allocation sites of this run.")
+    parser.add_argument("--profile-dir", default=os.path.join(os.path.dirname(ATP_file_path), "profiles"), help="Directory for the profile files (default: next to the ATP workbook).")
+    return parser
+
 def read_user_data(ATP_file_path, sheet_name="User_Data"):
     df = pd.read_excel(ATP_file_path, sheet_name=sheet_name)
     user_data = df.set_index('Key').to_dict()['Value']
     return user_data
 
-user_data = read_user_data(ATP_file_path)
+with timer("workbook_load"):
+    user_data = read_user_data(ATP_file_path)
 api_key = user_data.get('API_KEY', "yourapikey")
 username = user_data.get('USERNAME', "API_KEY")
 athlete_id = user_data.get('ATHLETE_ID', "athleteid")
@@ -49,8 +83,31 @@ unit_preference = user_data.get('DISTANCE_SYSTEM', "metric")
 note_color_ATP = user_data.get('NOTE_ATP_COLOR', "red")
 note_color_FEEDBACK = user_data.get('NOTE_FEEDBACK_COLOR', "blue")
 do_at_rest = user_data.get('Do_At_Rest', "Do nothing!")
+load_source = user_data.get('LOAD_SOURCE', "wellness")  # "wellness" or "model" (local CTL/ATL from activity loads)
 
-url_base = f"https://intervals.icu/api/v1/athlete/{athlete_id}"
+url_api = os.environ.get("ATP_API_URL", "https://intervals.icu/api/v1")  # Point to a local stand-in for benchmarks
+url_base = f"{url_api}/athlete/{athlete_id}"
 url_profile = f"{url_base}/profile"
 url_activities = f"{url_base}/activities"
 API_headers = {"Content-Type": "application/json"}
+
+note_templates_path = os.environ.get("ATP_NOTE_TEMPLATES")  # CSV or JSON file with the coach's note templates, see ATP_templates
+profile_ttl = float(os.environ.get("ATP_PROFILE_TTL", PROFILE_TTL))  # Seconds before the cached athlete profile is fetched again
+read_cache.open(os.path.join(ATP_cache_dir, "http"), float(os.environ.get("ATP_HTTP_CACHE_TTL", HTTP_CACHE_TTL)))  # GET responses, see ATP_http_cache
+ATP_api.FETCH_WINDOW_MONTHS = int(os.environ.get("ATP_FETCH_WINDOW_MONTHS", ATP_api.FETCH_WINDOW_MONTHS))  # Calendar months per request of long range reads
+
+def fetch_profile(username, api_key):
+    response = call_with_retries(http_session.get, url_profile, auth=HTTPBasicAuth(username, api_key), headers=API_headers)
+    if response.status_code == 200:
+        return response.json()
+    logging.error(f"Error fetching athlete profile: {response.status_code}")
+    return None
+
+def get_athlete_name(athlete_id, username, api_key):
+    """First name of the athlete for the notes, from the profile cache (see ATP_athlete_profile)."""
+    athlete = ProfileCache(ATP_cache_dir, athlete_id, profile_ttl).get(lambda: fetch_profile(username, api_key))
+    return first_name(athlete)
+
+def open_ledger(stage):
+    """Sync ledger of this workbook and athlete for one stage, see ATP_ledger."""
+    return Ledger(ATP_cache_dir, ATP_file_path, athlete_id, stage)
@@ -0,0 +1,114 @@
+"""
+Per activity type compliance of what was done with the ATP targets.
+
+Takes the weekly loads per activity type of the TARGET events and of the
+recorded activities (both aggregated with ATP_activities.weekly_type_totals,
+the activities counted toward the targeted types) and computes for every week and type at once:
+
+    ratio          actual / target of the week
+    rolling_ratio  actual / target over the last ROLLING_WEEKS weeks
+    status         ok, over, under (outside the compliance threshold), unplanned or none
+    under_streak   weeks in a row under target, up to and including this one
+    trend          up, down or steady: rolling_ratio against ROLLING_WEEKS weeks earlier
+
+The table is computed with NumPy over a (weeks, types) grid, so all past
+weeks of an athlete cost a handful of array operations.
+5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES adds its lines to the feedback notes.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from ATP_model import year_week
+
+ROLLING_WEEKS = 4
+TREND_STEP = 0.1  # Change of the rolling ratio that counts as a trend
+STREAK_WEEKS = 3  # Weeks under target in a row that are mentioned in the feedback
+
+
+def target_table(events):
+    """Date, type and load_target of TARGET event records."""
+    df = pd.DataFrame.from_records(events, columns=["start_date_local", "type", "load_target"])
+    df["date"] = pd.to_datetime(df["start_date_local"].astype(str).str[:10], errors="coerce")
+    df["type"] = df["type"].fillna("Unknown").astype(str)
+    df["load_target"] = pd.to_numeric(df["load_target"], errors="coerce").fillna(0)
+    return df.dropna(subset=["date"])[["date", "type", "load_target"]]
+
+
+def week_start(year_week):
+    year, week = year_week.split("-")
+    return datetime.strptime(f"{year}-W{int(week):02d}-1", "%G-W%V-%u")
+
+
+def all_weeks(first, last):
+    """Every ISO week ("YYYY-WW") from first to last, so rolling windows never skip a gap."""
+    weeks, day, end = [], week_start(first), week_start(last)
+    while day <= end:
+        weeks.append(year_week(day))
+        day += timedelta(days=7)
+    return weeks
+
+
+def rolling_sum(values, window):
+    totals = np.cumsum(values, axis=0)
+    totals[window:] = totals[window:] - totals[:-window]
+    return totals
+
+
+def compliance_table(targets, actuals, threshold, window=ROLLING_WEEKS):
+    """Long table (week, type) of target, actual and the compliance measures; targets and actuals are week x type frames."""
+    known = [index for index in (targets.index, actuals.index) if len(index)]
+    if not known:
+        return pd.DataFrame(columns=["week", "type", "target", "actual", "ratio", "rolling_ratio", "status", "under_streak", "trend"])
+    weeks = all_weeks(min(min(index) for index in known), max(max(index) for index in known))
+    types = sorted(set(targets.columns) | set(actuals.columns))
+    target = targets.reindex(index=weeks, columns=types, fill_value=0).to_numpy(dtype=float)
+    actual = actuals.reindex(index=weeks, columns=types, fill_value=0).to_numpy(dtype=float)
+
+    ratio = np.divide(actual, target, out=np.full(target.shape, np.nan), where=target > 0)
+    rolling_target, rolling_actual = rolling_sum(target, window), rolling_sum(actual, window)
+    rolling_ratio = np.divide(rolling_actual, rolling_target, out=np.full(target.shape, np.nan), where=rolling_target > 0)
+    status = np.select(
+        [(target == 0) & (actual == 0), target == 0, ratio > 1 + threshold, ratio < 1 - threshold],
+        ["none", "unplanned", "over", "under"],
+        "ok",
+    )
+    under = status == "under"
+    count = np.cumsum(under, axis=0)
+    under_streak = count - np.maximum.accumulate(np.where(under, 0, count), axis=0)
+    change = np.full(target.shape, np.nan)
+    change[window:] = rolling_ratio[window:] - rolling_ratio[:-window]
+    trend = np.select([change > TREND_STEP, change < -TREND_STEP], ["up", "down"], "steady")
+
+    return pd.DataFrame({
+        "week": np.repeat(weeks, len(types)),
+        "type": np.tile(types, len(weeks)),
+        "target": target.ravel(),
+        "actual": actual.ravel(),
+        "ratio": ratio.ravel(),
+        "rolling_ratio": rolling_ratio.ravel(),
+        "status": status.ravel(),
+        "under_streak": under_streak.ravel(),
+        "trend": trend.ravel(),
+    })
+
+
+def compliance_lines(table, year_week):
+    """Feedback lines (markdown) for the activity types that were planned or done in year_week."""
+    lines = []
+    week = table[(table["week"] == year_week) & (table["status"] != "none")]
+    for row in week.itertuples(index=False):
+        if row.status == "unplanned":
+            lines.append(f"- **{row.type}**: {round(row.actual)} done without a target.")
+            continue
+        line = f"- **{row.type}**: {round(row.actual)} of {round(row.target)} planned ({row.ratio:.0%})"
+        if not np.isnan(row.rolling_ratio):
+            line += f", {row.rolling_ratio:.0%} over the last {ROLLING_WEEKS} weeks"
+            if row.trend != "steady":
+                line += f" and trending {row.trend}"
+        line += "."
+        if row.under_streak >= STREAK_WEEKS:
+            line += f" Under target for {row.under_streak} weeks in a row."
+        lines.append(line)
+    return lines
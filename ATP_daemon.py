@@ -0,0 +1,328 @@
+"""
+Service mode for the ATP scripts: run the stages on a schedule, unattended.
+
+Jobs are read from a JSON config with a cron expression per stage and
+athlete. Every athlete gets one long-lived worker process that imports the
+stages once, so the HTTP session, the athlete profile and the imported
+libraries stay warm between runs. Its jobs run one at a time, so two stages
+never write the same workbook at once. The worker reloads the stages when the
+workbook was saved since the last job, so new settings are picked up.
+
+The time of the last run of every job is kept in a state file. After downtime
+each job that missed one or more runs is run once to catch up. A status file
+with a heartbeat, the next and last run, the outcome and the duration of every
+job is rewritten after every change, for monitoring.
+
+Config example (daemon.json):
+    {
+      "status_file": "C:\\\\TEMP\\\\atp_daemon_status.json",
+      "athletes": [
+        {"tla": "RAA", "year": 2026,
+         "jobs": [
+           {"stage": "5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES", "cron": "0 6 * * 1"},
+           {"stage": "4_LOAD_CHECK", "cron": "30 6 * * 1"},
+           {"stage": "1_ATP_LOAD", "cron": "0 5 * * *", "args": {"overwrite_past": false}}
+         ]}
+      ]
+    }
+
+Example:
+    python ATP_daemon.py --config daemon.json
+"""
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+from datetime import datetime, timedelta
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Entry point and unattended defaults per stage; a job's "args" are passed on top.
+STAGE_FUNCTIONS = {
+    "1_ATP_LOAD": ("sync_targets", {"overwrite_past": False}),
+    "2_ATP_NOTES": ("sync_weekly_notes", {}),
+    "3_ATP_PERIOD_NOTE": ("sync_period_notes", {"overwrite_past": False}),
+    "4_LOAD_CHECK": ("load_check", {}),
+    "5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES": ("sync_feedback_notes", {}),
+    "6_RACES": ("export_races", {}),
+}
+CRON_ALIASES = {"@hourly": "0 * * * *", "@daily": "0 0 * * *", "@weekly": "0 0 * * 1", "@monthly": "0 0 1 * *"}
+DEFAULT_JOB_TIMEOUT = 3600  # seconds
+MAX_MISSED_COUNT = 1000
+
+
+def parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+        if part == "*":
+            first, last = low, high
+        elif "-" in part:
+            first, last = (int(v) for v in part.split("-", 1))
+        else:
+            first = int(part)
+            last = high if step > 1 else first
+        if first < low or last > high or first > last or step < 1:
+            raise ValueError(f"Cron field '{field}' is outside {low}-{high}")
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class CronExpression:
+    """Standard 5-field cron expression: minute hour day-of-month month day-of-week (0 or 7 is Sunday)."""
+
+    def __init__(self, text):
+        self.text = text
+        fields = CRON_ALIASES.get(text.strip(), text).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{text}' needs 5 fields")
+        self.minutes = parse_cron_field(fields[0], 0, 59)
+        self.hours = parse_cron_field(fields[1], 0, 23)
+        self.days = parse_cron_field(fields[2], 1, 31)
+        self.months = parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {day % 7 for day in parse_cron_field(fields[4], 0, 7)}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday  # Like cron: either restriction is enough when both are given
+
+    def next_after(self, moment):
+        """First matching minute strictly after moment."""
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression '{self.text}' never fires")
+
+
+def athlete_worker(tla, env, jobs, results):
+    """Run the jobs of one athlete in a process that keeps the stages imported between runs."""
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - %(levelname)s - [{tla}] %(message)s', force=True)
+    os.environ.update(env)
+    workbook = env["ATP_FILE_PATH"]
+    loaded_mtime = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, stage, kwargs = job
+        started = time.perf_counter()
+        try:
+            mtime = os.path.getmtime(workbook)
+            if loaded_mtime is not None and mtime != loaded_mtime and "ATP_common_config" in sys.modules:
+                logging.info("Workbook changed since the last job; reloading settings and stages.")
+                importlib.reload(sys.modules["ATP_common_config"])
+                for name in list(STAGE_FUNCTIONS):
+                    if name in sys.modules:
+                        importlib.reload(sys.modules[name])
+            loaded_mtime = mtime
+            function_name, defaults = STAGE_FUNCTIONS[stage]
+            getattr(importlib.import_module(stage), function_name)(**dict(defaults, **kwargs))
+            results.put((job_id, "ok", None, time.perf_counter() - started))
+        except BaseException as e:  # SystemExit too: one bad run must not take the worker down
+            logging.exception(f"{stage} failed")
+            results.put((job_id, "failed", f"{type(e).__name__}: {e}", time.perf_counter() - started))
+
+
+class Job:
+    def __init__(self, athlete, spec):
+        self.athlete = athlete
+        self.stage = spec["stage"]
+        if self.stage not in STAGE_FUNCTIONS:
+            raise ValueError(f"Unknown stage '{self.stage}' for {athlete}")
+        self.cron = CronExpression(spec["cron"])
+        self.kwargs = spec.get("args", {})
+        self.timeout = spec.get("timeout", DEFAULT_JOB_TIMEOUT)
+        self.id = f"{athlete}:{self.stage}:{self.cron.text}"
+        self.next_run = None
+        self.status = {"athlete": athlete, "stage": self.stage, "cron": self.cron.text, "runs": 0, "failures": 0}
+
+
+class Scheduler:
+    def __init__(self, config, config_dir, catch_up=True):
+        self.status_file = config.get("status_file", os.path.join(config_dir, "atp_daemon_status.json"))
+        self.state_file = config.get("state_file", os.path.join(config_dir, "atp_daemon_state.json"))
+        self.catch_up = catch_up
+        self.started = datetime.now()
+        self.stopping = False
+        self.context = multiprocessing.get_context("spawn")  # Workers must import the config with their own environment
+        self.results = self.context.Queue()
+        self.athletes = {}
+        self.jobs = {}
+        for athlete in config["athletes"]:
+            tla = athlete["tla"]
+            env = {"ATP_ATHLETE_TLA": tla, "ATP_YEAR": str(athlete["year"])}
+            if athlete.get("file"):
+                env["ATP_FILE_PATH"] = athlete["file"]
+            else:
+                env["ATP_FILE_PATH"] = rf"C:\TEMP\{tla}\ATP2intervals_{tla}_{athlete['year']}.xlsm"
+            env.update({key: str(value) for key, value in athlete.get("env", {}).items()})
+            self.athletes[tla] = {"env": env, "process": None, "jobs": None, "pending": [], "running": None}
+            for spec in athlete["jobs"]:
+                job = Job(tla, spec)
+                self.jobs[job.id] = job
+        self.load_state()
+
+    def load_state(self):
+        state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, encoding="utf-8") as f:
+                state = json.load(f)
+        now = datetime.now()
+        for job in self.jobs.values():
+            saved = state.get(job.id, {})
+            job.status.update(saved)
+            last_run = datetime.fromisoformat(saved["last_run"]) if saved.get("last_run") else None
+            if last_run is None or not self.catch_up:
+                job.next_run = job.cron.next_after(now)
+                continue
+            job.next_run = job.cron.next_after(last_run)
+            missed, moment = 0, job.next_run
+            while moment <= now and missed < MAX_MISSED_COUNT:
+                missed += 1
+                moment = job.cron.next_after(moment)
+            if missed:
+                job.status["missed"] = job.status.get("missed", 0) + missed
+                logging.info(f"{job.id} missed {missed} run(s) while the daemon was down; catching up once.")
+
+    def write_json(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, default=str)
+        os.replace(tmp_path, path)
+
+    def save(self):
+        self.write_json(self.state_file, {
+            job.id: {key: job.status.get(key) for key in ("last_run", "runs", "failures", "missed")}
+            for job in self.jobs.values()
+        })
+        jobs = {}
+        for job in self.jobs.values():
+            jobs[job.id] = dict(job.status, next_run=job.next_run.isoformat(timespec="minutes"))
+        self.write_json(self.status_file, {
+            "pid": os.getpid(),
+            "started": self.started.isoformat(timespec="seconds"),
+            "heartbeat": datetime.now().isoformat(timespec="seconds"),
+            "healthy": all(job.status.get("last_status") != "failed" for job in self.jobs.values()),
+            "running": {tla: athlete["running"][0] for tla, athlete in self.athletes.items() if athlete["running"]},
+            "jobs": jobs,
+        })
+
+    def worker(self, tla):
+        athlete = self.athletes[tla]
+        if athlete["process"] is None or not athlete["process"].is_alive():
+            athlete["jobs"] = self.context.Queue()
+            athlete["process"] = self.context.Process(
+                target=athlete_worker, args=(tla, athlete["env"], athlete["jobs"], self.results), name=f"atp-{tla}", daemon=True
+            )
+            athlete["process"].start()
+        return athlete
+
+    def busy(self, job):
+        athlete = self.athletes[job.athlete]
+        return job.id in athlete["pending"] or (athlete["running"] is not None and athlete["running"][0] == job.id)
+
+    def dispatch(self, now):
+        for job in self.jobs.values():
+            # A job that comes due while it is still queued or running is run once more afterwards
+            if job.next_run <= now and not self.busy(job):
+                self.athletes[job.athlete]["pending"].append(job.id)
+                job.status["last_run"] = now.isoformat(timespec="minutes")
+                job.next_run = job.cron.next_after(now)
+        for tla, athlete in self.athletes.items():
+            if athlete["running"] is None and athlete["pending"]:
+                job = self.jobs[athlete["pending"].pop(0)]
+                logging.info(f"Starting {job.id}")
+                self.worker(tla)["jobs"].put((job.id, job.stage, job.kwargs))
+                athlete["running"] = (job.id, time.monotonic())
+
+    def finish(self, job_id, outcome, error, seconds):
+        job = self.jobs[job_id]
+        athlete = self.athletes[job.athlete]
+        if athlete["running"] is None or athlete["running"][0] != job_id:
+            # A late result of a worker that was terminated (timeout) and already counted as failed
+            logging.warning(f"Ignoring a late result of {job_id}: {outcome}")
+            return
+        athlete["running"] = None
+        job.status.update(last_status=outcome, last_error=error, last_duration_s=round(seconds, 1),
+                          last_finished=datetime.now().isoformat(timespec="seconds"), runs=job.status.get("runs", 0) + 1)
+        if outcome != "ok":
+            job.status["failures"] = job.status.get("failures", 0) + 1
+        logging.log(logging.INFO if outcome == "ok" else logging.ERROR, f"Finished {job_id}: {outcome} in {seconds:.1f}s" + (f" ({error})" if error else ""))
+
+    def check_workers(self):
+        for tla, athlete in self.athletes.items():
+            if not athlete["running"]:
+                continue
+            job_id, started = athlete["running"]
+            process = athlete["process"]
+            if not process.is_alive():
+                self.finish(job_id, "failed", f"worker exited with code {process.exitcode}", time.monotonic() - started)
+            elif time.monotonic() - started > self.jobs[job_id].timeout:
+                process.terminate()
+                process.join(5)
+                self.finish(job_id, "failed", "timeout", time.monotonic() - started)
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self, tick):
+        signal.signal(signal.SIGTERM, self.stop)
+        logging.info(f"ATP daemon started with {len(self.jobs)} job(s) for {len(self.athletes)} athlete(s).")
+        try:
+            while not self.stopping:
+                self.dispatch(datetime.now())
+                self.check_workers()
+                self.save()
+                try:
+                    self.finish(*self.results.get(timeout=tick))
+                    while True:
+                        self.finish(*self.results.get_nowait())
+                except queue.Empty:
+                    pass
+        except KeyboardInterrupt:
+            pass
+        logging.info("Stopping the ATP daemon.")
+        for athlete in self.athletes.values():
+            if athlete["process"] is not None and athlete["process"].is_alive():
+                athlete["jobs"].put(None)
+                athlete["process"].join(10)
+        self.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ATP stages on a cron schedule per athlete, unattended.")
+    parser.add_argument("--config", required=True, help="JSON file with the athletes and their jobs.")
+    parser.add_argument("--tick", type=float, default=15.0, help="Seconds between schedule checks.")
+    parser.add_argument("--no-catch-up", action="store_true", help="Skip runs that were missed while the daemon was down.")
+    args = parser.parse_args()
+    with open(args.config, encoding="utf-8") as f:
+        config = json.load(f)
+    Scheduler(config, os.path.dirname(os.path.abspath(args.config)), catch_up=not args.no_catch_up).run(args.tick)
+
+
+if __name__ == "__main__":
+    main()
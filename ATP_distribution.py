@@ -0,0 +1,238 @@
+"""
+Distribute the recommended weekly load over the activity types.
+
+Fills the *_load_target, *_time_target and *_distance_target columns of
+ATP_Data from the Total_load_target of every week, for one workbook or a whole
+roster at once. All weeks of all athletes are solved as one NumPy batch: each
+sport gets its share of the total, clamped to its minimum and maximum, and
+what a clamped sport can't take is spread over the others in proportion to
+their shares.
+
+Shares and limits come from an optional Load_Distribution sheet in the
+workbook, one row per period and sport (period "*" applies to every period):
+
+    period   sport  share  min_load  max_load  load_per_hour  speed
+    *        Ride   0.5    0                   70             28
+    *        Run    0.3    0         150       80             10
+    Base 1   Swim   0.3    50
+
+Empty cells fall back to the defaults: without a share, the athlete's current
+mix of that period (or of the whole plan, or an equal split); no limits; the
+TSS per hour of ATP_Conditions; and DEFAULT_SPEEDS. Time targets are in
+minutes; distance targets in km or miles (DISTANCE_SYSTEM), swims in meters.
+
+Example:
+    python ATP_distribution.py --roster daemon.json --dry-run
+"""
+import json
+
+import numpy as np
+
+from ATP_common_config import *
+
+DISTRIBUTION_SHEET = "Load_Distribution"
+DEFAULT_LOAD_PER_HOUR = 70
+DEFAULT_SPEEDS = {  # km/h
+    "Ride": 28, "VirtualRide": 30, "GravelRide": 24, "MountainBikeRide": 18,
+    "Run": 10, "TrailRun": 8, "Walk": 5, "Hike": 4, "Swim": 2.5, "OpenWaterSwim": 2.8,
+}
+SWIM_TYPES = ("swim", "openwaterswim")  # Distance targets in meters, as 1_ATP_LOAD expects
+KM_PER_MILE = 1.609344
+SOLVER_ITERATIONS = 60
+
+
+def float_or_none(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if np.isnan(value) else value
+
+
+class AthletePlan:
+    """The ATP_Data rows and distribution settings of one workbook."""
+
+    def __init__(self, path):
+        self.path = path
+        with timer("workbook_load"):
+            excel = pd.ExcelFile(path)
+            self.df = excel.parse(ATP_sheet_name)
+            conditions = excel.parse(ATP_sheet_Conditions, usecols="B:C")
+            user = excel.parse("User_Data")
+            settings = excel.parse(DISTRIBUTION_SHEET) if DISTRIBUTION_SHEET in excel.sheet_names else pd.DataFrame()
+        condition_values = dict(zip(conditions.iloc[:, 0].astype(str).str.strip(), conditions.iloc[:, 1]))
+        self.load_per_hour = float_or_none(condition_values.get("TSS per hour")) or DEFAULT_LOAD_PER_HOUR
+        self.unit_preference = dict(zip(user['Key'], user['Value'])).get('DISTANCE_SYSTEM', "metric")
+        self.settings = settings.rename(columns=lambda c: str(c).strip().lower())
+        self.sports = [
+            col[:-len('_load_target')] for col in self.df.columns
+            if col.endswith('_load_target') and col[:-len('_load_target')] not in ("None", "Total")
+        ]
+        self.rows = self.df.index[pd.to_datetime(self.df['start_date_local'], errors='coerce').notna()]
+        self.periods = self.df.loc[self.rows, 'period'].astype(str).str.strip()
+        self.totals = pd.to_numeric(self.df.loc[self.rows, 'Total_load_target'], errors='coerce').fillna(0).to_numpy()
+
+    def setting(self, sport, column):
+        """Per-row value of a Load_Distribution column for sport (NaN where not set)."""
+        values = pd.Series(np.nan, index=self.periods.index)
+        if self.settings.empty or column not in self.settings.columns:
+            return values
+        rows = self.settings[self.settings['sport'].astype(str).str.strip() == sport]
+        per_period = {str(p).strip(): float_or_none(v) for p, v in zip(rows['period'], rows[column])}
+        fallback = per_period.pop("*", None)
+        values = self.periods.map(per_period).astype(float)
+        return values.fillna(np.nan if fallback is None else fallback)
+
+    def current_mix(self):
+        """The athlete's current share per sport, per period where the period has loads, else over the whole plan."""
+        loads = self.df.loc[self.rows, [f"{sport}_load_target" for sport in self.sports]].apply(pd.to_numeric, errors='coerce').fillna(0)
+        loads.columns = self.sports
+        per_period = loads.groupby(self.periods).transform("sum")
+        overall = loads.sum()
+        mix = per_period.copy()
+        mix.loc[per_period.sum(axis=1).eq(0)] = overall.to_numpy()
+        if not mix.to_numpy().any():
+            return pd.DataFrame(1.0, index=loads.index, columns=self.sports)
+        return mix.div(mix.sum(axis=1).replace(0, 1), axis=0)
+
+    def arrays(self, sports):
+        """Shares, lower and upper limits, load per hour and speed as (weeks, len(sports)) arrays."""
+        weeks = len(self.rows)
+        shares, lower, upper = np.zeros((weeks, len(sports))), np.zeros((weeks, len(sports))), np.zeros((weeks, len(sports)))
+        rate, speed = np.ones((weeks, len(sports))), np.zeros((weeks, len(sports)))
+        mix = self.current_mix()
+        for j, sport in enumerate(sports):
+            if sport not in self.sports:
+                continue  # Not in this athlete's workbook: no share and a limit of 0
+            shares[:, j] = self.setting(sport, "share").fillna(mix[sport]).to_numpy()
+            lower[:, j] = self.setting(sport, "min_load").fillna(0).to_numpy()
+            upper[:, j] = self.setting(sport, "max_load").fillna(np.inf).to_numpy()
+            rate[:, j] = self.setting(sport, "load_per_hour").fillna(self.load_per_hour).to_numpy()
+            speed[:, j] = self.setting(sport, "speed").fillna(DEFAULT_SPEEDS.get(sport, 0)).to_numpy()
+        return shares, lower, upper, rate, speed
+
+
+def distribute(totals, shares, lower, upper, iterations=SOLVER_ITERATIONS):
+    """Split every row's total over the columns in proportion to shares, within lower and upper.
+
+    Solves x = clip(level * share, lower, upper) with sum(x) == total for the
+    level of every row at once, by bisection. Rows that can't be met within
+    the limits get the closest possible split.
+    """
+    totals = np.asarray(totals, dtype=float)[:, None]
+    total_share = shares.sum(axis=1, keepdims=True)
+    shares = np.where(total_share > 0, shares / np.where(total_share > 0, total_share, 1), (upper > 0) / np.maximum((upper > 0).sum(axis=1, keepdims=True), 1))
+    positive = np.where(shares > 0, shares, np.inf).min(axis=1, keepdims=True)
+    low = np.zeros_like(totals)
+    high = np.where(np.isfinite(positive), (totals + lower.sum(axis=1, keepdims=True)) / positive, 0.0)
+    for _ in range(iterations):
+        level = (low + high) / 2
+        too_much = np.clip(level * shares, lower, upper).sum(axis=1, keepdims=True) > totals
+        high = np.where(too_much, level, high)
+        low = np.where(too_much, low, level)
+    return np.clip(high * shares, lower, upper)
+
+
+def round_keeping_sum(values):
+    """Round every row to whole numbers without changing its (rounded) total."""
+    floors = np.floor(values)
+    missing = (np.round(values.sum(axis=1)) - floors.sum(axis=1)).astype(int)
+    order = np.argsort(floors - values, axis=1)  # Largest fractions first
+    ranks = np.argsort(order, axis=1)
+    return floors + (ranks < missing[:, None])
+
+
+@timer("distribute")
+def solve_roster(plans):
+    """Load, time and distance targets of every plan, solved as one batch over all athletes and weeks."""
+    sports = sorted({sport for plan in plans for sport in plan.sports})
+    parts = [plan.arrays(sports) for plan in plans]
+    shares, lower, upper, rate, speed = (np.vstack([part[i] for part in parts]) for i in range(5))
+    totals = np.concatenate([plan.totals for plan in plans])
+
+    infeasible = (lower.sum(axis=1) > totals) | (upper.sum(axis=1) < totals)
+    loads = round_keeping_sum(distribute(totals, shares, lower, upper))
+    hours = loads / np.where(rate > 0, rate, np.inf)
+    minutes = np.round(hours * 60)
+
+    results = []
+    start = 0
+    for plan in plans:
+        end = start + len(plan.rows)
+        if infeasible[start:end].any():
+            logging.warning(f"{plan.path}: {int(infeasible[start:end].sum())} week(s) can't meet the total within the min/max loads.")
+        targets = {}
+        for j, sport in enumerate(sports):
+            if sport not in plan.sports:
+                continue
+            if sport.lower() in SWIM_TYPES:
+                distance = hours[start:end, j] * speed[start:end, j] * 1000
+            elif plan.unit_preference == "imperial":
+                distance = hours[start:end, j] * speed[start:end, j] / KM_PER_MILE
+            else:
+                distance = hours[start:end, j] * speed[start:end, j]
+            targets[f"{sport}_load_target"] = loads[start:end, j]
+            targets[f"{sport}_time_target"] = minutes[start:end, j]
+            targets[f"{sport}_distance_target"] = np.round(distance)
+        results.append(targets)
+        start = end
+    return results
+
+
+@timer("export")
+def write_targets(plans, results, kinds):
+    """Write the solved columns into ATP_Data of every workbook; other rows and columns are left as they are."""
+    app = xw.App(visible=False)
+    try:
+        for plan, targets in zip(plans, results):
+            wb = xw.Book(plan.path)
+            ws = wb.sheets[ATP_sheet_name]
+            headers = list(plan.df.columns)
+            last_row = len(plan.df) + 1
+            for column, values in targets.items():
+                if column not in headers or not column.endswith(tuple(f"_{kind}_target" for kind in kinds)):
+                    continue
+                cells = ws.range((2, headers.index(column) + 1), (last_row, headers.index(column) + 1))
+                current = cells.options(ndim=1).value
+                for row, value in zip(plan.rows, values):
+                    current[row] = int(value)
+                cells.options(transpose=True).value = current
+            wb.save()
+            wb.close()
+            logging.info(f"Updated the targets in {plan.path}")
+    finally:
+        app.quit()
+
+
+def roster_workbooks(roster_path):
+    """Workbooks of the athletes in an ATP_daemon config."""
+    with open(roster_path, encoding="utf-8") as f:
+        config = json.load(f)
+    return [
+        athlete.get("file") or rf"C:\TEMP\{athlete['tla']}\ATP2intervals_{athlete['tla']}_{athlete['year']}.xlsm"
+        for athlete in config["athletes"]
+    ]
+
+
+def main(argv=None):
+    parser = stage_argument_parser("Distribute the weekly Total_load_target over the activity types of one workbook or a roster.")
+    parser.add_argument("workbooks", nargs="*", help="ATP workbooks (default: the workbook of ATP_common_config).")
+    parser.add_argument("--roster", help="ATP_daemon config whose athletes' workbooks are distributed together.")
+    parser.add_argument("--targets", default="load,time,distance", help="Comma separated target kinds to write (load, time, distance).")
+    parser.add_argument("--dry-run", action="store_true", help="Solve and log the result without writing the workbooks.")
+    args = parser.parse_args(argv)
+    paths = list(args.workbooks) + (roster_workbooks(args.roster) if args.roster else [])
+    kinds = [kind.strip() for kind in args.targets.split(",") if kind.strip()]
+
+    with profiled(args, "ATP_distribution"):
+        plans = [AthletePlan(path) for path in (paths or [ATP_file_path])]
+        results = solve_roster(plans)
+        for plan, targets in zip(plans, results):
+            loads = np.sum([values for column, values in targets.items() if column.endswith("_load_target")])
+            logging.info(f"{plan.path}: {len(plan.rows)} week(s), {int(loads)} of {int(plan.totals.sum())} load distributed over {', '.join(plan.sports)}")
+        if not args.dry_run:
+            write_targets(plans, results, kinds)
+
+
+if __name__ == "__main__":
+    main()
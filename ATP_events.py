@@ -0,0 +1,178 @@
+"""
+Compact in-memory index of the intervals.icu events the ATP scripts hold.
+
+The calendar reads return every event as a JSON dict. Kept that way, a
+roster-wide run that holds tens of thousands of events spends most of its
+memory on dict overhead and on copies of the same dates, types and colours.
+EventRecord keeps only the fields the scripts use, in __slots__, with the
+repeated strings interned. It still reads like the dict it replaces
+(record["id"], record.get("load_target", 0), record.update(...)), so the
+fingerprints of the sync ledger work on desired events (dicts) and fetched
+records alike.
+
+EventIndex holds the records of one stage as a mapping, under the key the
+stage looks its events up by:
+
+    start_type  (start_date_local, type)                  TARGET events of 1_ATP_LOAD
+    name        name                                      weekly and feedback notes of 2 and 5
+    period      (start_date_local, end_date_local, name)  period notes of 3_ATP_PERIOD_NOTE
+
+with secondary hash indexes by id and by name and a sorted index of the names
+for prefix lookups. The secondary indexes are built on their first use and
+kept up to date after that, so a stage that never asks for them doesn't pay
+for them. Writes from the threads of run_concurrently go through a lock. The
+fields of a key must not be changed on a record in place; store the record
+again under its new key instead.
+"""
+import bisect
+import sys
+import threading
+from collections.abc import MutableMapping
+from operator import attrgetter
+
+EVENT_FIELDS = (
+    "id", "category", "start_date_local", "end_date_local", "type", "name", "description", "color",
+    "load_target", "time_target", "distance_target",
+)
+INTERNED_FIELDS = ("category", "start_date_local", "end_date_local", "type", "color")
+KEYS = {
+    "start_type": ("start_date_local", "type"),
+    "name": ("name",),
+    "period": ("start_date_local", "end_date_local", "name"),
+}
+
+
+class EventRecord:
+    """The fields of one event the scripts use; the fields that weren't read are None."""
+    __slots__ = EVENT_FIELDS
+
+    def __init__(self, **fields):
+        for field in EVENT_FIELDS:
+            setattr(self, field, fields.get(field))
+        for field in INTERNED_FIELDS:
+            value = getattr(self, field)
+            if isinstance(value, str):
+                setattr(self, field, sys.intern(value))
+
+    @classmethod
+    def from_json(cls, record):
+        """Record of an event as read from intervals.icu; fields other than EVENT_FIELDS are dropped."""
+        return cls(**record)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) from None
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def update(self, changes=(), **fields):
+        for field, value in dict(changes, **fields).items():
+            setattr(self, field, value)
+
+    def to_json(self):
+        return {field: getattr(self, field) for field in EVENT_FIELDS if getattr(self, field) is not None}
+
+    def __repr__(self):
+        return f"EventRecord({', '.join(f'{field}={value!r}' for field, value in self.to_json().items())})"
+
+
+def event_record(record):
+    return record if isinstance(record, EventRecord) else EventRecord.from_json(record)
+
+
+class EventIndex(MutableMapping):
+    def __init__(self, key, records=()):
+        """Index of records (EventRecords or event dicts) under key, one of KEYS."""
+        self.key_of = attrgetter(*KEYS[key])
+        self.records = {}
+        self.lock = threading.RLock()
+        self._by_id = None
+        self._by_name = None
+        self._sorted_names = None
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """Store record under its own key."""
+        record = event_record(record)
+        self[self.key_of(record)] = record
+
+    def __getitem__(self, key):
+        return self.records[key]
+
+    def __setitem__(self, key, record):
+        record = event_record(record)
+        with self.lock:
+            if key in self.records:
+                self._unlink(key, self.records[key])
+            self.records[key] = record
+            if self._by_id is not None and record.id is not None:
+                self._by_id[record.id] = key
+            if self._by_name is not None and record.name is not None:
+                self._by_name.setdefault(record.name, {})[key] = None
+                self._sorted_names = None
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._unlink(key, self.records.pop(key))
+
+    def _unlink(self, key, record):
+        if self._by_id is not None and self._by_id.get(record.id) == key:
+            del self._by_id[record.id]
+        if self._by_name is not None and record.name in self._by_name:
+            keys = self._by_name[record.name]
+            keys.pop(key, None)
+            if not keys:
+                del self._by_name[record.name]
+                self._sorted_names = None
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def with_id(self, event_id):
+        """The record of the event with id event_id, or None."""
+        with self.lock:
+            if self._by_id is None:
+                self._by_id = {record.id: key for key, record in self.records.items() if record.id is not None}
+            key = self._by_id.get(event_id)
+            return None if key is None else self.records[key]
+
+    def named(self, name):
+        """The records of the events called name."""
+        with self.lock:
+            return [self.records[key] for key in self._names().get(name, ())]
+
+    def with_prefix(self, prefix):
+        """The records of the events whose name starts with prefix, by name."""
+        with self.lock:
+            names = self._names()
+            if self._sorted_names is None:
+                self._sorted_names = sorted(names)
+            found = []
+            for position in range(bisect.bisect_left(self._sorted_names, prefix), len(self._sorted_names)):
+                name = self._sorted_names[position]
+                if not name.startswith(prefix):
+                    break
+                found.extend(self.records[key] for key in names[name])
+            return found
+
+    def _names(self):
+        if self._by_name is None:
+            self._by_name = {}
+            for key, record in self.records.items():
+                if record.name is not None:
+                    self._by_name.setdefault(record.name, {})[key] = None
+        return self._by_name
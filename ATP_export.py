@@ -0,0 +1,100 @@
+"""
+Columnar export of the load check and race tables, next to (or instead of) the workbook.
+
+4_LOAD_CHECK and 6_RACES write their tables (WTL, WLC, Races and the event
+rows they are built from) to an export directory when one is given with
+--export-dir or ATP_EXPORT_DIR:
+
+    sqlite   atp_export.sqlite, one table per name with athlete and season columns
+    parquet  <table>/athlete=<TLA>/season=<year>/data.parquet (needs pyarrow)
+
+Every run replaces the rows of its own athlete and season only, so the
+history of other seasons and athletes stays in place and can be queried in
+one go, e.g. pd.read_parquet("export/WLC") or
+SELECT * FROM WLC WHERE athlete = 'RAA'. New columns (a new activity type in
+WLC) are added to existing SQLite tables on the fly.
+"""
+import importlib.util
+import logging
+import os
+import sqlite3
+from contextlib import closing
+
+from ATP_metrics import timer
+
+EXPORT_FORMATS = ("sqlite", "parquet")
+SQLITE_FILE = "atp_export.sqlite"
+PARQUET = importlib.util.find_spec("pyarrow") is not None
+
+
+def add_export_arguments(parser):
+    parser.add_argument("--export-dir", default=os.environ.get("ATP_EXPORT_DIR"), help="Also write the tables to this directory as SQLite and/or Parquet (default: ATP_EXPORT_DIR).")
+    parser.add_argument("--export-format", default=os.environ.get("ATP_EXPORT_FORMAT", ",".join(EXPORT_FORMATS) if PARQUET else "sqlite"), help="Comma separated export formats: sqlite, parquet (default: both when pyarrow is installed).")
+    parser.add_argument("--no-excel", action="store_true", help="Skip writing the workbook (only useful with --export-dir).")
+    return parser
+
+
+def sql_name(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+class TableExporter:
+    def __init__(self, export_dir, athlete, season, formats=EXPORT_FORMATS):
+        self.export_dir = export_dir
+        self.athlete = str(athlete)
+        self.season = str(season)
+        self.formats = [f.strip().lower() for f in (formats.split(",") if isinstance(formats, str) else formats) if f.strip()]
+        unknown = set(self.formats) - set(EXPORT_FORMATS)
+        if unknown:
+            raise ValueError(f"Unknown export format(s): {', '.join(sorted(unknown))}")
+        if "parquet" in self.formats and not PARQUET:
+            logging.warning("pyarrow is not installed; skipping the Parquet export.")
+            self.formats.remove("parquet")
+        os.makedirs(export_dir, exist_ok=True)
+
+    def prepared(self, df):
+        """The table with athlete and season columns and column names as plain strings."""
+        df = df.copy()
+        df.columns = [str(c) for c in df.columns]
+        df.insert(0, "season", self.season)
+        df.insert(0, "athlete", self.athlete)
+        return df
+
+    @timer("export")
+    def write(self, tables):
+        """Replace this athlete's and season's rows of every table (a dict of name -> DataFrame)."""
+        tables = {name: self.prepared(df) for name, df in tables.items() if df is not None}
+        if "sqlite" in self.formats:
+            self.write_sqlite(tables)
+        if "parquet" in self.formats:
+            for name, df in tables.items():
+                self.write_parquet(name, df)
+        logging.info(f"Exported {', '.join(tables)} for {self.athlete} {self.season} to {self.export_dir} ({', '.join(self.formats)})")
+
+    def write_sqlite(self, tables):
+        # The connection's own with block only commits; closing() releases the file as well
+        with closing(sqlite3.connect(os.path.join(self.export_dir, SQLITE_FILE))) as connection, connection:
+            for name, df in tables.items():
+                columns = [row[1] for row in connection.execute(f"PRAGMA table_info({sql_name(name)})")]
+                if columns:
+                    for column in df.columns:
+                        if column not in columns:
+                            connection.execute(f"ALTER TABLE {sql_name(name)} ADD COLUMN {sql_name(column)}")
+                    connection.execute(f"DELETE FROM {sql_name(name)} WHERE athlete = ? AND season = ?", (self.athlete, self.season))
+                df.to_sql(name, connection, if_exists="append", index=False)
+
+    def write_parquet(self, name, df):
+        directory = os.path.join(self.export_dir, name, f"athlete={self.athlete}", f"season={self.season}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "data.parquet")
+        tmp_path = f"{path}.tmp"
+        # The partition directories carry athlete and season
+        df.drop(columns=["athlete", "season"]).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+
+def open_exporter(args, athlete, season):
+    """A TableExporter for the stage's --export-dir, or None when no export was asked for."""
+    if not args.export_dir:
+        return None
+    return TableExporter(args.export_dir, athlete, season, args.export_format)
@@ -0,0 +1,179 @@
+"""
+Fault-injection scenarios for the retry and concurrency behaviour of the ATP scripts.
+
+Every scenario starts a fresh ATP_mock_server with a FaultInjector (429 storms,
+5xx bursts, slow responses, dropped connections, lost answers to writes) and
+runs the syncing stages on one synthetic athlete, each as its own process like
+ATP_benchmark does. A stage that fails on a fault is run again, up to
+--attempts times, as a coach or the daemon would. Afterwards the scenario
+switches the faults off and runs every stage once more, as the next routine
+run would. scenario_failures then checks that:
+
+- every stage finished within its attempts,
+- the faulty runs took at most max_seconds,
+- the stages retried at most max_retries calls in total (their own metrics),
+- no TARGET or NOTE event was created twice, by the create log of the stand-in,
+- intervals.icu holds no duplicate TARGET or NOTE events, after the faulty
+  runs nor after the follow-up run,
+- after the follow-up run it holds exactly the events of a run without faults.
+
+test_fault_scenarios.py runs baseline, dropped_writes, 429_storm and
+dropped_connections as pytest tests on these checks. This script runs any of
+the scenarios, appends the results to --output as JSON lines and exits with 1
+when a check failed.
+
+Example:
+    python ATP_fault_scenarios.py --scenarios baseline 429_storm dropped_writes
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from ATP_benchmark import benchmark_start_date, run_stage, seed_mock_state
+from ATP_mock_server import FaultInjector, MockIntervalsServer
+from ATP_workbook_generator import generate_roster
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SYNC_STAGES = ["1_ATP_LOAD", "2_ATP_NOTES", "3_ATP_PERIOD_NOTE", "5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES"]
+
+# faults: FaultInjector arguments; rate_limit: requests per second before the stand-in answers 429
+SCENARIOS = {
+    "baseline": {"faults": {}, "max_seconds": 120, "max_retries": 0},
+    "slow_tail": {"faults": {"latency_median": 0.03, "latency_sigma": 1.0}, "max_seconds": 240, "max_retries": 0},
+    "rate_limited": {"faults": {}, "rate_limit": 10, "max_seconds": 240, "max_retries": 200},
+    "429_storm": {"faults": {"throttle_windows": [(2, 5), (12, 14)]}, "max_seconds": 180, "max_retries": 200},
+    "5xx_burst": {"faults": {"outage_windows": [(3, 5)], "error_rate": 0.03}, "max_seconds": 180, "max_retries": 200},
+    "dropped_connections": {"faults": {"drop_rate": 0.03}, "max_seconds": 180, "max_retries": 100},
+    "dropped_writes": {"faults": {"drop_after_rate": 0.03}, "max_seconds": 180, "max_retries": 100},
+}
+
+
+def event_key(event):
+    return (event.get("category"), event.get("start_date_local"), event.get("type") if event.get("category") == "TARGET" else event.get("name"))
+
+
+def event_keys(state, athlete_id):
+    """(category, start, type or name) of every TARGET and NOTE event, one entry per event."""
+    with state.lock:
+        events = list(state.events.get(athlete_id, {}).values())
+    return sorted(event_key(e) for e in events if e.get("category") in ("TARGET", "NOTE"))
+
+
+def created_keys(state, athlete_id):
+    """event_key of every TARGET and NOTE event created through the API, one entry per create."""
+    with state.lock:
+        created = [event for athlete, event in state.created if athlete == athlete_id]
+    return sorted(event_key(e) for e in created if e.get("category") in ("TARGET", "NOTE"))
+
+
+def duplicates(keys):
+    seen, repeated = set(), set()
+    for key in keys:
+        (repeated if key in seen else seen).add(key)
+    return sorted(repeated)
+
+
+def run_scenario(name, spec, athlete, attempts, timeout, workdir):
+    """Run the sync stages under the faults of spec, then once more without faults; returns the result."""
+    faults = FaultInjector(**spec["faults"]) if spec["faults"] else None
+    server = MockIntervalsServer(rate_limit=spec.get("rate_limit"), faults=faults).start()
+    seed_mock_state(server.state, athlete["athlete_id"], athlete["rows"])
+    cache_dir = tempfile.mkdtemp(prefix=f"cache_{name}_", dir=workdir)
+    result = {"scenario": name, "stages": {}, "retries": 0, "reruns": 0, "dropped": 0}
+    started = time.perf_counter()
+    try:
+        for stage in SYNC_STAGES:
+            for attempt in range(1, attempts + 1):
+                outcome = run_stage(stage, athlete, server, timeout, workdir, cache_dir)
+                result["retries"] += outcome.get("client_counters", {}).get("http_retries", 0)
+                result["dropped"] += outcome["statuses"].get("dropped", 0)
+                if outcome["returncode"] == 0:
+                    break
+                result["reruns"] += 1
+                logging.info(f"{name}: {stage} failed on attempt {attempt} ({outcome.get('error', '')}); running it again")
+            result["stages"][stage] = {"attempts": attempt, "returncode": outcome["returncode"]}
+        result["seconds"] = round(time.perf_counter() - started, 1)
+        faulty_events = event_keys(server.state, athlete["athlete_id"])
+        # The next routine run, without faults: the sync ledgers pick up the writes that went unanswered
+        server.faults = None
+        for stage in SYNC_STAGES:
+            run_stage(stage, athlete, server, timeout, workdir, cache_dir)
+        result["events"] = event_keys(server.state, athlete["athlete_id"])
+        result["created"] = created_keys(server.state, athlete["athlete_id"])
+        result["duplicate_events"] = duplicates(faulty_events) or duplicates(result["events"])
+    finally:
+        server.stop()
+    return result
+
+
+def scenario_failures(result, spec, expected):
+    """The checks of the module docstring that result fails; expected are the events of a run without faults."""
+    failed = [f"{stage} did not finish in its attempts" for stage, outcome in result["stages"].items() if outcome["returncode"] != 0]
+    if result["seconds"] > spec["max_seconds"]:
+        failed.append(f"took {result['seconds']}s, more than {spec['max_seconds']}s")
+    if result["retries"] > spec["max_retries"]:
+        failed.append(f"{result['retries']} retries, more than {spec['max_retries']}")
+    created_twice = duplicates(result["created"])
+    if created_twice:
+        failed.append(f"{len(created_twice)} event(s) created more than once, e.g. {created_twice[0]}")
+    if result["duplicate_events"]:
+        failed.append(f"{len(result['duplicate_events'])} duplicate event(s), e.g. {result['duplicate_events'][0]}")
+    if result["events"] != expected:
+        missing, extra = len(set(expected) - set(result["events"])), len(set(result["events"]) - set(expected))
+        failed.append(f"events differ from a run without faults: {missing} missing, {extra} extra")
+    return failed
+
+
+def fault_athlete(workdir, seasons=1):
+    """The synthetic athlete every scenario runs on."""
+    return generate_roster(os.path.join(workdir, "workbook"), athletes=1, seasons=seasons, start_date=benchmark_start_date(seasons))[0]
+
+
+def reference_events(athlete, timeout, workdir):
+    """The events a run without faults leaves behind, to compare every scenario with."""
+    return run_scenario("reference", SCENARIOS["baseline"], athlete, 1, timeout, workdir)["events"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ATP sync stages against a stand-in that injects faults, and check the outcome.")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS), help="Scenarios to run (default: all).")
+    parser.add_argument("--seasons", type=int, default=1, help="Seasons in the synthetic workbook.")
+    parser.add_argument("--attempts", type=int, default=3, help="Runs per stage before it counts as failed.")
+    parser.add_argument("--timeout", type=float, default=600, help="Per run timeout in seconds.")
+    parser.add_argument("--output", default="fault_results.jsonl", help="JSON lines file the results are appended to.")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic workbook (default: temp dir).")
+    args = parser.parse_args()
+
+    run_id = datetime.now().strftime("%Y%m%dT%H%M%S")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="atp_faults_")
+    os.makedirs(workdir, exist_ok=True)
+    athlete = fault_athlete(workdir, args.seasons)
+    expected = reference_events(athlete, args.timeout, workdir)
+    results = []
+    for name in args.scenarios:
+        logging.info(f"Running scenario {name}")
+        result = run_scenario(name, SCENARIOS[name], athlete, args.attempts, args.timeout, workdir)
+        result["failed"] = scenario_failures(result, SCENARIOS[name], expected)
+        results.append(result)
+
+    with open(args.output, "a", encoding="utf-8") as f:
+        for result in results:
+            summary = dict(result, run_id=run_id, events=len(result["events"]), created=len(result["created"]),
+                           duplicate_events=len(result["duplicate_events"]))
+            f.write(json.dumps(summary) + "\n")
+
+    print(f"{'scenario':<22}{'time(s)':>9}{'retries':>9}{'dropped':>9}{'reruns':>8}  result")
+    for r in results:
+        print(f"{r['scenario']:<22}{r['seconds']:>9}{r['retries']:>9}{r['dropped']:>9}{r['reruns']:>8}  {'; '.join(r['failed']) or 'ok'}")
+    if any(r["failed"] for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Local fitness/fatigue model (CTL, ATL and TSB) for the ATP scripts.
+
+Computes the exponentially weighted training load model from daily loads, the
+same way intervals.icu does for its wellness values:
+
+    CTL[t] = CTL[t-1] * exp(-1/42) + load[t] * (1 - exp(-1/42))
+    ATL[t] = ATL[t-1] * exp(-1/7)  + load[t] * (1 - exp(-1/7))
+    TSB[t] = CTL[t] - ATL[t]
+
+The recursion is evaluated with NumPy in blocks of days: within a block it is
+a cumulative sum of decay-weighted loads, so a whole ATP window (or a batch of
+athletes or scenarios, as rows of a 2D array) costs a handful of array
+operations instead of a Python loop per day. Blocks keep the decay weights
+within float64 range for any window length.
+
+With LOAD_SOURCE = model in User_Data, 5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES takes
+its weekly loads from this model, fed by the activity loads, instead of the
+wellness endpoint. The activities come from the ActivityStore cache of
+ATP_activities, so the feedback still works offline.
+
+Run this file to validate the model against the wellness values of the
+athlete in ATP_common_config:
+    python ATP_fitness.py
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from ATP_model import year_weeks
+
+CTL_DAYS = 42
+ATL_DAYS = 7
+EWMA_BLOCK_DAYS = 128  # exp(128/7) stays far below the float64 limit
+WARMUP_DAYS = 180  # Days of load history before the window, so the starting CTL has settled
+
+
+def ewma(loads, days, initial=0.0, block=EWMA_BLOCK_DAYS):
+    """Exponentially weighted average over the last axis of loads (one row per series)."""
+    loads = np.asarray(loads, dtype=float)
+    decay = np.exp(-1.0 / days)
+    result = np.empty_like(loads)
+    state = np.array(np.broadcast_to(np.asarray(initial, dtype=float), loads.shape[:-1]))
+    for start in range(0, loads.shape[-1], block):
+        chunk = loads[..., start:start + block]
+        steps = np.arange(chunk.shape[-1])
+        # y[t] = decay^(t+1) * state + (1 - decay) * sum_i<=t decay^(t-i) * load[i]
+        weighted = np.cumsum(chunk * decay ** -steps, axis=-1) * decay ** steps
+        values = decay ** (steps + 1) * state[..., None] + (1.0 - decay) * weighted
+        result[..., start:start + chunk.shape[-1]] = values
+        state = values[..., -1]
+    return result
+
+
+def fitness_model(loads, initial_ctl=0.0, initial_atl=0.0):
+    """Daily CTL, ATL and TSB for daily loads (1D, or 2D with one row per athlete or scenario)."""
+    ctl = ewma(loads, CTL_DAYS, initial_ctl)
+    atl = ewma(loads, ATL_DAYS, initial_atl)
+    return ctl, atl, ctl - atl
+
+
+def daily_load_series(records, start_date, end_date, date_key="start_date_local", load_key="icu_training_load"):
+    """Sum the loads of activity or event records (or an ActivityStore table) per day, with a zero for every day without load."""
+    days = pd.date_range(pd.Timestamp(start_date).normalize(), pd.Timestamp(end_date).normalize(), freq="D")
+    frame = records if isinstance(records, pd.DataFrame) else pd.DataFrame.from_records(records, columns=[date_key, load_key])
+    if frame.empty:
+        return pd.Series(0.0, index=days, name="load")
+    dates = pd.to_datetime(frame[date_key].astype(str).str[:10], errors="coerce")
+    offsets = ((dates - days[0]).dt.days).to_numpy()
+    loads = pd.to_numeric(frame[load_key], errors="coerce").fillna(0).to_numpy()
+    valid = ~np.isnan(offsets.astype(float)) & (offsets >= 0) & (offsets < len(days))
+    totals = np.bincount(offsets[valid].astype(int), weights=loads[valid], minlength=len(days))
+    return pd.Series(totals, index=days, name="load")
+
+
+def fitness_frame(daily_loads, initial_ctl=0.0, initial_atl=0.0):
+    """DataFrame with the daily load, CTL, ATL and TSB, indexed by day."""
+    ctl, atl, tsb = fitness_model(daily_loads.to_numpy(), initial_ctl, initial_atl)
+    return pd.DataFrame({"load": daily_loads.to_numpy(), "ctl": ctl, "atl": atl, "tsb": tsb}, index=daily_loads.index)
+
+
+def weekly_loads_from_model(frame):
+    """Weekly totals keyed like calculate_weekly_loads ("YYYY-WW"), with CTL, ATL and TSB at the end of the week.
+
+    intervals.icu counts the same daily load for CTL and ATL, so ctlLoad and atlLoad are equal here.
+    """
+    keys = year_weeks(frame.index)
+    grouped = frame.groupby(keys.to_numpy(), sort=False)
+    totals = grouped["load"].sum().round()
+    last = grouped[["ctl", "atl", "tsb"]].last().round(1)
+    return {
+        key: {"ctlLoad": int(totals[key]), "atlLoad": int(totals[key]),
+              "ctl": float(last.at[key, "ctl"]), "atl": float(last.at[key, "atl"]), "tsb": float(last.at[key, "tsb"])}
+        for key in totals.index
+    }
+
+
+def compare_with_wellness(frame, wellness_records):
+    """Per-day difference between the model and the wellness ctl/atl values, for validation."""
+    wellness = pd.DataFrame.from_records(wellness_records, columns=["id", "ctl", "atl"])
+    wellness.index = pd.to_datetime(wellness["id"], errors="coerce")
+    joined = frame[["ctl", "atl"]].join(wellness[["ctl", "atl"]], rsuffix="_wellness", how="inner").dropna()
+    joined["ctl_error"] = joined["ctl"] - joined["ctl_wellness"]
+    joined["atl_error"] = joined["atl"] - joined["atl_wellness"]
+    return joined
+
+
+def main():
+    import argparse
+    from datetime import timedelta
+
+    parser = argparse.ArgumentParser(description="Validate the local CTL/ATL model against the intervals.icu wellness values.")
+    parser.add_argument("--warmup-days", type=int, default=WARMUP_DAYS, help="Days of activity history before the ATP window.")
+    args = parser.parse_args()
+
+    from ATP_common_config import (ATP_file_path, API_headers, HTTPBasicAuth, api_key, call_with_retries, http_session,
+                                   stream_records, url_activities, url_base, username)
+    conditions = pd.read_excel(ATP_file_path, sheet_name="ATP_Conditions", usecols="B:C")
+    window = dict(zip(conditions.iloc[:, 0], conditions.iloc[:, 1]))
+    start, end = pd.Timestamp(window["Start_ATP"]), min(pd.Timestamp(window["End_ATP"]), pd.Timestamp.now().normalize())
+    history_start = start - timedelta(days=args.warmup_days)
+    auth = HTTPBasicAuth(username, api_key)
+
+    params = {"oldest": history_start.strftime("%Y-%m-%d"), "newest": end.strftime("%Y-%m-%d")}
+    response = call_with_retries(http_session.get, url_activities, headers=API_headers, params=params, auth=auth, stream=True)
+    response.raise_for_status()
+    loads = daily_load_series(stream_records(response, fields={"start_date_local": None, "icu_training_load": 0}), history_start, end)
+    frame = fitness_frame(loads)
+
+    params = {"oldest": start.strftime("%Y-%m-%d"), "newest": end.strftime("%Y-%m-%d")}
+    response = call_with_retries(http_session.get, f"{url_base}/wellness", headers=API_headers, params=params, auth=auth, stream=True)
+    response.raise_for_status()
+    comparison = compare_with_wellness(frame, stream_records(response, fields={"id": None, "ctl": None, "atl": None}))
+    if comparison.empty:
+        logging.error("No wellness values to compare with.")
+        return
+    for column in ("ctl_error", "atl_error"):
+        errors = comparison[column].abs()
+        logging.info(f"{column}: mean {errors.mean():.2f}, max {errors.max():.2f} over {len(errors)} day(s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Read cache for the intervals.icu GET calls of the ATP scripts.
+
+Responses are kept per URL (which names the athlete), query parameters and
+API key, in ATP_cache_dir/http (one folder per athlete), so they are shared
+by the calls of one run and by the runs after it. When the server sent an ETag or
+Last-Modified header, the next read asks again with If-None-Match /
+If-Modified-Since and a 304 answer is served from the cache; otherwise a
+cached response is used as is while it is younger than the TTL
+(ATP_HTTP_CACHE_TTL seconds). Identical reads from several threads at once
+share a single request. A successful create, update or delete drops the
+cached reads of that athlete, so a script never reads back its own stale
+calendar.
+
+Cached responses are plain requests.Response objects, so response.json() and
+ATP_api.stream_records work on them unchanged. Streamed reads (stream=True,
+the large event and wellness lists) stay streamed: their body is copied to
+the cache file chunk by chunk while the caller parses it, is only kept once
+it was read to the end, and is read back from the file in chunks as well.
+Small bodies (the athlete profile) are also kept in memory.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import weakref
+
+import requests
+
+from ATP_metrics import metrics
+
+HTTP_CACHE_TTL = 60  # seconds, for responses without ETag or Last-Modified
+SHARE_TIMEOUT = 60  # seconds a read waits for an identical streamed read of another thread before it asks itself
+ATHLETE_SCOPE = re.compile(r"^.*?/athlete/[^/?]+")
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:20]
+
+
+class BodyFile:
+    """The raw stream of a cached body read from its file; the file is closed once it has been read to the end."""
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+
+    def read(self, size=-1):
+        if self.file.closed:
+            return b""
+        chunk = self.file.read(size)
+        if not chunk:
+            self.file.close()
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+
+def cached_response(entry, body):
+    """A response with a cached answer; body holds its bytes, or the path of the body file of a streamed read."""
+    response = requests.Response()
+    response.status_code = 200
+    if isinstance(body, bytes):
+        response._content = body
+        response._content_consumed = True
+    else:
+        response.raw = BodyFile(body)
+    response.encoding = entry.get("encoding")
+    response.headers.update(entry.get("headers", {}))
+    response.url = entry["url"]
+    response.from_cache = True  # Its bytes were counted when it was fetched
+    return response
+
+
+class InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.streaming = False
+
+
+class ReadCache:
+    def __init__(self):
+        self.directory = None
+        self.ttl = HTTP_CACHE_TTL
+        self.lock = threading.RLock()  # finish may run from the garbage collector while this thread holds the lock
+        self.entries = {}
+        self.in_flight = {}
+        self.generations = {}  # Bumped per athlete by every write, so reads that overlap a write aren't kept
+
+    def open(self, directory, ttl=HTTP_CACHE_TTL):
+        """Enable the cache; until then every read goes to the server."""
+        self.directory, self.ttl = directory, ttl
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def scope(self, url):
+        match = ATHLETE_SCOPE.match(url)
+        return _digest(match.group(0) if match else url)
+
+    def key(self, url, kwargs):
+        # The basic auth user is the same "API_KEY" for everyone; the password is the key of the coach or athlete
+        auth = kwargs.get("auth")
+        return _digest([url, sorted((kwargs.get("params") or {}).items()), getattr(auth, "password", None)])
+
+    def paths(self, scope, key):
+        base = os.path.join(self.directory, scope, key)
+        return f"{base}.json", f"{base}.body"
+
+    def load(self, scope, key):
+        if key in self.entries:
+            return self.entries[key]
+        meta_path, body_path = self.paths(scope, key)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                entry = json.load(f)
+            if entry.get("streamed"):
+                if not os.path.exists(body_path):
+                    return None, None
+                body = body_path
+            else:
+                with open(body_path, "rb") as f:
+                    body = f.read()
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable HTTP cache entry {meta_path}: {e}")
+            return None, None
+        self.entries[key] = (entry, body)
+        return entry, body
+
+    def store(self, scope, key, entry, body, write_body=True):
+        """Save entry and its body (only the entry when write_body is False or body is the path of a streamed body)."""
+        if write_body and isinstance(body, bytes):
+            _, body_path = self.paths(scope, key)
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            with open(f"{body_path}.tmp", "wb") as f:
+                f.write(body)
+            os.replace(f"{body_path}.tmp", body_path)
+        meta_path, _ = self.paths(scope, key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(f"{meta_path}.tmp", meta_path)
+        self.entries[key] = (entry, body)
+
+    def invalidate(self, url):
+        """Drop the cached reads of the athlete of url, after a write."""
+        if not self.enabled:
+            return
+        scope = self.scope(url)
+        with self.lock:
+            self.generations[scope] = self.generations.get(scope, 0) + 1
+            self.entries = {key: value for key, value in self.entries.items() if value[0].get("scope") != scope}
+            shutil.rmtree(os.path.join(self.directory, scope), ignore_errors=True)
+
+    def get(self, url, kwargs, fetch):
+        """The response of a GET, from the cache where possible; fetch(headers) makes the request."""
+        scope, key = self.scope(url), self.key(url, kwargs)
+        with self.lock:
+            pending = self.in_flight.get(key)
+            leader = pending is None
+            if leader:
+                pending = self.in_flight[key] = InFlight()
+        if not leader:
+            pending.done.wait(SHARE_TIMEOUT)
+            if isinstance(pending.result, tuple):
+                metrics.count("http_cache_shared")
+                return cached_response(*pending.result)
+            return fetch(kwargs.get("headers"))  # The shared request failed or is still streaming; ask on our own
+        result = None
+        try:
+            result = self.read(scope, key, url, kwargs, fetch, pending)
+        finally:
+            if not pending.streaming:
+                self.finish(key, pending, result)
+        return cached_response(*result) if isinstance(result, tuple) else result
+
+    def finish(self, key, pending, result=None):
+        """Let the reads waiting for pending go on; they share result when it is an (entry, body) answer."""
+        with self.lock:
+            if self.in_flight.get(key) is not pending:
+                return
+            del self.in_flight[key]
+        pending.result = result
+        pending.done.set()
+
+    def read(self, scope, key, url, kwargs, fetch, pending):
+        """(entry, body) of a cacheable answer, or the response itself when it can't be cached."""
+        with self.lock:
+            entry, body = self.load(scope, key)
+            generation = self.generations.get(scope, 0)
+        validators = {}
+        if entry is not None:
+            if entry.get("etag"):
+                validators["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                validators["If-Modified-Since"] = entry["last_modified"]
+            if not validators and time.time() - entry["fetched"] < self.ttl:
+                metrics.count("http_cache_hits")
+                return entry, body
+
+        response = fetch(dict(kwargs.get("headers") or {}, **validators))
+        if response.status_code == 304 and entry is not None:
+            metrics.count("http_cache_revalidated")
+            entry = dict(entry, fetched=time.time())
+            with self.lock:
+                if self.generations.get(scope, 0) == generation:
+                    self.store(scope, key, entry, body, write_body=False)
+            return entry, body
+        if response.status_code != 200:
+            return response
+
+        entry = {
+            "url": url,
+            "scope": scope,
+            "fetched": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "encoding": response.encoding,
+            "headers": {"Content-Type": response.headers.get("Content-Type", "application/json")},
+            "streamed": bool(kwargs.get("stream")),
+        }
+        if not (entry["etag"] or entry["last_modified"] or self.ttl > 0):
+            return response
+        if entry["streamed"]:
+            # Read as a stream by the caller, as without the cache, with the body copied to its file on the way
+            self.copy_while_streaming(response, scope, key, entry, generation, pending)
+            return response
+        body = response.content
+        with self.lock:
+            if self.generations.get(scope, 0) == generation:
+                self.store(scope, key, entry, body)
+        return entry, body
+
+    def copy_while_streaming(self, response, scope, key, entry, generation, pending):
+        """Write the body of response to the cache chunk by chunk while the caller reads it; kept once read to the end."""
+        _, body_path = self.paths(scope, key)
+        iter_content = type(response).iter_content
+        response_ref = weakref.ref(response)  # No reference cycle, so an unread response is freed (and finished) at once
+        pending.streaming = True
+        # A response that is never read must not hold up the reads waiting for it
+        weakref.finalize(response, self.finish, key, pending)
+
+        def copying(*args, **kwargs):
+            tmp_path = f"{body_path}.{threading.get_ident()}.tmp"
+            complete = False
+            try:
+                os.makedirs(os.path.dirname(body_path), exist_ok=True)
+                with open(tmp_path, "wb") as f:
+                    for chunk in iter_content(response_ref(), *args, **kwargs):
+                        f.write(chunk)
+                        yield chunk
+                complete = True
+            finally:
+                with self.lock:
+                    complete = complete and self.generations.get(scope, 0) == generation
+                    if complete:
+                        os.replace(tmp_path, body_path)
+                        self.store(scope, key, entry, body_path)
+                if not complete and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                self.finish(key, pending, (entry, body_path) if complete else None)
+
+        response.iter_content = copying
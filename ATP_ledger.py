@@ -0,0 +1,150 @@
+"""
+Local sync ledger for the ATP scripts.
+
+For every week (or period) a stage syncs, the ledger keeps a fingerprint of
+what the stage wants on intervals.icu for it (a hash over the workbook inputs
+that end up in the events) and the ids of the events that hold it, as recorded
+after the last successful sync. On the next run the stage only fetches and
+reconciles the date ranges whose fingerprint changed; when nothing changed it
+makes no API calls at all. Changes made on intervals.icu itself are not seen
+this way: run the stage with --verify to fetch the full ATP window, reconcile
+everything and rebuild the ledger.
+
+A sync can be limited to a range of weeks with --from/--to or --weeks (see
+sync_range): only those weeks are fetched, reconciled and recorded, and
+events outside the range are never deleted.
+
+Ledgers live in ATP_cache_dir (ATP_CACHE_DIR, or .atp_cache next to the
+workbook), one JSON file per workbook, athlete and stage.
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+DAY_FORMAT = "%Y-%m-%dT00:00:00"
+
+
+def fingerprint(value):
+    """Stable short hash of any JSON-serialisable value."""
+    text = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def week_end(week_start):
+    return (datetime.strptime(week_start[:10], "%Y-%m-%d") + timedelta(days=6)).strftime(DAY_FORMAT)
+
+
+def date_ranges(spans):
+    """Merge (first_day, last_day) spans into as few contiguous fetch ranges as possible."""
+    ranges = []
+    for first, last in sorted(spans):
+        if ranges:
+            previous_last = datetime.strptime(ranges[-1][1][:10], "%Y-%m-%d")
+            if datetime.strptime(first[:10], "%Y-%m-%d") <= previous_last + timedelta(days=1):
+                ranges[-1][1] = max(ranges[-1][1], last)
+                continue
+        ranges.append([first, last])
+    return [tuple(r) for r in ranges]
+
+
+def day(text):
+    """A YYYY-MM-DD command line date, in DAY_FORMAT."""
+    return datetime.strptime(text, "%Y-%m-%d").strftime(DAY_FORMAT)
+
+
+def sync_range(first=None, last=None, weeks=None, today=None):
+    """(first, last) of a sync limited with --from/--to/--weeks, in DAY_FORMAT; None for an open end.
+
+    first moves back to the Monday of its week; last is the latest week start to include. weeks counts
+    from the week of first, or from the current week.
+    """
+    def monday(value):
+        date = datetime.strptime(str(value)[:10], "%Y-%m-%d")
+        return date - timedelta(days=date.weekday())
+
+    if weeks:
+        if last:
+            raise ValueError("--weeks and --to can't be combined.")
+        start = monday(first or (today or datetime.now()).strftime("%Y-%m-%d"))
+        return start.strftime(DAY_FORMAT), (start + timedelta(weeks=weeks - 1)).strftime(DAY_FORMAT)
+    return (monday(first).strftime(DAY_FORMAT) if first else None), (day(str(last)[:10]) if last else None)
+
+
+def clip_window(oldest_date, newest_date, first=None, last=None):
+    """The part of the ATP window (DAY_FORMAT strings) from first up to last."""
+    return max(oldest_date, first or oldest_date), min(newest_date, last or newest_date)
+
+
+def keys_between(first, last, *key_sets):
+    """The ledger keys of key_sets from first up to and including last."""
+    return {key for keys in key_sets for key in keys if first <= key <= last}
+
+
+def add_ledger_arguments(parser):
+    parser.add_argument("--verify", action="store_true", help="Fetch and reconcile the full ATP window (or the --from/--to range) and rebuild the sync ledger.")
+    return parser
+
+
+def add_range_arguments(parser):
+    parser.add_argument("--from", dest="first", type=day, metavar="YYYY-MM-DD", help="Only sync the weeks from the week of this day on (default: Start_ATP).")
+    end = parser.add_mutually_exclusive_group()
+    end.add_argument("--to", dest="last", type=day, metavar="YYYY-MM-DD", help="Only sync the weeks that start on or before this day (default: End_ATP).")
+    end.add_argument("--weeks", type=int, help="Only sync this many weeks, from the week of --from or else the current week.")
+    return parser
+
+
+class Ledger:
+    def __init__(self, cache_dir, workbook_path, athlete_id, stage):
+        workbook = os.path.splitext(os.path.basename(workbook_path))[0]
+        self.path = os.path.join(cache_dir, f"ledger_{workbook}_{athlete_id}_{stage}.json")
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Ignoring unreadable ledger {self.path}: {e}")
+
+    def changed(self, fingerprints, first=None, last=None):
+        """Keys whose fingerprint differs from the ledger, plus ledger keys (between first and last) that are gone."""
+        keys = {key for key, value in fingerprints.items() if self.entries.get(key, {}).get("fingerprint") != value}
+        keys |= {
+            key for key in self.entries
+            if key not in fingerprints and (first is None or key >= first) and (last is None or key <= last)
+        }
+        return keys
+
+    def until(self, key):
+        """Last day the recorded events of key cover, if the stage recorded one."""
+        return self.entries.get(key, {}).get("until")
+
+    def update(self, desired, actual, keys=None, event_ids=None, until=None):
+        """Record the keys whose server state now matches what was desired; forget the others.
+
+        desired and actual map keys to fingerprints. keys limits the update to
+        the keys that were synced (None means all of them).
+        """
+        event_ids = event_ids or {}
+        until = until or {}
+        keys = set(desired) | set(actual) | set(self.entries) if keys is None else keys
+        in_sync = 0
+        for key in keys:
+            if key in desired and desired[key] == actual.get(key):
+                entry = {"fingerprint": desired[key], "events": event_ids.get(key, {})}
+                if key in until:
+                    entry["until"] = until[key]
+                self.entries[key] = entry
+                in_sync += 1
+            else:
+                # Retried on the next run: either gone from the plan or not (fully) written
+                self.entries.pop(key, None)
+        return in_sync
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,182 @@
+"""
+Lightweight run metrics for the ATP scripts.
+
+Collects phase timers (workbook load, fetch, diff, write, export), HTTP call
+counters per method/status, retries, sleep seconds and bytes sent/received.
+A summary is logged when the script exits. Set ATP_METRICS_JSON and/or
+ATP_METRICS_PROM to a file or directory to also export the run as JSON or as
+a Prometheus textfile (for the node_exporter textfile collector).
+"""
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None when the platform can't tell."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # Linux reports KiB
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def _stage_name():
+    script = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "interactive"
+    return os.path.splitext(script)[0] or "interactive"
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.labels = {"stage": _stage_name()}
+        self.timers = {}
+        self.counters = {}
+        self.http = {}
+        self.gauges = {}
+
+    @contextmanager
+    def timer(self, name):
+        """Time a phase of the run; nested and repeated phases add up."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, {"count": 0, "seconds": 0.0})
+            timer["count"] += 1
+            timer["seconds"] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def record_http(self, method, status, bytes_sent=0, bytes_received=0, seconds=0.0):
+        with self.lock:
+            key = (method.upper(), str(status))
+            self.http[key] = self.http.get(key, 0) + 1
+            self.counters["http_bytes_sent"] = self.counters.get("http_bytes_sent", 0) + bytes_sent
+            self.counters["http_bytes_received"] = self.counters.get("http_bytes_received", 0) + bytes_received
+            timer = self.timers.setdefault("http", {"count": 0, "seconds": 0.0})
+            timer["count"] += 1
+            timer["seconds"] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "labels": dict(self.labels),
+                "started": self.started,
+                "duration_s": round(time.time() - self.started, 3),
+                "timers": {k: {"count": v["count"], "seconds": round(v["seconds"], 4)} for k, v in self.timers.items()},
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "http": [{"method": m, "status": s, "count": c} for (m, s), c in sorted(self.http.items())],
+            }
+
+    def summary_lines(self):
+        snap = self.snapshot()
+        lines = [f"Run summary for {snap['labels'].get('stage')} ({snap['duration_s']}s total)"]
+        for name, timer in sorted(snap["timers"].items()):
+            lines.append(f"  {name:<16} {timer['seconds']:>9.3f}s in {timer['count']} step(s)")
+        for entry in snap["http"]:
+            lines.append(f"  HTTP {entry['method']:<6} {entry['status']:<4} x{entry['count']}")
+        for name, value in sorted(snap["counters"].items()):
+            lines.append(f"  {name:<24} {round(value, 3)}")
+        for name, value in sorted(snap["gauges"].items()):
+            lines.append(f"  {name:<24} {value}")
+        return lines
+
+    def prometheus_text(self):
+        snap = self.snapshot()
+        base = ",".join(f'{k}="{v}"' for k, v in sorted(snap["labels"].items()))
+        lines = [
+            "# TYPE atp_run_duration_seconds gauge",
+            f"atp_run_duration_seconds{{{base}}} {snap['duration_s']}",
+            "# TYPE atp_phase_seconds gauge",
+        ]
+        for name, timer in sorted(snap["timers"].items()):
+            lines.append(f'atp_phase_seconds{{{base},phase="{name}"}} {timer["seconds"]}')
+        lines.append("# TYPE atp_http_requests_total counter")
+        for entry in snap["http"]:
+            lines.append(f'atp_http_requests_total{{{base},method="{entry["method"]}",status="{entry["status"]}"}} {entry["count"]}')
+        for name, value in sorted(snap["counters"].items()):
+            metric = f"atp_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{{{base}}} {value}")
+        for name, value in sorted(snap["gauges"].items()):
+            lines.append(f"# TYPE atp_{name} gauge")
+            lines.append(f"atp_{name}{{{base}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = RunMetrics()
+timer = metrics.timer
+
+
+def _export_path(target, extension):
+    """A directory gets one file per athlete and stage; anything else is used as the file name."""
+    if os.path.isdir(target):
+        athlete = metrics.labels.get("athlete", "athlete")
+        return os.path.join(target, f"atp_{athlete}_{metrics.labels['stage']}.{extension}")
+    return target
+
+
+def _write_atomic(path, text):
+    # The textfile collector may read at any moment, so never expose a half written file.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_reports():
+    peak = peak_rss_bytes()
+    if peak is not None:
+        metrics.gauge("peak_rss_bytes", peak)
+    for line in metrics.summary_lines():
+        logging.info(line)
+    json_target = os.environ.get("ATP_METRICS_JSON")
+    prom_target = os.environ.get("ATP_METRICS_PROM")
+    try:
+        if json_target:
+            _write_atomic(_export_path(json_target, "json"), json.dumps(metrics.snapshot(), indent=2))
+        if prom_target:
+            _write_atomic(_export_path(prom_target, "prom"), metrics.prometheus_text())
+    except OSError as e:
+        logging.error(f"Could not export run metrics: {e}")
+
+
+atexit.register(write_reports)
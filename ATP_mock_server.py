@@ -0,0 +1,350 @@
+"""
+Local stand-in for the intervals.icu endpoints used by the ATP scripts.
+
+Serves /profile, /eventsjson (and /events.json), event create/update/delete,
+/wellness and /activities for one or more athletes from memory. Latency and
+a simple rate limit are configurable so the benchmark can reproduce slow or
+throttled API behaviour without touching the live service. Reads carry an
+ETag and are answered with 304 when If-None-Match still matches.
+
+A FaultInjector makes it misbehave on purpose: log-normal latency, random 5xx
+answers, 429 storms and 503 outages in scripted time windows, connections
+dropped before a request is handled and writes that are applied but whose
+answer is lost. ATP_fault_scenarios runs the stages against named mixes of
+these.
+
+Run it standalone with:
+    python ATP_mock_server.py --port 8765 --latency 0.05
+and point the scripts to it with ATP_API_URL=http://127.0.0.1:8765/api/v1
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+ROUTE = re.compile(r"^/api/v1/athlete/(?P<athlete>[^/]+)/(?P<resource>[^/]+)(?:/(?P<event_id>[^/]+))?$")
+
+
+def _in_window(date_str, oldest, newest):
+    day = (date_str or "")[:10]
+    if oldest and day < oldest[:10]:
+        return False
+    if newest and day > newest[:10]:
+        return False
+    return True
+
+
+class MockIntervalsState:
+    """In-memory athlete data plus the traffic counters the benchmark reads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}
+        self.wellness = {}
+        self.activities = {}
+        self.profiles = {}
+        self.next_id = 1
+        self.created = []  # (athlete_id, event) of every event created through the API, answered or not
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.statuses = {}
+            self.bytes_received = 0  # request bodies sent by the client
+            self.bytes_sent = 0      # response bodies sent to the client
+
+    def stats(self):
+        with self.lock:
+            return {
+                "api_calls": sum(self.calls.values()),
+                "calls": dict(self.calls),
+                "statuses": dict(self.statuses),
+                "bytes_sent": self.bytes_received,
+                "bytes_received": self.bytes_sent,
+            }
+
+    def record(self, method, resource, status, bytes_in, bytes_out):
+        with self.lock:
+            key = f"{method} {resource}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+            self.bytes_received += bytes_in
+            self.bytes_sent += bytes_out
+
+    def set_profile(self, athlete_id, name):
+        self.profiles[athlete_id] = {"athlete": {"id": athlete_id, "name": name}}
+
+    def add_event(self, athlete_id, event):
+        with self.lock:
+            event = dict(event)
+            event["id"] = self.next_id
+            self.next_id += 1
+            self.events.setdefault(athlete_id, {})[event["id"]] = event
+            return event
+
+    def create_event(self, athlete_id, event):
+        """add_event for a POST of a client; the event is kept in the create log as well."""
+        event = self.add_event(athlete_id, event)
+        with self.lock:
+            self.created.append((athlete_id, event))
+        return event
+
+    def add_wellness(self, athlete_id, records):
+        self.wellness.setdefault(athlete_id, []).extend(records)
+
+    def add_activities(self, athlete_id, records):
+        self.activities.setdefault(athlete_id, []).extend(records)
+
+    def list_events(self, athlete_id, oldest, newest, categories):
+        with self.lock:
+            events = list(self.events.get(athlete_id, {}).values())
+        return [
+            e for e in events
+            if _in_window(e.get("start_date_local"), oldest, newest)
+            and (not categories or e.get("category") in categories)
+        ]
+
+
+class FaultInjector:
+    """Scripted faults of the stand-in, decided request by request (reproducible through seed).
+
+    latency_median, latency_sigma: log-normal latency added to every answer.
+    error_rate: share of requests answered with a 500, 502, 503 or 504.
+    drop_rate: share of connections closed before the request is handled.
+    drop_after_rate: share of writes (POST, PUT, DELETE) that are applied but get no answer.
+    throttle_windows, outage_windows: (start, end) seconds after start() in which every
+    request is answered 429 with a Retry-After up to the end of the window, or 503.
+    """
+
+    def __init__(self, latency_median=0.0, latency_sigma=0.0, error_rate=0.0, drop_rate=0.0, drop_after_rate=0.0,
+                 throttle_windows=(), outage_windows=(), seed=0):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.drop_after_rate = drop_after_rate
+        self.throttle_windows = list(throttle_windows)
+        self.outage_windows = list(outage_windows)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        """Time zero of the throttle and outage windows."""
+        self.started = time.monotonic()
+
+    def latency(self):
+        if not self.latency_median:
+            return 0.0
+        with self.lock:
+            return self.random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+
+    def fault(self, method):
+        """What goes wrong with this request: None, ("status", code, headers), ("drop",) or ("drop_after",)."""
+        elapsed = time.monotonic() - self.started
+        for start, end in self.throttle_windows:
+            if start <= elapsed < end:
+                return ("status", 429, {"Retry-After": str(max(1, math.ceil(end - elapsed)))})
+        for start, end in self.outage_windows:
+            if start <= elapsed < end:
+                return ("status", 503, {})
+        with self.lock:
+            roll = self.random.random()
+            code = self.random.choice((500, 502, 503, 504))
+        if roll < self.drop_rate:
+            return ("drop",)
+        if roll < self.drop_rate + self.error_rate:
+            return ("status", code, {})
+        if method != "GET" and roll < self.drop_rate + self.error_rate + self.drop_after_rate:
+            return ("drop_after",)
+        return None
+
+
+class MockIntervalsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("mock: " + format, *args)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _drop(self, bytes_in, resource):
+        """Close the connection without an answer, as a reset or a proxy timeout would."""
+        self.close_connection = True
+        self.server.state.record(self.command, resource, "dropped", bytes_in, 0)
+
+    def _send(self, status, payload, bytes_in, resource, headers=None):
+        if self.drop_answer:
+            self._drop(bytes_in, resource)
+            return
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        headers = dict(headers or {})
+        if self.command == "GET" and status == 200:
+            headers["ETag"] = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                status, body = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.state.record(self.command, resource, status, bytes_in, len(body))
+
+    def _handle(self):
+        raw = self._body()
+        parsed = urlparse(self.path)
+        match = ROUTE.match(parsed.path)
+        resource = match.group("resource") if match else parsed.path
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.drop_answer = False
+        faults = self.server.faults
+        fault = None
+        if faults is not None:
+            time.sleep(faults.latency())
+            fault = faults.fault(self.command)
+        if fault and fault[0] == "drop":
+            self._drop(len(raw), resource)
+            return
+        if fault and fault[0] == "status":
+            self._send(fault[1], {"error": "Injected fault"}, len(raw), resource, fault[2])
+            return
+        self.drop_answer = bool(fault)  # ("drop_after",): handle the request, lose the answer
+        if self.server.is_rate_limited():
+            self._send(429, {"error": "Too Many Requests"}, len(raw), resource, {"Retry-After": "1"})
+            return
+        if not match:
+            self._send(404, {"error": "Not found"}, len(raw), resource)
+            return
+
+        state = self.server.state
+        athlete_id = match.group("athlete")
+        event_id = match.group("event_id")
+        query = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        oldest, newest = query.get("oldest"), query.get("newest")
+
+        if self.command == "GET" and resource == "profile":
+            profile = state.profiles.get(athlete_id)
+            self._send(200 if profile else 404, profile or {"error": "Unknown athlete"}, len(raw), resource)
+        elif self.command == "GET" and resource in ("eventsjson", "events.json", "events") and not event_id:
+            categories = set(filter(None, query.get("category", "").split(",")))
+            self._send(200, state.list_events(athlete_id, oldest, newest, categories), len(raw), resource)
+        elif self.command == "POST" and resource == "events":
+            event = state.create_event(athlete_id, json.loads(raw or b"{}"))
+            self._send(200, event, len(raw), resource)
+        elif self.command in ("PUT", "DELETE") and resource == "events" and event_id:
+            with state.lock:
+                events = state.events.get(athlete_id, {})
+                event = events.get(int(event_id)) if event_id.isdigit() else None
+                if event is not None and self.command == "PUT":
+                    event.update(json.loads(raw or b"{}"))
+                elif event is not None:
+                    del events[event["id"]]
+            if event is None:
+                self._send(404, {"error": "Event not found"}, len(raw), resource)
+            else:
+                self._send(200, event, len(raw), resource)
+        elif self.command == "GET" and resource == "wellness":
+            records = [w for w in state.wellness.get(athlete_id, []) if _in_window(w.get("id"), oldest, newest)]
+            self._send(200, records, len(raw), resource)
+        elif self.command == "GET" and resource == "activities":
+            records = [a for a in state.activities.get(athlete_id, []) if _in_window(a.get("start_date_local"), oldest, newest)]
+            self._send(200, records, len(raw), resource)
+        else:
+            self._send(404, {"error": "Not found"}, len(raw), resource)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class MockIntervalsServer(ThreadingHTTPServer):
+    """Threaded HTTP server with configurable latency and a sliding-window rate limit."""
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, rate_limit=None, rate_window=1.0, state=None, faults=None):
+        super().__init__((host, port), MockIntervalsHandler)
+        self.state = state or MockIntervalsState()
+        self.faults = faults
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self._hits = deque()
+        self._hits_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def is_rate_limited(self):
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        with self._hits_lock:
+            while self._hits and now - self._hits[0] > self.rate_window:
+                self._hits.popleft()
+            if len(self._hits) >= self.rate_limit:
+                return True
+            self._hits.append(now)
+        return False
+
+    def start(self):
+        if self.faults is not None:
+            self.faults.start()
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-intervals", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local intervals.icu stand-in for benchmarking the ATP scripts.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response.")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Max requests per window before answering 429.")
+    parser.add_argument("--rate-window", type=float, default=1.0, help="Rate limit window in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 5xx.")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Share of connections closed without an answer.")
+    parser.add_argument("--drop-after-rate", type=float, default=0.0, help="Share of writes applied without an answer.")
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="Log-normal spread around --latency (0: fixed latency).")
+    parser.add_argument("--athlete", default="i0", help="Athlete id to create a profile for.")
+    parser.add_argument("--name", default="Bench Athlete", help="Athlete name returned by /profile.")
+    args = parser.parse_args()
+
+    faults = None
+    if args.error_rate or args.drop_rate or args.drop_after_rate or args.latency_sigma:
+        faults = FaultInjector(args.latency if args.latency_sigma else 0.0, args.latency_sigma, args.error_rate, args.drop_rate, args.drop_after_rate)
+    server = MockIntervalsServer(args.host, args.port, 0.0 if args.latency_sigma else args.latency, args.rate_limit, args.rate_window, faults=faults)
+    server.state.set_profile(args.athlete, args.name)
+    logging.info(f"Mock intervals.icu listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(json.dumps(server.state.stats()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Typed week model of the ATP_Data sheet, shared by the note scripts.
+
+read_week_plan converts the sheet once, column by column, into a WeekPlan: a
+list of Week objects (a __slots__ dataclass per week) with plain Python
+values, so the note builders no longer need pd.isna, int(float(...)) and
+try/except on every cell of every row. Cells that can't be converted (text in
+a number column, an unreadable date) are collected in WeekPlan.problems and
+logged once, up front, with their row and column; they count as empty.
+
+Empty races are "" (the sheet uses "-", 0 or None for no race), the week in
+the period is None for unnumbered weeks and the focus columns are kept as
+(column, value) pairs of the focus items that are set.
+"""
+import bisect
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+
+import pandas as pd
+
+FOCUS_COLUMNS = [
+    'Weight Lifting', 'Aerobic Endurance', 'Muscular force', 'Speed Skills',
+    'Muscular Endurance', 'Anaerobic Endurance', 'Sprint Power'
+]
+NO_RACE = ("", "-", "0", "None", "nan")
+WEEK_FORMAT = "%Y-%m-%dT00:00:00"
+
+
+def year_week(day):
+    """ISO week key "YYYY-WW" of a date, as all stages key their weekly loads."""
+    year, week, _ = day.isocalendar()
+    return f"{year}-{week:02d}"
+
+
+def year_weeks(dates):
+    """year_week of every date in a datetime Series or DatetimeIndex, as a Series."""
+    iso = dates.isocalendar() if isinstance(dates, pd.DatetimeIndex) else dates.dt.isocalendar()
+    return (iso["year"].astype(str) + "-" + iso["week"].map("{:02d}".format)).rename("week")
+
+
+@dataclass(slots=True)
+class Week:
+    row: int  # Row of the sheet (Excel numbering), for messages
+    start: datetime
+    period: str
+    period_week: int | None
+    total_load: float | int | None  # Total_load_target; None when the sheet has no such column
+    test: str
+    focus: tuple
+    race: str
+    cat: str
+    race_date: datetime | None
+
+    @property
+    def start_date(self):
+        return self.start.strftime(WEEK_FORMAT)
+
+    @property
+    def iso_year(self):
+        return self.start.isocalendar()[0]
+
+    @property
+    def iso_week(self):
+        return self.start.isocalendar()[1]
+
+    @property
+    def year_week(self):
+        return year_week(self.start)
+
+
+class WeekPlan:
+    def __init__(self, weeks, problems=()):
+        self.weeks = list(weeks)
+        self.problems = list(problems)
+        # Position of the next week with a race, and the A races in date order
+        self.next_race = [None] * len(self.weeks)
+        following = None
+        for position in range(len(self.weeks) - 1, -1, -1):
+            self.next_race[position] = following
+            if self.weeks[position].race:
+                following = position
+        a_races = [week for week in self.weeks if week.cat == "A" and week.race]
+        self.a_race_starts = [week.start for week in a_races]
+        self.a_race_names = [week.race for week in a_races]
+
+    def __len__(self):
+        return len(self.weeks)
+
+    def __iter__(self):
+        return iter(self.weeks)
+
+    def between(self, first=None, last=None):
+        """The weeks starting from first up to and including last (None: no limit)."""
+        return WeekPlan(
+            [week for week in self.weeks if (first is None or week.start >= first) and (last is None or week.start <= last)],
+            self.problems,
+        )
+
+    def race_after(self, position):
+        """The first week after position with a race, or None."""
+        following = self.next_race[position]
+        return None if following is None else self.weeks[following]
+
+    def first_a_race_after(self, moment):
+        """Name of the first A race of a week that starts after moment, or None."""
+        index = bisect.bisect_right(self.a_race_starts, moment)
+        return self.a_race_names[index] if index < len(self.a_race_names) else None
+
+    def period_blocks(self):
+        """(first, last) positions of every run of consecutive weeks in the same period."""
+        blocks, first = [], 0
+        for position in range(1, len(self.weeks) + 1):
+            if position == len(self.weeks) or self.weeks[position].period != self.weeks[first].period:
+                blocks.append((first, position - 1))
+                first = position
+        return blocks
+
+    def load_by_year_week(self):
+        """Total_load_target per "YYYY-WW"."""
+        loads = {}
+        for week in self.weeks:
+            loads[week.year_week] = loads.get(week.year_week, 0) + (week.total_load or 0)
+        return loads
+
+
+def _text(values):
+    """Cell values as stripped strings; empty cells and 0 become ""."""
+    return [
+        "" if value is None or (isinstance(value, float) and pd.isna(value)) or (not isinstance(value, str) and value == 0) else str(value).strip()
+        for value in values
+    ]
+
+
+def _numbers(df, column, rows, problems):
+    """A numeric column as a list over rows (None where empty), noting the cells that hold something else."""
+    if column not in df.columns:
+        return None
+    raw = df[column]
+    numbers = pd.to_numeric(raw, errors="coerce")
+    bad = numbers.isna() & raw.notna() & ~raw.astype(str).str.strip().isin(["", "-"])
+    for index in raw.index[bad]:
+        problems.append(f"row {index + 2}, {column}: {raw[index]!r} is not a number")
+    return [None if pd.isna(value) else value for value in numbers[rows].tolist()]
+
+
+def read_week_plan(df, date_format=None):
+    """Validate and convert the ATP_Data rows of df into a WeekPlan, once."""
+    problems = []
+    df = df.reset_index(drop=True)  # Positions, so row + 2 is the Excel row
+    starts = pd.to_datetime(df['start_date_local'], format=date_format, errors='coerce')
+    for index in df.index[starts.isna() & df['start_date_local'].notna()]:
+        problems.append(f"row {index + 2}, start_date_local: {df.at[index, 'start_date_local']!r} is not a date")
+    rows = df.index[starts.notna()]
+
+    def text(name):
+        return _text(df.loc[rows, name].tolist()) if name in df.columns else [""] * len(rows)
+
+    period_weeks = _numbers(df, 'week', rows, problems) or [None] * len(rows)
+    total_loads = _numbers(df, 'Total_load_target', rows, problems)
+    focus = {name: _numbers(df, name, rows, problems) for name in FOCUS_COLUMNS if name in df.columns}
+    if 'race_date' in df.columns:
+        race_dates = pd.to_datetime(df.loc[rows, 'race_date'].where(~df.loc[rows, 'race_date'].astype(str).str.strip().isin(NO_RACE)), errors='coerce')
+        race_dates = [None if pd.isna(value) else value.to_pydatetime() for value in race_dates]
+    else:
+        race_dates = [None] * len(rows)
+
+    weeks = []
+    columns = zip(rows, starts[rows], text('period'), period_weeks, text('test'), text('race'), text('cat'), race_dates)
+    for position, (index, start, period, period_week, test, race, cat, race_date) in enumerate(columns):
+        weeks.append(Week(
+            row=index + 2,
+            start=start.to_pydatetime(),
+            period=period,
+            period_week=int(period_week) if period_week else None,  # 0 means no week number
+            total_load=None if total_loads is None else 0.0 if total_loads[position] is None else total_loads[position],
+            test=test,
+            focus=tuple((name, int(values[position])) for name, values in focus.items() if values[position] and int(values[position]) > 0),
+            race="" if race in NO_RACE else race,
+            cat=cat.upper(),
+            race_date=race_date,
+        ))
+    for problem in problems:
+        logging.warning(f"ATP_Data {problem}; treated as empty.")
+    return WeekPlan(weeks, problems)
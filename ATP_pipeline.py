@@ -0,0 +1,130 @@
+"""
+Run a full ATP publish for one athlete, with independent stages side by side.
+
+The stages declare what they need in STAGE_DEPENDENCIES: the targets, weekly
+notes, period notes and race export (1, 2, 3 and 6) write disjoint event sets
+and only read the workbook, so they start at once; the load check and the
+feedback notes (4 and 5) start as soon as the targets of 1_ATP_LOAD are in
+place. Every stage runs in its own thread on the shared HTTP session, whose
+rate limiter keeps the calls of all stages together within RATE_LIMIT_DELAY,
+so the wall time of a publish is that of the slowest branch instead of the sum
+of all stages. Reads and writes of the workbook are serialised by
+workbook_lock. When a stage fails, the stages that depend on it are skipped
+and the others finish.
+
+Example:
+    python ATP_pipeline.py --stages 1,2,3,4,5,6 --overwrite-past no
+"""
+import importlib
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ATP_common_config import *
+from ATP_daemon import STAGE_FUNCTIONS
+
+STAGE_DEPENDENCIES = {
+    "1_ATP_LOAD": [],
+    "2_ATP_NOTES": [],
+    "3_ATP_PERIOD_NOTE": [],
+    "6_RACES": [],
+    "4_LOAD_CHECK": ["1_ATP_LOAD"],
+    "5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES": ["1_ATP_LOAD"],
+}
+EXPORT_STAGES = ("4_LOAD_CHECK", "6_RACES")
+
+
+def stage_names(text):
+    """Stage modules for a comma separated list of stage numbers or names, in STAGE_DEPENDENCIES order."""
+    wanted = [part.strip() for part in text.split(",") if part.strip()]
+    names = [name for name in STAGE_DEPENDENCIES if name in wanted or name.split("_")[0] in wanted]
+    unknown = [part for part in wanted if not any(part in (name, name.split("_")[0]) for name in names)]
+    if unknown:
+        raise ValueError(f"Unknown stage(s): {', '.join(unknown)}")
+    return names
+
+
+def run_stage(name, function, kwargs):
+    threading.current_thread().name = name
+    try:
+        import pythoncom  # xlwings needs COM initialised in every thread on Windows
+        pythoncom.CoInitialize()
+    except ImportError:
+        pythoncom = None
+    started = time.perf_counter()
+    try:
+        function(**kwargs)
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.gauge(f"stage_seconds_{name.split('_')[0]}", round(seconds, 3))
+        logging.info(f"{name} finished in {seconds:.1f}s")
+        if pythoncom is not None:
+            pythoncom.CoUninitialize()
+
+
+def run_pipeline(stages, stage_kwargs=None, max_workers=None):
+    """Run the stages as soon as their dependencies succeeded; returns {stage: "ok" | "failed" | "skipped"}."""
+    stage_kwargs = stage_kwargs or {}
+    # Import one after the other: the stages read the workbook and settings when imported
+    modules = {name: importlib.import_module(name) for name in stages}
+    waiting = {name: [dep for dep in STAGE_DEPENDENCIES[name] if dep in stages] for name in stages}
+    outcome = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1) as executor:
+        while waiting or running:
+            for name in list(waiting):
+                deps = waiting[name]
+                if any(outcome.get(dep) in ("failed", "skipped") for dep in deps):
+                    logging.warning(f"Skipping {name}: {', '.join(dep for dep in deps if outcome.get(dep) != 'ok')} did not succeed.")
+                    outcome[name] = "skipped"
+                    del waiting[name]
+                elif all(outcome.get(dep) == "ok" for dep in deps):
+                    function_name, defaults = STAGE_FUNCTIONS[name]
+                    kwargs = dict(defaults, **stage_kwargs.get(name, {}))
+                    running[executor.submit(in_worker(run_stage), name, getattr(modules[name], function_name), kwargs)] = name
+                    del waiting[name]
+            if not running:
+                continue  # Everything left was skipped
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    outcome[name] = "ok"
+                except BaseException as e:  # SystemExit too: one failing stage must not stop the others
+                    logging.error(f"{name} failed: {type(e).__name__}: {e}", exc_info=not isinstance(e, SystemExit))
+                    outcome[name] = "failed"
+    return outcome
+
+
+def main(argv=None):
+    parser = add_range_arguments(add_export_arguments(stage_argument_parser("Run the ATP stages for one athlete, independent stages concurrently.")))
+    parser.add_argument("--stages", default=",".join(name.split("_")[0] for name in STAGE_DEPENDENCIES), help="Comma separated stages to run (default: all).")
+    parser.add_argument("--overwrite-past", choices=["yes", "no"], default="no", help="Overwrite the targets and period notes of weeks that have started (default: no).")
+    parser.add_argument("--workers", type=int, help="Number of stages that may run at the same time (default: all).")
+    args = parser.parse_args(argv)
+    logging.getLogger().handlers[0].setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - [%(threadName)s] %(message)s'))
+    stages = stage_names(args.stages)
+
+    range_kwargs = {"first": args.first, "last": args.last, "weeks": args.weeks}
+    stage_kwargs = {
+        "1_ATP_LOAD": dict(range_kwargs, overwrite_past=args.overwrite_past == "yes"),
+        "2_ATP_NOTES": range_kwargs,
+        "3_ATP_PERIOD_NOTE": dict(range_kwargs, overwrite_past=args.overwrite_past == "yes"),
+        "5_ATP_WEEKLY_LOAD_FEEDBACK_NOTES": range_kwargs,
+    }
+    exporter = open_exporter(args, athlete_TLA, ATP_year)
+    for name in EXPORT_STAGES:
+        stage_kwargs[name] = {"exporter": exporter, "excel": not args.no_excel}
+
+    started = time.perf_counter()
+    with profiled(args, "ATP_pipeline"):
+        outcome = run_pipeline(stages, stage_kwargs, args.workers)
+    logging.info(f"Pipeline finished in {time.perf_counter() - started:.1f}s: " + ", ".join(f"{name} {result}" for name, result in outcome.items()))
+    if any(result != "ok" for result in outcome.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Opt-in profiling for the ATP scripts.
+
+Run any script with --profile to capture a cProfile profile of the run plus
+tracemalloc peak memory and the top allocation sites. The .prof file (open
+it with snakeviz or pstats) and a readable .txt report are written to the
+profile directory, named after the athlete TLA, the stage and the start time.
+The report also sums the time per library, so a slow sync can be pinned on
+pandas, openpyxl, xlwings or the network at a glance.
+
+Before Python 3.12 cProfile only sees the thread it runs on, so the calls
+handed to the API pools (prefetch, run_concurrently) and the stage threads of
+ATP_pipeline are wrapped with in_worker and recorded by a profiler per thread,
+merged into the one profile at the end. From 3.12 on cProfile is built on
+sys.monitoring: the one profiler sees every thread and no second one can be
+enabled next to it, so in_worker leaves the calls as they are. ATP_common_config starts the recording when it is
+imported with --profile on the command line, so the reads a stage does at
+import (User_Data, the athlete profile) are in it as well; only the library imports
+at the top of ATP_common_config (pandas, requests, xlwings) are not.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime
+
+from ATP_metrics import metrics
+
+TOP_ENTRIES = 30
+TRACEMALLOC_FRAMES = 10
+PER_THREAD_PROFILERS = sys.version_info < (3, 12)  # sys.monitoring allows one profiler, which sees all threads
+
+# First match on the source path wins.
+LIBRARY_GROUPS = [
+    ("pandas", ("pandas", "numpy")),
+    ("openpyxl", ("openpyxl", "et_xmlfile")),
+    ("xlwings", ("xlwings", "win32com", "pythoncom", "appscript")),
+    ("network", ("requests", "urllib3", "http", "socket", "ssl", "json")),
+]
+STDLIB_DIR = os.path.dirname(os.__file__).replace("\\", "/")
+
+
+def _library_for(filename, function):
+    if filename == "~":  # Built-in functions have no source file
+        if "time.sleep" in function:
+            return "sleep"
+        if "socket" in function or "ssl" in function:
+            return "network"
+        return "builtins"
+    normalized = filename.replace("\\", "/")
+    for group, packages in LIBRARY_GROUPS:
+        if any(f"/{package}/" in normalized or normalized.endswith(f"/{package}.py") for package in packages):
+            return group
+    if "site-packages" in normalized:
+        return "other libraries"
+    if normalized.startswith(STDLIB_DIR):
+        return "standard library"
+    return "ATP scripts"
+
+
+def time_by_library(stats):
+    totals = {}
+    for (filename, _, function), (_, _, tottime, _, _) in stats.stats.items():
+        label = _library_for(filename, function)
+        totals[label] = totals.get(label, 0.0) + tottime
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def write_report(path, stats, peak, snapshot, stage):
+    stream = io.StringIO()
+    stats.stream = stream
+    stream.write(f"Profile of {stage} for athlete {metrics.labels.get('athlete')}\n\n")
+    stream.write("Own time per library (all threads, so it can add up to more than the wall time):\n")
+    for label, seconds in time_by_library(stats):
+        stream.write(f"  {label:<16} {seconds:>9.3f}s\n")
+    stream.write(f"\nPeak traced memory: {peak / 1024 / 1024:.1f} MiB\n\nTop allocation sites:\n")
+    for stat in snapshot.statistics("lineno")[:TOP_ENTRIES]:
+        stream.write(f"  {stat}\n")
+    stream.write("\nTop functions by cumulative time:\n")
+    stats.sort_stats("cumulative").print_stats(TOP_ENTRIES)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(stream.getvalue())
+
+
+class Recording:
+    """cProfile profilers of the thread that started the recording and of the worker threads, plus tracemalloc."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workers = []
+        self.local = threading.local()
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def in_worker(self, function):
+        """function, recorded by a profiler of the thread it runs on."""
+        if not PER_THREAD_PROFILERS:
+            return function
+
+        @wraps(function)
+        def recorded(*args, **kwargs):
+            profiler = getattr(self.local, "profiler", None)
+            if profiler is None:
+                profiler = self.local.profiler = cProfile.Profile()
+                with self.lock:
+                    self.workers.append(profiler)
+            elif getattr(self.local, "running", False):  # Already recorded further up this thread
+                return function(*args, **kwargs)
+            self.local.running = True
+            profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.disable()
+                self.local.running = False
+        return recorded
+
+    def stop(self):
+        """(merged pstats.Stats, peak traced memory, tracemalloc snapshot) of the recording."""
+        self.profiler.disable()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        tracemalloc.stop()
+        stats = pstats.Stats(self.profiler)
+        with self.lock:
+            for profiler in self.workers:
+                stats.add(profiler)
+        return stats, peak, snapshot
+
+
+_recording = None
+
+
+def start_profile():
+    """Start recording before the script has parsed its arguments; profiled() picks the recording up."""
+    global _recording
+    if _recording is None:
+        _recording = Recording()
+    return _recording
+
+
+def in_worker(function):
+    """function, recorded on the thread of a pool it is handed to while a profile is recorded."""
+    recording = _recording
+    return function if recording is None else recording.in_worker(function)
+
+
+@contextmanager
+def profiled(args, stage):
+    """Profile the enclosed block when the script was started with --profile."""
+    global _recording
+    if not getattr(args, "profile", False):
+        yield
+        return
+    output_dir = args.profile_dir
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    base = os.path.join(output_dir, f"{metrics.labels.get('athlete', 'athlete')}_{stage}_{stamp}")
+
+    recording = start_profile()
+    try:
+        yield
+    finally:
+        _recording = None
+        stats, peak, snapshot = recording.stop()
+        stats.dump_stats(f"{base}.prof")
+        write_report(f"{base}.txt", stats, peak, snapshot, stage)
+        metrics.gauge("peak_traced_memory_bytes", peak)
+        logging.info(f"Profile written to {base}.prof and {base}.txt (peak traced memory {peak / 1024 / 1024:.1f} MiB)")
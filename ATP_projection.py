@@ -0,0 +1,181 @@
+"""
+What-if fitness projection for the planned ATP.
+
+Spreads the planned Total_load_target of every week over its days and runs the
+CTL/ATL/TSB model of ATP_fitness over the whole plan. Variants of the plan are
+simulated together as one 2D batch (one row per scenario):
+
+    plan                the workbook as it is
+    scale_<x>           every week scaled by x (--scales)
+    missed_<week>       one week without training, for every week of the plan
+    taper_<n>w_<x>      the n weeks up to each A race scaled by x (--taper-weeks, --taper-levels)
+
+For every scenario it reports CTL, ATL and TSB on each race day and CTL and
+TSB at the end of every week, in a separate workbook next to the ATP
+workbook (the ATP workbook itself is not touched).
+
+Example:
+    python ATP_projection.py --scales 0.8,0.9,1.1 --taper-weeks 1,2 --taper-levels 0.5,0.7
+"""
+import time
+
+import numpy as np
+
+from ATP_common_config import *
+from ATP_fitness import fitness_model
+
+DAY_WEIGHTS = (0.0, 1.0, 1.2, 0.8, 1.0, 1.6, 1.8)  # Monday (rest day) .. Sunday (long sessions)
+
+
+def float_list(text):
+    return [float(value) for value in text.split(",") if value.strip()]
+
+
+def int_list(text):
+    return [int(value) for value in text.split(",") if value.strip()]
+
+
+def read_plan(path):
+    """Planned weeks (sorted by start date) and the races in them."""
+    with timer("workbook_load"):
+        df = pd.read_excel(path, sheet_name=ATP_sheet_name)
+    df['start_date_local'] = pd.to_datetime(df['start_date_local'], errors='coerce')
+    df = df.dropna(subset=['start_date_local']).sort_values('start_date_local').reset_index(drop=True)
+    df['Total_load_target'] = pd.to_numeric(df['Total_load_target'], errors='coerce').fillna(0)
+    # Weeks without a race hold '-' in the race columns
+    df['race_date'] = pd.to_datetime(df['race_date'].where(df['race_date'].astype(str).str.strip() != '-'), errors='coerce')
+    races = df[df['race'].astype(str).str.strip().ne('-') & df['race_date'].notna()][['race', 'cat', 'race_date']]
+    return df, races.reset_index(drop=True)
+
+
+def weekly_plan(df):
+    """Planned load of every week from the first to the last planned week (weeks missing from the sheet count as 0)."""
+    first_day = df['start_date_local'].iloc[0]
+    offsets = ((df['start_date_local'] - first_day).dt.days // 7).to_numpy()
+    loads = np.bincount(offsets, weights=df['Total_load_target'].to_numpy(), minlength=offsets.max() + 1)
+    return pd.Series(loads, index=pd.date_range(first_day, periods=len(loads), freq="7D"))
+
+
+def build_scenarios(weeks, race_weeks_a, scales=(), taper_weeks=(), taper_levels=(), missed_weeks=True):
+    """Scenario names and a (scenarios, weeks) matrix of multipliers for the planned weekly loads."""
+    names = ["plan"]
+    rows = [np.ones(weeks)]
+    for scale in scales:
+        names.append(f"scale_{scale:g}")
+        rows.append(np.full(weeks, scale))
+    if missed_weeks:
+        missed = 1.0 - np.eye(weeks)
+        names.extend(f"missed_{week + 1}" for week in range(weeks))
+        rows.extend(missed)
+    for length in taper_weeks:
+        for level in taper_levels:
+            multipliers = np.ones(weeks)
+            for race_week in race_weeks_a:
+                multipliers[max(race_week - length + 1, 0):race_week + 1] = level
+            names.append(f"taper_{length}w_{level:g}")
+            rows.append(multipliers)
+    return names, np.vstack(rows)
+
+
+def daily_loads(weekly_loads, multipliers, day_weights=DAY_WEIGHTS):
+    """(scenarios, days) loads: each scenario's weekly loads spread over the days with day_weights."""
+    weights = np.asarray(day_weights, dtype=float)
+    weights = weights / weights.sum()
+    per_week = multipliers * np.asarray(weekly_loads, dtype=float)  # (scenarios, weeks)
+    return (per_week[:, :, None] * weights).reshape(len(multipliers), -1)
+
+
+def starting_fitness(first_day):
+    """CTL and ATL on the day before the plan, from the activities cached by ActivityStore, else zero."""
+    activities = ActivityStore(ATP_cache_dir, athlete_id).table
+    activities = activities[activities["date"] < first_day]
+    if activities.empty:
+        return 0.0, 0.0
+    fitness = fitness_frame(daily_load_series(activities, activities["date"].min(), first_day - timedelta(days=1), date_key="date"))
+    return float(fitness["ctl"].iloc[-1]), float(fitness["atl"].iloc[-1])
+
+
+@timer("diff")
+def project(plan, races, names, multipliers, initial_ctl, initial_atl, day_weights=DAY_WEIGHTS):
+    """Summary, race-day and weekly results of every scenario as DataFrames; plan comes from weekly_plan."""
+    loads = daily_loads(plan.to_numpy(), multipliers, day_weights)
+    ctl, atl, tsb = fitness_model(loads, initial_ctl, initial_atl)
+    first_day = plan.index[0]
+
+    race_rows = []
+    for race in races.itertuples(index=False):
+        day = (race.race_date - first_day).days
+        if not 0 <= day < loads.shape[1]:
+            continue
+        # Fitness on race morning: the model value of the day before
+        index = day - 1
+        for scenario, name in enumerate(names):
+            race_rows.append({
+                "scenario": name, "race": race.race, "cat": race.cat, "race_date": race.race_date.date(),
+                "CTL": round(ctl[scenario, index] if index >= 0 else initial_ctl, 1),
+                "ATL": round(atl[scenario, index] if index >= 0 else initial_atl, 1),
+                "TSB": round(tsb[scenario, index] if index >= 0 else initial_ctl - initial_atl, 1),
+            })
+
+    week_ends = np.arange(6, loads.shape[1], 7)
+    weeks = plan.index.date
+    weekly_ctl = pd.DataFrame(ctl[:, week_ends].T.round(1), index=weeks, columns=names)
+    weekly_tsb = pd.DataFrame(tsb[:, week_ends].T.round(1), index=weeks, columns=names)
+    summary = pd.DataFrame({
+        "scenario": names,
+        "total_load": loads.sum(axis=1).round(),
+        "peak_CTL": ctl.max(axis=1).round(1),
+        "lowest_TSB": tsb.min(axis=1).round(1),
+        "final_CTL": ctl[:, -1].round(1),
+    })
+    return summary, pd.DataFrame(race_rows), weekly_ctl, weekly_tsb
+
+
+@timer("export")
+def write_projection(path, summary, race_results, weekly_ctl, weekly_tsb):
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        summary.to_excel(writer, sheet_name="Scenarios", index=False)
+        race_results.to_excel(writer, sheet_name="Races", index=False)
+        weekly_ctl.rename_axis("week").to_excel(writer, sheet_name="Weekly_CTL")
+        weekly_tsb.rename_axis("week").to_excel(writer, sheet_name="Weekly_TSB")
+    logging.info(f"Wrote the projection to {path}")
+
+
+def main(argv=None):
+    parser = stage_argument_parser("Project CTL/ATL/TSB of the planned ATP for a batch of what-if scenarios.")
+    parser.add_argument("--scales", type=float_list, default=[0.8, 0.9, 1.1, 1.2], help="Comma separated load scale factors.")
+    parser.add_argument("--taper-weeks", type=int_list, default=[1, 2, 3], help="Comma separated taper lengths in weeks before A races.")
+    parser.add_argument("--taper-levels", type=float_list, default=[0.4, 0.6, 0.8], help="Comma separated load factors during the taper.")
+    parser.add_argument("--no-missed-weeks", action="store_true", help="Skip the scenarios with one missed week.")
+    parser.add_argument("--initial-ctl", type=float, help="CTL on the day before the ATP (default: from the cached activity loads, else 0).")
+    parser.add_argument("--initial-atl", type=float, help="ATL on the day before the ATP (default: from the cached activity loads, else 0).")
+    parser.add_argument("--output", help="Output workbook (default: ATP_projection_<TLA>_<year>.xlsx next to the ATP workbook).")
+    args = parser.parse_args(argv)
+    output = args.output or os.path.join(os.path.dirname(ATP_file_path), f"ATP_projection_{athlete_TLA}_{ATP_year}.xlsx")
+
+    with profiled(args, "ATP_projection"):
+        df, races = read_plan(ATP_file_path)
+        if df.empty:
+            logging.error("No planned weeks in the ATP workbook.")
+            return
+        plan = weekly_plan(df)
+        first_day = plan.index[0]
+        cached_ctl, cached_atl = starting_fitness(first_day)
+        initial_ctl = cached_ctl if args.initial_ctl is None else args.initial_ctl
+        initial_atl = cached_atl if args.initial_atl is None else args.initial_atl
+
+        race_weeks_a = [
+            (race.race_date - first_day).days // 7 for race in races.itertuples(index=False)
+            if str(race.cat).strip().upper() == "A" and 0 <= (race.race_date - first_day).days < 7 * len(plan)
+        ]
+        names, multipliers = build_scenarios(
+            len(plan), race_weeks_a, args.scales, args.taper_weeks, args.taper_levels, not args.no_missed_weeks
+        )
+        started = time.perf_counter()
+        results = project(plan, races, names, multipliers, initial_ctl, initial_atl)
+        logging.info(f"Simulated {len(names)} scenario(s) of {len(plan)} weeks in {time.perf_counter() - started:.3f}s")
+        write_projection(output, *results)
+
+
+if __name__ == "__main__":
+    main()
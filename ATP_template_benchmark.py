@@ -0,0 +1,254 @@
+"""
+Benchmark of the weekly note templates (ATP_templates) against the builders
+they replaced.
+
+The legacy builders below are the add_*_description functions 2_ATP_NOTES
+used to chain per week, kept as the reference: every run checks that the
+default templates still give exactly the same notes. The ATP_Data rows of
+--athletes synthetic athletes (ATP_workbook_generator, every other one with
+numbered Peak, Race and Trans blocks) are built once; then
+the notes of all their weeks are built --repeat times week by week with the
+legacy builders, and rendered in one batch with the templates (including the
+conversion of the week plans to columns). The best time of each is printed
+and appended to --output as a JSON line.
+
+Example:
+    python ATP_template_benchmark.py --athletes 30 --seasons 3
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from ATP_model import read_week_plan
+from ATP_templates import load_note_templates, render_week_notes, week_note_columns
+from ATP_workbook_generator import ACTIVITY_TYPES, build_atp_rows, monday_on_or_before
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+ATHLETE = "Athlete"
+DO_AT_REST = "Do nothing!"
+FOOTER = "\n---\n *made with the ATP_common_config.py script / From coach CozyCoach*"
+NUMBERED_PERIODS = {"Peak": "Peak 2", "Race": "Race 2", "Trans": "Trans 2"}
+
+
+# --- Legacy builders, as in 2_ATP_NOTES before ATP_templates ---
+
+def format_focus_items_notes(focus_items_notes):
+    if len(focus_items_notes) > 1:
+        return ', '.join(focus_items_notes[:-1]) + ' and ' + focus_items_notes[-1]
+    return ''.join(focus_items_notes)
+
+def populate_description(description, first_a_event):
+    if not description:
+        description = "Nothing to mention this week."
+    if first_a_event:
+        description = f"- This (part) of the plan aims for **{first_a_event}**.\n\n" + description
+    description = f"Hi **{ATHLETE}**, here is your weekly ATP summary:\n\n" + description
+    description += FOOTER
+    return description
+
+def add_period_description(atp_week, description):
+    period = atp_week.period
+    if period:
+        period_name = handle_period_name(period)
+        # The 'week' column of ATP_Data adds contextual info about the week in the period (None: no week number).
+        week_int = atp_week.period_week
+
+        # The aimed weekly load from the 'Total_load_target' column.
+        weekly_target_val = None if atp_week.total_load is None else int(round(atp_week.total_load))
+
+        # Special meaning_core for Race and Transition periods
+        if period_name == "Race":
+            default_meaning_core = "a focus on the upcoming race, where we prioritise tapering, sharpening and optimal rest to peak for competition"
+        elif period_name == "Transition":
+            default_meaning_core = "a **more easy period**, focused on recovery and consolidating training adaptations"
+        elif period_name == "Peak":
+            default_meaning_core = "a **Peak period**  focused on balancing load and recovery to achieve optimal race readiness (generally 1–2 weeks before the event)."        
+        else:
+            default_meaning_core = None
+
+        if week_int is not None:
+            # If special period types, use their default core meaning regardless of week number
+            if default_meaning_core:
+                meaning_core = default_meaning_core
+            else:
+                if week_int == 1:
+                    meaning_core = "the **start week** op de trainingperiod, where we"
+                elif week_int == 2:
+                    meaning_core = "the **second week** op de trainingperiod, where we"
+                elif week_int == 3:
+                    meaning_core = "the **third week** op de trainingperiod, where we"
+                elif week_int == 4:
+                    meaning_core = "we ease a bit, so we just"
+                else:
+                    meaning_core = f"week {week_int} of the period"
+
+            if weekly_target_val is not None:
+                meaning = f"{meaning_core} aim for a TSS of **{weekly_target_val}**"
+            else:
+                meaning = meaning_core
+
+            description += f"- This is **week {week_int}** of the **{period_name}** period, which means {meaning}.\n\n"
+        else:
+            # No week number (or zero) — different sentence form requested
+            if default_meaning_core:
+                meaning_core = default_meaning_core
+            else:
+                meaning_core = f"the **{period_name}** period"
+
+            if weekly_target_val is not None:
+                meaning = f"{meaning_core} where we aim for a TSS of **{weekly_target_val}**"
+            else:
+                meaning = meaning_core
+
+            description += f"- This is **the {period_name} period**, which means {meaning}.\n\n"
+
+        if period == "Rest":
+            description += f"**{DO_AT_REST}**\n\n"
+    return description
+
+def add_test_description(atp_week, description):
+    test = atp_week.test
+    if test:
+        description += f"- Do the following test(s) this week: **{test}**.\n\n"
+    return description
+
+def add_focus_description(atp_week, description):
+    additional_focus = sorted(atp_week.focus, key=lambda x: x[1])
+    if additional_focus:
+        formatted_focus = format_focus_items_notes([col for col, _ in additional_focus])
+        description += f"- Focus on **{formatted_focus}**.\n\n"
+    elif description.strip():
+        description += "- You don't have to focus on specific workouts this week.\n\n"
+    return description
+
+def add_race_focus_description(atp_week, description):
+    race_cat = atp_week.cat
+    race_name = atp_week.race
+    if race_cat == 'A' and race_name:
+        description += f"- **{race_name}** is your main-goal! This is your **{race_cat}-event**, so primarily focus on this race.\n\n"
+    elif race_cat == 'B' and race_name:
+        description += f"- Use the **{race_name}** to learn and improve skills.\n\n"
+    elif race_cat == 'C' and race_name:
+        description += f"- Use the **{race_name}** as a hard effort training or just having fun!\n\n"
+    return description
+
+def add_next_race_description(position, plan, week, description):
+    next_race = plan.race_after(position)
+    if next_race is not None and next_race.race_date is not None:
+        next_race_month = next_race.race_date.strftime("%B")
+        next_race_week = next_race.race_date.isocalendar()[1]
+        next_race_day = next_race.race_date.strftime("%A")
+        next_race_dayofmonth = next_race.race_date.day
+        next_race_name = next_race.race
+        next_race_cat = next_race.cat
+        weeks_to_go = next_race_week - week
+        if weeks_to_go == 1:
+            description += f"- Upcoming race: **{next_race_name}** (a **{next_race_cat}**-event) next week on {next_race_day} {next_race_dayofmonth} {next_race_month}.\n\n "
+        if weeks_to_go > 1:
+            description += f"- Upcoming race: **{next_race_name}** (a **{next_race_cat}**-event) within **{weeks_to_go}** weeks on {next_race_day} {next_race_dayofmonth} {next_race_month}.\n\n "
+    return description
+
+def handle_period_name(period):
+    period = period.strip()
+    if period == "Trans":
+        return "Transition"
+    elif period == "Prep":
+        return "Preparation"
+    elif period and not period[-1].isdigit():
+        return period.strip()
+    return period
+
+
+def legacy_description(position, plan):
+    atp_week = plan.weeks[position]
+    week = atp_week.iso_week
+    first_a_event = plan.first_a_race_after(atp_week.start)
+    description = ""
+    description = add_period_description(atp_week, description)
+    description = add_test_description(atp_week, description)
+    description = add_focus_description(atp_week, description)
+    race_focus_description = add_race_focus_description(atp_week, description)
+    if race_focus_description == description:
+        description = add_next_race_description(position, plan, week, description)
+    else:
+        description = race_focus_description
+    return populate_description(description, first_a_event)
+
+
+def benchmark_rows(start_date, seasons, race_density, seed):
+    """ATP_Data rows of one synthetic athlete; odd seeds number their Peak, Race and Trans blocks."""
+    rows = build_atp_rows(start_date, seasons, ACTIVITY_TYPES[:3], race_density, seed=seed)
+    if seed % 2:
+        for row in rows:
+            row["period"] = NUMBERED_PERIODS.get(row["period"], row["period"])
+    return rows
+
+
+def best_of(repeat, function):
+    """(best seconds, result) of repeat calls of function."""
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the weekly note templates against the legacy note builders.")
+    parser.add_argument("--athletes", type=int, default=30, help="Synthetic athletes rendered in one batch.")
+    parser.add_argument("--seasons", type=int, default=3, help="Seasons per synthetic athlete.")
+    parser.add_argument("--race-density", type=int, default=6, help="Races per season.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each; the best time counts.")
+    parser.add_argument("--output", default="template_bench_results.jsonl", help="JSON lines file the results are appended to.")
+    args = parser.parse_args()
+
+    start_date = monday_on_or_before(datetime.now())
+    plans = [
+        read_week_plan(pd.DataFrame(benchmark_rows(start_date, args.seasons, args.race_density, n)))
+        for n in range(args.athletes)
+    ]
+    weeks = sum(len(plan) for plan in plans)
+    templates = load_note_templates()
+
+    def legacy():
+        return [legacy_description(position, plan) for plan in plans for position in range(len(plan))]
+
+    def batch():
+        columns = {}
+        for plan in plans:
+            for field, values in week_note_columns(plan, range(len(plan)), ATHLETE, DO_AT_REST, FOOTER).items():
+                columns.setdefault(field, []).extend(values)
+        return render_week_notes(columns, templates)
+
+    legacy_seconds, expected = best_of(args.repeat, legacy)
+    template_seconds, rendered = best_of(args.repeat, batch)
+    different = sum(1 for old, new in zip(expected, rendered) if old != new) + abs(len(expected) - len(rendered))
+
+    result = {
+        "run_id": datetime.now().strftime("%Y%m%dT%H%M%S"),
+        "athletes": args.athletes,
+        "seasons": args.seasons,
+        "weeks": weeks,
+        "legacy_seconds": round(legacy_seconds, 4),
+        "template_seconds": round(template_seconds, 4),
+        "different_notes": different,
+    }
+    with open(args.output, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    print(f"{weeks} weeks of {args.athletes} athlete(s): legacy builders {legacy_seconds * 1000:.1f} ms, "
+          f"templates {template_seconds * 1000:.1f} ms ({legacy_seconds / template_seconds:.1f}x)")
+    if different:
+        print(f"{different} note(s) differ from the legacy builders")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+Templates of the weekly ATP notes, compiled once and rendered in batch.
+
+A weekly note is made of sections (greeting, period, test, focus, race, ...).
+Which sections a week gets and in what order is fixed in render_week_notes;
+the wording is in templates. A template is a str.format text with {field}
+placeholders (see FIELDS) and is selected per week by the period name and the
+week number in the period:
+
+    section         period      week  template
+    period_meaning  Race        *     a focus on the upcoming race, ...
+    period_meaning  *           1     the **start week** op de trainingperiod, where we
+    period_meaning  *           #     week {week} of the period
+
+period is a period name exactly as shown in the note (e.g. "Transition" or
+"Base 2", so "Race" doesn't match "Race 2") or *; week is a number, #
+(any number), - (no number) or *. The most specific template
+wins, the period before the week number, and a later template wins a tie.
+A section without a matching template is left out of the note.
+
+DEFAULT_TEMPLATES holds the standard wording. A coach can override or add
+templates in a CSV or JSON file named by ATP_NOTE_TEMPLATES (for all
+athletes) and in a Note_Templates sheet of the ATP workbook (for one
+athlete), with the columns section, period, week and template; "\\n" in a
+template is a line break.
+
+Templates are checked once, when loaded. The sections a kind of week gets
+(its period and week number, and whether it has a target, a test, focus
+items, a race, ...) are joined into one note template, which is parsed once
+per kind into a positional format string; rendering a week is a single
+str.format call. render_week_notes takes its inputs as columns (one list per
+field, one entry per week) and renders the weeks of a kind together, so the
+weeks of a whole plan, or of several athletes, are rendered in one call.
+"""
+import json
+import logging
+import string
+from operator import itemgetter
+
+import pandas as pd
+
+TEMPLATE_SHEET = "Note_Templates"
+ANY, NUMBERED, UNNUMBERED = "*", "#", "-"
+FIELDS = (
+    "athlete", "a_race", "period", "week", "tss", "meaning", "do_at_rest", "test", "focus", "race", "cat",
+    "next_race", "next_race_cat", "next_race_day", "next_race_dayofmonth", "next_race_month", "weeks_to_go", "footer",
+)
+SPECIAL_PERIODS = {
+    "Race": "a focus on the upcoming race, where we prioritise tapering, sharpening and optimal rest to peak for competition",
+    "Transition": "a **more easy period**, focused on recovery and consolidating training adaptations",
+    "Peak": "a **Peak period**  focused on balancing load and recovery to achieve optimal race readiness (generally 1–2 weeks before the event).",
+}
+DEFAULT_TEMPLATES = [
+    ("greeting", ANY, ANY, "Hi **{athlete}**, here is your weekly ATP summary:\n\n"),
+    ("a_race", ANY, ANY, "- This (part) of the plan aims for **{a_race}**.\n\n"),
+    ("period_meaning", ANY, 1, "the **start week** op de trainingperiod, where we"),
+    ("period_meaning", ANY, 2, "the **second week** op de trainingperiod, where we"),
+    ("period_meaning", ANY, 3, "the **third week** op de trainingperiod, where we"),
+    ("period_meaning", ANY, 4, "we ease a bit, so we just"),
+    ("period_meaning", ANY, NUMBERED, "week {week} of the period"),
+    ("period_meaning", ANY, UNNUMBERED, "the **{period}** period"),
+    *[("period_meaning", period, ANY, meaning) for period, meaning in SPECIAL_PERIODS.items()],
+    ("period_tss", ANY, NUMBERED, "{meaning} aim for a TSS of **{tss}**"),
+    ("period_tss", ANY, UNNUMBERED, "{meaning} where we aim for a TSS of **{tss}**"),
+    ("period", ANY, NUMBERED, "- This is **week {week}** of the **{period}** period, which means {meaning}.\n\n"),
+    ("period", ANY, UNNUMBERED, "- This is **the {period} period**, which means {meaning}.\n\n"),
+    ("rest", "Rest", ANY, "**{do_at_rest}**\n\n"),
+    ("test", ANY, ANY, "- Do the following test(s) this week: **{test}**.\n\n"),
+    ("focus", ANY, ANY, "- Focus on **{focus}**.\n\n"),
+    ("no_focus", ANY, ANY, "- You don't have to focus on specific workouts this week.\n\n"),
+    ("race_A", ANY, ANY, "- **{race}** is your main-goal! This is your **{cat}-event**, so primarily focus on this race.\n\n"),
+    ("race_B", ANY, ANY, "- Use the **{race}** to learn and improve skills.\n\n"),
+    ("race_C", ANY, ANY, "- Use the **{race}** as a hard effort training or just having fun!\n\n"),
+    ("next_race_next_week", ANY, ANY, "- Upcoming race: **{next_race}** (a **{next_race_cat}**-event) next week on {next_race_day} {next_race_dayofmonth} {next_race_month}.\n\n "),
+    ("next_race_later", ANY, ANY, "- Upcoming race: **{next_race}** (a **{next_race_cat}**-event) within **{weeks_to_go}** weeks on {next_race_day} {next_race_dayofmonth} {next_race_month}.\n\n "),
+    ("nothing", ANY, ANY, "Nothing to mention this week."),
+    ("footer", ANY, ANY, "{footer}"),
+]
+SECTIONS = tuple(dict.fromkeys(section for section, _, _, _ in DEFAULT_TEMPLATES))
+NO_NEXT_RACE = ("", "", "", "", "", None)
+
+
+class Template:
+    """A template parsed into a positional format string and the fields it fills in."""
+    __slots__ = ("text", "fields", "format")
+
+    def __init__(self, text):
+        pattern, fields = [], []
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            pattern.append(literal.replace("{", "{{").replace("}", "}}"))
+            if field is None:
+                continue
+            if field not in FIELDS:
+                raise ValueError(f"unknown field {{{field}}}")
+            if "{" in spec:
+                raise ValueError(f"nested field in {{{field}:{spec}}}")
+            pattern.append(f"{{{len(fields)}{'!' + conversion if conversion else ''}{':' + spec if spec else ''}}}")
+            fields.append(field)
+        self.text = text
+        self.fields = tuple(fields)
+        self.format = "".join(pattern).format
+
+
+def substitute(text, field, inner):
+    """Template text with the {field} placeholders replaced by the template text inner."""
+    pattern = []
+    for literal, name, spec, conversion in string.Formatter().parse(text):
+        pattern.append(literal.replace("{", "{{").replace("}", "}}"))
+        if name == field:
+            pattern.append(inner)
+        elif name is not None:
+            pattern.append(f"{{{name}{'!' + conversion if conversion else ''}{':' + spec if spec else ''}}}")
+    return "".join(pattern)
+
+
+def _period_score(template_period, period):
+    """How specifically template_period matches period; None when it doesn't."""
+    if template_period == ANY:
+        return 0
+    return 4 if template_period == period else None
+
+
+def _week_score(week, period_week):
+    """How specifically week (a template's week) matches period_week; None when it doesn't."""
+    if week == ANY:
+        return 0
+    if week == NUMBERED:
+        return 1 if period_week is not None else None
+    if week == UNNUMBERED:
+        return 1 if period_week is None else None
+    return 2 if week == period_week else None
+
+
+class NoteTemplates:
+    def __init__(self, entries=(), problems=()):
+        self.entries = {section: [] for section in SECTIONS}
+        for section, period, week, template in entries:
+            self.entries[section].append((period, week, template))
+        self.problems = list(problems)
+        self.selected = {}
+        self.notes = {}
+
+    def select(self, section, period, period_week):
+        """The template of section for a week of period with period_week (None: no number), or None."""
+        key = (section, period, period_week)
+        if key not in self.selected:
+            best, best_score = None, -1
+            for template_period, week, template in self.entries[section]:
+                period_score, week_score = _period_score(template_period, period), _week_score(week, period_week)
+                if period_score is None or week_score is None:
+                    continue
+                score = period_score + week_score
+                if score >= best_score:
+                    best, best_score = template, score
+            self.selected[key] = best
+        return self.selected[key]
+
+    def note(self, shape):
+        """The whole note for a kind of week (see note_shapes) as one Template, compiled on first use."""
+        if shape not in self.notes:
+            self.notes[shape] = Template(self.note_text(shape))
+        return self.notes[shape]
+
+    def note_text(self, shape):
+        period, period_week, tss, test, focus, cat, upcoming, a_race = shape
+
+        def text(section):
+            template = self.select(section, period, period_week)
+            return "" if template is None else template.text
+
+        body = ""
+        if period:
+            meaning = text("period_meaning")
+            if tss and text("period_tss"):
+                meaning = substitute(text("period_tss"), "meaning", meaning)
+            body += substitute(text("period"), "meaning", meaning) + text("rest")
+        if test:
+            body += text("test")
+        if focus:
+            body += text("focus")
+        elif body.strip():
+            body += text("no_focus")
+        race = text(f"race_{cat}") if cat else ""
+        if race:
+            body += race
+        elif upcoming:
+            body += text("next_race_next_week" if upcoming == 1 else "next_race_later")
+        if not body:
+            body = text("nothing")
+        return text("greeting") + (text("a_race") if a_race else "") + body + text("footer")
+
+
+def _week_key(value):
+    if value is None or (isinstance(value, float) and pd.isna(value)) or str(value).strip() in ("", ANY):
+        return ANY
+    value = str(value).strip()
+    if value in (NUMBERED, UNNUMBERED):
+        return value
+    return int(float(value))
+
+
+def template_rows(df, source):
+    """(section, period, week, text) rows of a template sheet or file, and the problems found in it."""
+    rows, problems = [], []
+    df = df.rename(columns=lambda name: str(name).strip().lower())
+    missing = {"section", "template"} - set(df.columns)
+    if missing:
+        return rows, [f"{source}: no column {', '.join(sorted(missing))}"]
+    for index, record in enumerate(df.to_dict("records")):
+        section = str(record.get("section") or "").strip()
+        text = record.get("template")
+        if not section or text is None or (isinstance(text, float) and pd.isna(text)):
+            continue
+        where = f"{source} row {index + 2}"
+        if section not in SECTIONS:
+            problems.append(f"{where}: unknown section {section!r}")
+            continue
+        period = record.get("period")
+        period = ANY if period is None or (isinstance(period, float) and pd.isna(period)) or not str(period).strip() else str(period).strip()
+        try:
+            week = _week_key(record.get("week"))
+        except ValueError:
+            problems.append(f"{where}: week {record.get('week')!r} is not a number, #, - or *")
+            continue
+        rows.append((section, period, week, str(text).replace("\\n", "\n")))
+    return rows, problems
+
+
+def read_template_file(path):
+    """Template rows of a CSV or JSON file (a list of objects with the same keys as the columns)."""
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            return pd.DataFrame(json.load(f))
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def load_note_templates(sheet=None, path=None):
+    """DEFAULT_TEMPLATES, overridden by the file at path and then by the Note_Templates sheet (a DataFrame)."""
+    rows, problems = [(section, period, week, text) for section, period, week, text in DEFAULT_TEMPLATES], []
+    sources = []
+    if path:
+        try:
+            sources.append((read_template_file(path), path))
+        except (OSError, ValueError) as e:
+            problems.append(f"{path}: {e}")
+    if sheet is not None:
+        sources.append((sheet, TEMPLATE_SHEET))
+    for df, source in sources:
+        source_rows, source_problems = template_rows(df, source)
+        rows += source_rows
+        problems += source_problems
+        logging.info(f"Loaded {len(source_rows)} note template(s) from {source}")
+
+    entries = []
+    for section, period, week, text in rows:
+        try:
+            entries.append((section, period, week, Template(text)))
+        except ValueError as e:
+            problems.append(f"{section} ({period}, {week}) {text!r}: {e}")
+    for problem in problems:
+        logging.warning(f"Note template {problem}; ignored.")
+    return NoteTemplates(entries, problems)
+
+
+def handle_period_name(period):
+    period = period.strip()
+    if period == "Trans":
+        return "Transition"
+    elif period == "Prep":
+        return "Preparation"
+    elif period and not period[-1].isdigit():
+        return period.strip()
+    return period
+
+
+def format_focus_items_notes(focus_items_notes):
+    if len(focus_items_notes) > 1:
+        return ', '.join(focus_items_notes[:-1]) + ' and ' + focus_items_notes[-1]
+    return ''.join(focus_items_notes)
+
+
+def week_note_columns(plan, positions, athlete, do_at_rest, footer):
+    """The fields of the weeks at positions of plan (an ATP_model.WeekPlan), one list per field."""
+    weeks = [plan.weeks[position] for position in positions]
+    period_names = {period: handle_period_name(period) if period else "" for period in {week.period for week in weeks}}
+    race_fields = {}  # Per race week: name, cat, day, day of month, month and ISO week of the race
+    next_races = []
+    for position in positions:
+        race = plan.race_after(position)
+        if race is None or race.race_date is None:
+            next_races.append(NO_NEXT_RACE)
+            continue
+        if race.row not in race_fields:
+            race_date = race.race_date
+            race_fields[race.row] = (race.race, race.cat, race_date.strftime("%A"), race_date.day, race_date.strftime("%B"), race_date.isocalendar()[1])
+        next_races.append(race_fields[race.row])
+    return {
+        "athlete": [athlete] * len(weeks),
+        "a_race": [plan.first_a_race_after(week.start) or "" for week in weeks],
+        "period": [period_names[week.period] for week in weeks],
+        "week": [week.period_week for week in weeks],
+        "tss": [None if week.total_load is None else int(round(week.total_load)) for week in weeks],
+        "do_at_rest": [do_at_rest] * len(weeks),
+        "test": [week.test for week in weeks],
+        "focus": [format_focus_items_notes([name for name, _ in sorted(week.focus, key=itemgetter(1))]) if week.focus else "" for week in weeks],
+        "race": [week.race for week in weeks],
+        "cat": [week.cat for week in weeks],
+        "next_race": [race[0] for race in next_races],
+        "next_race_cat": [race[1] for race in next_races],
+        "next_race_day": [race[2] for race in next_races],
+        "next_race_dayofmonth": [race[3] for race in next_races],
+        "next_race_month": [race[4] for race in next_races],
+        "weeks_to_go": [None if race is NO_NEXT_RACE else race[5] - week.iso_week for race, week in zip(next_races, weeks)],
+        "footer": [footer] * len(weeks),
+    }
+
+
+def note_shapes(columns):
+    """The kind of note of every week in columns: its period and week number, and which sections it gets."""
+    return list(zip(
+        columns["period"],
+        columns["week"],
+        [tss is not None for tss in columns["tss"]],
+        map(bool, columns["test"]),
+        map(bool, columns["focus"]),
+        [cat if race and cat in ("A", "B", "C") else "" for race, cat in zip(columns["race"], columns["cat"])],
+        [0 if weeks is None or weeks < 1 else 1 if weeks == 1 else 2 for weeks in columns["weeks_to_go"]],
+        map(bool, columns["a_race"]),
+    ))
+
+
+def render_week_notes(columns, templates):
+    """The note descriptions of the weeks in columns (see week_note_columns), rendered with templates."""
+    rows_by_shape = {}
+    for row, shape in enumerate(note_shapes(columns)):
+        rows_by_shape.setdefault(shape, []).append(row)
+    descriptions = [""] * len(columns["period"])
+    for shape, rows in rows_by_shape.items():
+        template = templates.note(shape)
+        pick = itemgetter(*rows)
+        values = [pick(columns[field]) for field in template.fields]
+        if len(rows) == 1:
+            values = [(value,) for value in values]
+        texts = map(template.format, *values) if values else [template.format()] * len(rows)
+        for row, text in zip(rows, texts):
+            descriptions[row] = text
+    return descriptions
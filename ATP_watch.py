@@ -0,0 +1,239 @@
+"""
+Watch mode: keep intervals.icu in step with the ATP workbook while it is being edited.
+
+Polls the workbook for saves and compares the ATP_Data, ATP_Conditions,
+User_Data and Note_Templates sheets with the previous snapshot, row by row.
+Only the weeks that changed are pushed: the TARGET events of 1_ATP_LOAD and
+the weekly NOTE events of 2_ATP_NOTES. The HTTP session and the existing
+events are kept between saves, so a one-cell change costs one read of the
+workbook and a single API call. A change to ATP_Conditions (the ATP window)
+triggers a full sync; a change to the note templates reloads them and renders
+all weekly notes again; a change to User_Data restarts the watcher so the new
+settings are picked up. The weeks a push got in step are recorded in the sync
+ledgers of 1_ATP_LOAD and 2_ATP_NOTES, so those stages don't push them again.
+
+Example:
+    python ATP_watch.py --interval 0.5
+"""
+import importlib
+import os
+import sys
+import time
+
+from ATP_common_config import *
+
+atp_load = importlib.import_module("1_ATP_LOAD")
+atp_notes = importlib.import_module("2_ATP_NOTES")
+
+WEEK_FORMAT = "%Y-%m-%dT00:00:00"
+# Columns that also feed the notes of other weeks (upcoming race, first A event)
+NOTE_CROSS_WEEK_COLUMNS = {"start_date_local", "race", "cat", "race_date"}
+
+
+def read_sheets(path):
+    """Read the watched sheets in one pass over the workbook; the template sheet is None when there is none."""
+    with pd.ExcelFile(path) as workbook:
+        sheets = [workbook.parse(name) for name in (ATP_sheet_name, ATP_sheet_Conditions, "User_Data")]
+        sheets.append(workbook.parse(TEMPLATE_SHEET) if TEMPLATE_SHEET in workbook.sheet_names else None)
+    return tuple(sheets)
+
+
+def same_sheet(old, new):
+    if old is None or new is None:
+        return old is new
+    return old.equals(new)
+
+
+def rows_by_week(df):
+    """ATP_Data rows as strings indexed by week start, or None when weeks are missing or duplicated."""
+    if "start_date_local" not in df.columns:
+        return None
+    weeks = pd.to_datetime(df["start_date_local"], errors="coerce")
+    rows = df[weeks.notna()].astype(str)
+    rows.index = weeks[weeks.notna()].dt.strftime(WEEK_FORMAT)
+    return None if rows.index.has_duplicates else rows
+
+
+def changed_weeks(old, new):
+    """Return the week starts whose row changed and the columns that changed.
+
+    The weeks are None when the sheet layout changed and every week has to be synced.
+    """
+    if list(old.columns) != list(new.columns):
+        return None, set(new.columns)
+    old_rows, new_rows = rows_by_week(old), rows_by_week(new)
+    if old_rows is None or new_rows is None:
+        return None, set(new.columns)
+    weeks = set(old_rows.index.symmetric_difference(new_rows.index))
+    columns = {"start_date_local"} if weeks else set()
+    common = old_rows.index.intersection(new_rows.index)
+    diff = old_rows.loc[common] != new_rows.loc[common]
+    weeks |= set(common[diff.any(axis=1).to_numpy()])
+    columns |= set(diff.columns[diff.any(axis=0).to_numpy()])
+    return weeks, columns
+
+
+class WorkbookWatcher:
+    def __init__(self, path, overwrite_past=False):
+        self.path = path
+        self.overwrite_past = overwrite_past
+        self.signature = None
+        self.sheets = None
+        self.oldest_date = self.newest_date = None
+        self.existing_events = EventIndex("start_type")
+        self.existing_notes = EventIndex("name")
+        self.unsynced = set()  # Weeks a push didn't get in step with intervals.icu; pushed again on the next save
+
+    def read_if_saved(self):
+        """Return the sheets when the workbook was saved since the last poll, else None."""
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            logging.warning(f"Cannot stat {self.path}: {e}")
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature:
+            return None
+        try:
+            with timer("workbook_load"):
+                sheets = read_sheets(self.path)
+        except Exception as e:
+            # Excel may still be writing the file; try again on the next poll
+            logging.warning(f"Workbook not readable yet: {e}")
+            return None
+        self.signature = signature
+        return sheets
+
+    def load_templates(self, template_sheet):
+        """Render the weekly notes with the templates of this save (and ATP_NOTE_TEMPLATES)."""
+        atp_notes.note_templates = load_note_templates(template_sheet, note_templates_path)
+
+    def full_sync(self, atp):
+        self.oldest_date, self.newest_date = atp_load.read_ATP_period(self.path)
+        self.existing_events = atp_load.get_existing_events(athlete_id, self.oldest_date, self.newest_date, username, api_key)
+        self.existing_notes = atp_notes.get_existing_note_events(
+            athlete_id, username, api_key, self.oldest_date, self.newest_date, note_name_prefix_ATP
+        )
+        return self.push(atp, None, None)
+
+    def target_weeks(self, weeks, desired_events):
+        """Weeks 1_ATP_LOAD may touch; past weeks are left alone unless overwrite_past is set."""
+        if self.overwrite_past:
+            return weeks
+        if weeks is None:
+            weeks = {key[0] for key in desired_events} | {key[0] for key in self.existing_events}
+        now = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        return {week for week in weeks if week >= now}
+
+    def push(self, atp, weeks, note_weeks):
+        """Push the TARGET events of weeks and the NOTE events of note_weeks (None means all).
+
+        The weeks that still differ from intervals.icu afterwards (a call that failed after its
+        retries is only logged) are kept in self.unsynced.
+        """
+        targets = atp_load.select_target_weeks(atp.copy(), self.oldest_date, self.newest_date, self.overwrite_past)
+        desired_events = atp_load.get_desired_events(targets)
+        target_weeks = self.target_weeks(weeks, desired_events)
+        atp_load.apply_event_changes(desired_events, self.existing_events, username, api_key, weeks=target_weeks)
+        desired, actual = atp_load.target_fingerprints(desired_events), atp_load.target_fingerprints(self.existing_events)
+        checked = target_weeks if target_weeks is not None else set(desired) | set(actual)
+        unsynced = {week for week in checked if desired.get(week) != actual.get(week)}
+        self.record("1_ATP_LOAD", desired, actual, checked, atp_load.target_event_ids(self.existing_events))
+
+        plan = atp_notes.select_note_weeks(atp, self.oldest_date, self.newest_date)
+        positions = [position for position, atp_week in enumerate(plan) if note_weeks is None or atp_week.start_date in note_weeks]
+        desired, actual, event_ids = {}, {}, {}
+        for note in atp_notes.build_week_notes(positions, plan):
+            atp_notes.push_week_note(note, self.existing_notes)
+            desired[note["start_date"]] = atp_notes.note_fingerprint(note)
+            existing_note = self.existing_notes.get(note["name"])
+            if existing_note is not None:
+                actual[note["start_date"]] = atp_notes.note_fingerprint(existing_note)
+                event_ids[note["start_date"]] = {note["name"]: existing_note["id"]}
+            if existing_note is None or existing_note["description"] != note["description"]:
+                unsynced.add(note["start_date"])
+        self.record("2_ATP_NOTES", desired, actual, set(desired), event_ids)
+        pushed_notes = len(positions)
+        self.unsynced = unsynced
+        if unsynced:
+            logging.warning(f"{len(unsynced)} week(s) not in step with intervals.icu; they are pushed again on the next save.")
+        pushed_targets = len(target_weeks) if target_weeks is not None else targets['start_date_local'].nunique()
+        return pushed_targets, pushed_notes
+
+    @staticmethod
+    def record(stage, desired, actual, weeks, event_ids):
+        """Record the pushed weeks in the sync ledger of stage, as its own run would."""
+        ledger = open_ledger(stage)
+        ledger.update(desired, actual, weeks, event_ids)
+        ledger.save()
+
+    def on_save(self, sheets):
+        """Sync a new save; the snapshot only moves on to it once the push got through."""
+        atp, conditions, user, templates = sheets
+        old_atp, old_conditions, old_user, old_templates = self.sheets
+        if not user.equals(old_user):
+            logging.info("User_Data changed; restarting the watcher to pick up the new settings.")
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        templates_changed = not same_sheet(old_templates, templates)
+        if templates_changed:
+            logging.info(f"{TEMPLATE_SHEET} changed; rendering all weekly notes again.")
+            self.load_templates(templates)
+        if not conditions.equals(old_conditions):
+            logging.info("ATP_Conditions changed; doing a full sync.")
+            pushed = self.full_sync(atp)
+        else:
+            weeks, columns = changed_weeks(old_atp, atp)
+            if weeks is not None:
+                weeks |= self.unsynced
+            if weeks is not None and not weeks and not templates_changed:
+                logging.info("Workbook saved without changes to the watched sheets.")
+                pushed = 0, 0
+            else:
+                note_weeks = None if templates_changed or weeks is None or columns & NOTE_CROSS_WEEK_COLUMNS else weeks
+                if weeks is None or weeks:
+                    logging.info(f"Changed week(s): {'all' if weeks is None else ', '.join(sorted(w[:10] for w in weeks))}")
+                pushed = self.push(atp, weeks, note_weeks)
+        # An exception above leaves the snapshot alone, so the next save is compared with the last synced one
+        self.sheets = sheets
+        return pushed
+
+    def run(self, interval):
+        logging.info(f"Initial sync of {self.path}")
+        while self.sheets is None:
+            self.sheets = self.read_if_saved()
+            if self.sheets is None:
+                time.sleep(interval)
+        self.load_templates(self.sheets[3])
+        self.full_sync(self.sheets[0])
+        logging.info(f"Watching {self.path} for changes (Ctrl+C to stop).")
+        try:
+            while True:
+                time.sleep(interval)
+                sheets = self.read_if_saved()
+                if sheets is None:
+                    continue
+                started = time.perf_counter()
+                try:
+                    target_weeks, note_weeks = self.on_save(sheets)
+                except Exception:
+                    # A half-finished edit should not end the session; the next save is compared with the last synced one
+                    logging.exception("Sync of the saved workbook failed; fix the workbook and save again.")
+                    continue
+                if target_weeks or note_weeks:
+                    logging.info(f"Synced {target_weeks} target week(s) and {note_weeks} note(s) in {time.perf_counter() - started:.2f}s")
+        except KeyboardInterrupt:
+            logging.info("Stopped watching.")
+
+
+def main(argv=None):
+    parser = stage_argument_parser("Watch the ATP workbook and push the weeks that changed to intervals.icu on every save.")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between checks for a new save of the workbook.")
+    parser.add_argument("--overwrite-past", action="store_true", help="Also push targets of weeks that have already started.")
+    args = parser.parse_args(argv)
+    watcher = WorkbookWatcher(ATP_file_path, args.overwrite_past)
+    with profiled(args, "ATP_watch"):
+        watcher.run(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Synthetic ATP workbook generator for scale testing and benchmarks.
+
+Writes workbooks with the same sheets and columns the scripts read from the
+ATP2intervals_TLA_YYYY.xlsm template: User_Data, ATP_Conditions and ATP_Data
+with period/week, race/cat/race_date, test, focus columns and the
+*_load_target, *_time_target and *_distance_target columns per activity type.
+Season length, number of activity types, race density and number of athletes
+are parameters, and a seed makes every workbook reproducible.
+
+Example:
+    python ATP_workbook_generator.py --athletes 30 --seasons 3 --activity-types 4 --race-density 6 --output-dir C:\\TEMP\\bench
+"""
+import argparse
+import logging
+import os
+import random
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+ACTIVITY_TYPES = ["Ride", "Run", "Swim", "TrailRun", "MountainBikeRide", "OpenWaterSwim", "GravelRide", "Walk"]
+LOAD_TARGET_SLOTS = 8  # The template reserves 8 activity columns, unused ones are named None_load_target
+FOCUS_COLUMNS = ['Weight Lifting', 'Aerobic Endurance', 'Muscular force', 'Speed Skills',
+                 'Muscular Endurance', 'Anaerobic Endurance', 'Sprint Power']
+TESTS = ["FTP", "AeT", "FTP - Ramp", "Swim 1k", "Coopertest"]
+
+# One 52-week season: two race blocks, the second one shorter.
+SEASON_PLAN = [
+    ("Prep", 3), ("Base 1", 4), ("Base 2", 4), ("Base 3", 4), ("Build 1", 4), ("Build 2", 4),
+    ("Peak", 2), ("Race", 1), ("Trans", 2),
+    ("Base 3", 4), ("Build 1", 4), ("Build 2", 4), ("Peak", 2), ("Race", 1), ("Trans", 9),
+]
+PERIOD_LOAD_FACTOR = {
+    "Prep": 0.7, "Base 1": 0.9, "Base 2": 1.0, "Base 3": 1.1, "Build 1": 1.2, "Build 2": 1.25,
+    "Peak": 0.9, "Race": 0.6, "Trans": 0.5,
+}
+UNNUMBERED_PERIODS = ("Prep", "Race", "Trans")
+
+
+def season_periods():
+    """Return (period, week_in_period) for the 52 weeks of one season."""
+    weeks = []
+    for period, length in SEASON_PLAN:
+        for week in range(1, length + 1):
+            weeks.append((period, 0 if period in UNNUMBERED_PERIODS else week))
+    return weeks
+
+
+def monday_on_or_before(date):
+    date = datetime(date.year, date.month, date.day)
+    return date - timedelta(days=date.weekday())
+
+
+def build_atp_rows(start_date, seasons=1, activity_types=None, race_density=3, yearly_tss=22500, seed=0):
+    """Build the ATP_Data rows as a list of dicts, one per week."""
+    rng = random.Random(seed)
+    activity_types = list(activity_types or ACTIVITY_TYPES[:3])
+    plan = season_periods() * seasons
+    weekly_tss = yearly_tss / 52
+
+    # A races sit in the Race weeks; the rest of the race density becomes B and C races.
+    race_weeks = {i: "A" for i, (period, _) in enumerate(plan) if period == "Race"}
+    free_weeks = [i for i, (period, _) in enumerate(plan) if period not in ("Race", "Trans")]
+    extra_races = max(0, race_density * seasons - len(race_weeks))
+    for i in rng.sample(free_weeks, min(extra_races, len(free_weeks))):
+        race_weeks[i] = rng.choice("BC")
+
+    weights = {sport: rng.uniform(0.5, 1.5) for sport in activity_types}
+    total_weight = sum(weights.values())
+    rows = []
+    for i, (period, week) in enumerate(plan):
+        week_start = start_date + timedelta(weeks=i)
+        cat = race_weeks.get(i)
+        row = {
+            "start_date_local": week_start,
+            "period": period,
+            "race": f"Race {week_start:%Y-%m-%d}" if cat else "-",
+            "cat": cat or "-",
+            "race_date": week_start + timedelta(days=6 if cat == "A" else rng.randint(5, 6)) if cat else "-",
+            "test": rng.choice(TESTS) if week == 1 and period.startswith(("Base", "Build")) else 0,
+        }
+        for col in FOCUS_COLUMNS:
+            row[col] = rng.randint(1, 3) if rng.random() < 0.3 else 0
+        factor = PERIOD_LOAD_FACTOR[period] * (0.7 if week == 4 else 1.0)
+        total = 0
+        for sport in activity_types:
+            load = int(round(weekly_tss * factor * weights[sport] / total_weight / 5.0)) * 5
+            row[f"{sport}_load_target"] = load
+            total += load
+        if len(activity_types) < LOAD_TARGET_SLOTS:
+            row["None_load_target"] = 0
+        row["Total_load_target"] = total
+        for sport in activity_types:
+            row[f"{sport}_time_target"] = rng.randrange(0, 600, 30) if rng.random() < 0.2 else 0
+            row[f"{sport}_distance_target"] = rng.randrange(0, 60, 5) if rng.random() < 0.2 else 0
+        row["week"] = week
+        rows.append(row)
+    return rows
+
+
+def write_atp_workbook(path, rows, athlete_id, yearly_tss=22500, unit_preference="metric"):
+    """Write User_Data, ATP_Conditions and ATP_Data sheets in the layout the scripts expect."""
+    start_date = rows[0]["start_date_local"]
+    end_date = rows[-1]["start_date_local"]
+    user_data = pd.DataFrame({
+        "Key": ["USERNAME", "API_KEY", "ATHLETE_ID", "DISTANCE_SYSTEM", "NOTE_ATP_COLOR", "NOTE_FEEDBACK_COLOR", "DO_AT_REST"],
+        "Value": ["API_KEY", "synthetic", athlete_id, unit_preference, "red", "blue", "Only train light, stay in bed or on the beach!"],
+    })
+    conditions = pd.DataFrame({
+        "Key": ["Start_ATP", "Duration", "End_ATP", "Yearly TSS", "Weekly Routine TSS", "TSS per hour "],
+        "Value": [start_date, len(rows), end_date, yearly_tss, 0, 70],
+    })
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        user_data.to_excel(writer, sheet_name="User_Data", index=False)
+        conditions.to_excel(writer, sheet_name="ATP_Conditions", index=False, startcol=1)
+        pd.DataFrame(rows).to_excel(writer, sheet_name="ATP_Data", index=False)
+
+
+def generate_roster(output_dir, athletes=1, seasons=1, activity_types=3, race_density=3, start_date=None, yearly_tss=22500, seed=0):
+    """Generate one workbook per athlete and return their metadata and rows."""
+    os.makedirs(output_dir, exist_ok=True)
+    start_date = monday_on_or_before(start_date or datetime.now())
+    roster = []
+    for n in range(athletes):
+        athlete_rng = random.Random(seed * 1000 + n)
+        tla = f"A{n:02d}"
+        athlete_id = f"i{n}"
+        types = ACTIVITY_TYPES[:activity_types] if n == 0 else athlete_rng.sample(ACTIVITY_TYPES, activity_types)
+        rows = build_atp_rows(start_date, seasons, types, race_density, yearly_tss, seed=seed * 1000 + n)
+        path = os.path.join(output_dir, f"ATP2intervals_{tla}_{start_date.year}.xlsx")
+        write_atp_workbook(path, rows, athlete_id, yearly_tss)
+        roster.append({"tla": tla, "athlete_id": athlete_id, "year": start_date.year, "path": path, "rows": rows})
+        logging.info(f"Wrote {path} ({len(rows)} weeks, {len(types)} activity types)")
+    return roster
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic ATP workbooks for scale testing.")
+    parser.add_argument("--output-dir", default="synthetic_atp", help="Directory to write the workbooks to.")
+    parser.add_argument("--athletes", type=int, default=1, help="Number of athletes (one workbook each).")
+    parser.add_argument("--seasons", type=int, default=1, help="Number of 52-week seasons per workbook.")
+    parser.add_argument("--activity-types", type=int, default=3, choices=range(1, LOAD_TARGET_SLOTS + 1), help="Activity types per athlete.")
+    parser.add_argument("--race-density", type=int, default=3, help="Races per season (A races plus B/C races).")
+    parser.add_argument("--start", type=lambda s: datetime.strptime(s, "%Y-%m-%d"), default=None, help="ATP start date (YYYY-MM-DD), defaults to this week.")
+    parser.add_argument("--yearly-tss", type=int, default=22500, help="Yearly TSS the weekly loads are based on.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for reproducible workbooks.")
+    args = parser.parse_args()
+    generate_roster(args.output_dir, args.athletes, args.seasons, args.activity_types, args.race_density, args.start, args.yearly_tss, args.seed)
+
+
+if __name__ == "__main__":
+    main()
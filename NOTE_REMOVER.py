@@ -10,6 +10,7 @@ import random
 from functools import wraps
 import os
 import argparse
+from ATP_profiling import profiled
 
 # Import all config and variables from ATP_common_config.py
 import ATP_common_config as config
@@ -21,13 +22,14 @@ def delete_note_events(year, rip_word, verbose=False):
     start_date = datetime(year, 1, 1).strftime("%Y-%m-%dT00:00:00")
     end_date = datetime(year, 12, 31).strftime("%Y-%m-%dT23:59:59")
     url_get = f"{config.url_base}/events.json"
-    params = {"oldest": start_date, "newest": end_date, "category": "NOTE"}
     headers = config.API_headers
 
     try:
-        resp = requests.get(url_get, headers=headers, params=params, auth=HTTPBasicAuth(config.username, config.api_key))
-        resp.raise_for_status()
-        events = resp.json()
+        # The year is read in quarters side by side; notes listed by two quarters are returned once
+        events, status = config.fetch_records(url_get, start_date, end_date, params={"category": "NOTE"}, fields={"id": None, "name": ""},
+                                              convert=config.EventRecord.from_json, headers=headers, auth=HTTPBasicAuth(config.username, config.api_key))
+        if status != 200:
+            raise requests.HTTPError(f"{status} fetching NOTE events for {year}")
         if verbose:
             logging.info(f"Fetched {len(events)} NOTE events for {year}")
         deleted = 0
@@ -35,7 +37,7 @@ def delete_note_events(year, rip_word, verbose=False):
             if rip_word.lower() in event['name'].lower():
                 event_id = event['id']
                 url_del = f"{config.url_base}/events/{event_id}"
-                del_resp = requests.delete(url_del, headers=headers, auth=HTTPBasicAuth(config.username, config.api_key))
+                del_resp = config.call_with_retries(config.http_session.delete, url_del, headers=headers, auth=HTTPBasicAuth(config.username, config.api_key))
                 if del_resp.ok:
                     deleted += 1
                     logging.info(f"Deleted event ID={event_id} - Name: {event['name']}")
@@ -47,7 +49,7 @@ def delete_note_events(year, rip_word, verbose=False):
         print("Failed to process/delete events.")
 
 def main():
-    parser = argparse.ArgumentParser(description="Delete NOTES containing a specific word for a given year.")
+    parser = config.stage_argument_parser("Delete NOTES containing a specific word for a given year.")
     parser.add_argument("--year", type=int, help="Year to check (e.g., 2026). If not provided, prompts interactively.")
     parser.add_argument("--rip_word", type=str, help="Word to match in NOTES to delete. If not provided, prompts interactively.")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose logging.")
@@ -59,7 +61,8 @@ def main():
     year = args.year if args.year else int(input("Year to check for NOTE events to delete? "))
     rip_word = args.rip_word if args.rip_word else input("Word to search for in NOTE events to delete (rip_word)? ")
 
-    delete_note_events(year, rip_word, args.verbose)
+    with profiled(args, "NOTE_REMOVER"):
+        delete_note_events(year, rip_word, args.verbose)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,65 @@
+"""
+Retry and concurrency tests of the sync stages, against the fault-injecting
+stand-in of ATP_mock_server (see ATP_fault_scenarios for the scenarios and
+their checks). Every scenario runs the stages as separate processes, so a
+test takes a minute or so:
+
+    python -m pytest test_fault_scenarios.py
+"""
+import pytest
+
+from ATP_fault_scenarios import SCENARIOS, duplicates, fault_athlete, reference_events, run_scenario, scenario_failures
+
+ATTEMPTS = 3
+TIMEOUT = 600
+
+
+@pytest.fixture(scope="module")
+def workdir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("atp_faults"))
+
+
+@pytest.fixture(scope="module")
+def athlete(workdir):
+    return fault_athlete(workdir)
+
+
+@pytest.fixture(scope="module")
+def expected_events(athlete, workdir):
+    return reference_events(athlete, TIMEOUT, workdir)
+
+
+def checked_scenario(name, athlete, expected_events, workdir):
+    spec = SCENARIOS[name]
+    result = run_scenario(name, spec, athlete, ATTEMPTS, TIMEOUT, workdir)
+    assert all(stage["returncode"] == 0 for stage in result["stages"].values()), result["stages"]
+    assert result["seconds"] <= spec["max_seconds"]
+    assert result["retries"] <= spec["max_retries"]
+    assert duplicates(result["created"]) == []
+    assert result["duplicate_events"] == []
+    assert result["events"] == expected_events
+    assert scenario_failures(result, spec, expected_events) == []
+    return result
+
+
+def test_baseline(athlete, expected_events, workdir):
+    result = checked_scenario("baseline", athlete, expected_events, workdir)
+    assert result["retries"] == 0
+    assert result["reruns"] == 0
+    assert result["dropped"] == 0
+
+
+def test_dropped_writes(athlete, expected_events, workdir):
+    result = checked_scenario("dropped_writes", athlete, expected_events, workdir)
+    # Creates whose answer was lost are not sent again; the ledger finds them on the next run
+    assert result["dropped"] > 0
+
+
+def test_429_storm(athlete, expected_events, workdir):
+    result = checked_scenario("429_storm", athlete, expected_events, workdir)
+    assert result["retries"] > 0
+
+
+def test_dropped_connections(athlete, expected_events, workdir):
+    result = checked_scenario("dropped_connections", athlete, expected_events, workdir)
+    assert result["dropped"] > 0